@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Microbenchmark of the per-request cost of store_from_config
+
+Usage: python benchmarks/bench_store_from_config.py [-n NUMBER] [CONFIG]
+
+No database connection is made: store_from_config only parses the config,
+connections are established lazily on first get_cursor().
+'''
+
+import argparse
+import timeit
+
+import douban.sqlstore as M
+
+DATABASE = {
+    'farms': dict(('farm%d' % i, {
+        'master': '127.0.0.1:3306:test_sqlstore%d:sqlstore:sqlstore' % i,
+        'tables': ['test_table%d_%d' % (i, j) for j in range(200)],
+    }) for i in range(1, 11)),
+}
+DATABASE['farms']['farm1']['tables'].append('*')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=100000)
+    parser.add_argument('config', nargs='?',
+                        help='sqlstore config name, also measured besides '
+                             'a builtin dict config with 10 farms and 2000 '
+                             'tables')
+    args = parser.parse_args()
+
+    M.store_from_config(DATABASE)
+    cases = [
+        ('cached dict', lambda: M.store_from_config(DATABASE)),
+        ('cached dict kwargs',
+         lambda: M.store_from_config(DATABASE, delete_without_where=False)),
+        # the digest of a dict config is computed once per dict object, an
+        # equal copy is digested on every call
+        ('dict copy', lambda: M.store_from_config(dict(DATABASE))),
+    ]
+    if args.config:
+        M.store_from_config(args.config)
+        cases.extend([
+            ('cached name', lambda: M.store_from_config(args.config)),
+            ('cached name kwargs',
+             lambda: M.store_from_config(args.config,
+                                         delete_without_where=False)),
+        ])
+    for name, func in cases:
+        cost = timeit.timeit(func, number=args.number)
+        print '%-20s %8.3f usec/call' % (name, cost / args.number * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,14 @@
 '''SqlStore library for douban'''
 
 from contextlib import contextmanager
-from operator import itemgetter
-from warnings import warn, catch_warnings, formatwarning
 from hashlib import md5
+from operator import itemgetter
+from warnings import warn
+import atexit
 import collections
 import os
 import pwd
+import Queue
 import random
 import re
 import socket
@@ -19,6 +21,8 @@ import syslog
 import threading
 import time
 import traceback
+import urlparse
+import weakref
 
 try:
     import cPickle as pickle
@@ -26,11 +30,12 @@ except ImportError:
     import pickle
 
 import MySQLdb
-from MySQLdb.constants.CR import COMMANDS_OUT_OF_SYNC, SERVER_GONE_ERROR
+from MySQLdb.constants import CLIENT
+from MySQLdb.constants.CR import COMMANDS_OUT_OF_SYNC, SERVER_GONE_ERROR, \
+    SERVER_LOST
 
 try:
     from raven import Client as RavenClient
-    from raven.utils.stacks import get_stack_info, iter_stack_frames
 except ImportError:
     RavenClient = None
 
@@ -39,7 +44,13 @@ from douban.utils import hashdict
 from douban.utils.imloaded import imloaded
 from douban.utils.slog import log
 
+from .bulk import check_format, format_rows, load_statement, split_file
+from .capture import CaptureWriter
+from .columns import ColumnBuilder
+from .conv import get_conv, get_decoders
 from .dbconfig import DBConfig
+from .scatter import ScatterQuery
+from .sharding import ShardedTable, ShardingError
 from .table_finder import find_tables
 
 imloaded('douban.sqlstore')
@@ -63,6 +74,192 @@ except Exception, exc:
     USER = 'unknown'
 
 
+class LogBuffer(object):
+
+    '''在后台线程中写入slog和syslog
+
+    Identical messages logged within `interval` seconds are written once
+    with a repeat count. When `maxsize` distinct messages are pending, new
+    ones are dropped and counted. Pending messages are flushed at exit.
+    '''
+
+    def __init__(self, interval=1, maxsize=1000):
+        self.interval = interval
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.pending = collections.OrderedDict()
+        self.dropped = 0
+        self.worker = None
+        atexit.register(self.flush)
+
+    def log(self, writer, message):
+        key = (writer, message)
+        with self.lock:
+            count = self.pending.get(key)
+            if count is None and len(self.pending) >= self.maxsize:
+                self.dropped += 1
+                return
+            self.pending[key] = (count or 0) + 1
+        if self.worker is None or not self.worker.is_alive():
+            self.start_worker()
+
+    def start_worker(self):
+        with self.lock:
+            # worker thread does not survive fork
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run,
+                                               name='sqlstore-log')
+                self.worker.daemon = True
+                self.worker.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def after_fork(self):
+        # the lock may have been held by a thread of the parent process
+        self.lock = threading.Lock()
+        self.worker = None
+        # messages of the parent are flushed by the parent
+        self.pending = collections.OrderedDict()
+        self.dropped = 0
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, collections.OrderedDict()
+            dropped, self.dropped = self.dropped, 0
+        for (writer, message), count in pending.iteritems():
+            if count > 1:
+                message = '%s (repeated %d times)' % (message, count)
+            try:
+                writer(message)
+            except Exception:
+                pass
+        if dropped:
+            slog('LOG_BUFFER_DROPPED %d' % dropped)
+
+
+log_buffer = LogBuffer()
+
+
+def buffered_slog(message):
+    log_buffer.log(slog, message)
+
+
+def buffered_syslog(message):
+    log_buffer.log(syslog.syslog, message)
+
+
+def get_raw_frames(skip=1, limit=50):
+    '''Return (filename, lineno, function, module) of the current stack,
+    outermost first, without reading any source file'''
+
+    frame = sys._getframe(skip + 1)
+    frames = []
+    while frame is not None and len(frames) < limit:
+        code = frame.f_code
+        frames.append((code.co_filename, frame.f_lineno, code.co_name,
+                       frame.f_globals.get('__name__')))
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+class SentryReporter(object):
+
+    '''在后台线程中发送sentry消息
+
+    Messages with the same key, e.g. (exception class, farm), are sent to a
+    client at most once per `interval` seconds, the number of suppressed
+    messages is attached to the next one. Messages are dropped when the
+    queue is full. Messages of all stores are sent by one reporter,
+    sentry_reporter, flushed at exit.
+    '''
+
+    def __init__(self, maxsize=100):
+        self.queue = Queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.history = {}
+        self.dropped = 0
+        self.worker = None
+        atexit.register(self.flush)
+
+    def report(self, client, key, message, frames, extra, interval=60):
+        now = time.time()
+        key = (id(client),) + tuple(key)
+        with self.lock:
+            last_time, suppressed = self.history.get(key, (0, 0))
+            if now - last_time < interval:
+                self.history[key] = (last_time, suppressed + 1)
+                return False
+            self.history[key] = (now, 0)
+            dropped = self.dropped
+
+        extra['suppressed'] = suppressed
+        extra['dropped'] = dropped
+        try:
+            self.queue.put_nowait((client, message, frames, extra))
+        except Queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+        self.ensure_worker()
+        return True
+
+    def ensure_worker(self):
+        if self.worker is not None and self.worker.is_alive():
+            return
+        with self.lock:
+            # worker thread does not survive fork
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run,
+                                               name='sqlstore-sentry')
+                self.worker.daemon = True
+                self.worker.start()
+
+    def run(self):
+        while True:
+            client, message, frames, extra = self.queue.get()
+            try:
+                self.send(client, message, frames, extra)
+            except Exception, exc:
+                slog('SEND_TO_SENTRY_FAIL: %s' % exc)
+            finally:
+                self.queue.task_done()
+
+    def send(self, client, message, frames, extra):
+        frames = [{'filename': filename,
+                   'abs_path': filename,
+                   'lineno': lineno,
+                   'function': function,
+                   'module': module}
+                  for filename, lineno, function, module in frames]
+        data = {
+            'sentry.interfaces.Stacktrace': {
+                'frames': frames
+            }
+        }
+        client.captureMessage(message, data=data, extra=extra)
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue(self.queue.maxsize)
+        self.worker = None
+
+    def flush(self, timeout=1):
+        '''Wait at most `timeout` seconds for queued messages to be sent'''
+
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            if self.worker is None or not self.worker.is_alive():
+                break
+            time.sleep(0.01)
+
+
+sentry_reporter = SentryReporter()
+
+
 class QueryDisabledException(Exception):
 
     def __init__(self, sql, recover_timestamp):
@@ -87,6 +284,109 @@ class InvalidMySQLDataException(Exception):
         return '%s: SQL:%s args:%s' % (self.message, self.sql, self._args)
 
 
+class QueryBudgetExceeded(Exception):
+
+    def __init__(self, name, kind, detail):
+        self.name = name
+        self.kind = kind
+        self.detail = detail
+
+    def __str__(self):
+        return 'SQL budget of %s exceeded (%s): %s' % (self.name, self.kind,
+                                                       self.detail)
+
+
+class QueryBudget(object):
+
+    '''单个请求的SQL统计与预算
+
+    Count statements and DB time of a request, and executions of the same
+    statement with different arguments (N+1 queries). Exceeding a soft
+    budget, or repeating a statement `repeat_threshold` times, is logged
+    and sampled to sentry; exceeding a hard budget raises
+    QueryBudgetExceeded before the next statement.
+    '''
+
+    def __init__(self, store, name=None, soft_statements=None,
+                 hard_statements=None, soft_time=None, hard_time=None,
+                 repeat_threshold=None, sentry_sample_rate=0):
+        self.store = store
+        self.name = name or CMDLINE
+        self.soft_statements = soft_statements
+        self.hard_statements = hard_statements
+        self.soft_time = soft_time
+        self.hard_time = hard_time
+        self.repeat_threshold = repeat_threshold
+        self.sentry_sample_rate = sentry_sample_rate
+        self.statements = 0
+        self.time = 0.0
+        # sql -> [count, time, set of distinct args]
+        self.fingerprints = {}
+        self.exceeded = []
+        self.start = time.time()
+
+    def check(self):
+        '''Raise QueryBudgetExceeded if a hard budget is used up'''
+
+        if self.hard_statements is not None and \
+                self.statements >= self.hard_statements:
+            self.exceed('hard_statements', self.statements, hard=True)
+        if self.hard_time is not None and self.time >= self.hard_time:
+            self.exceed('hard_time', round(self.time, 6), hard=True)
+
+    def record(self, sql, args, timecost):
+        self.statements += 1
+        self.time += timecost
+        stats = self.fingerprints.get(sql)
+        if stats is None:
+            stats = self.fingerprints[sql] = [0, 0.0, set()]
+        stats[0] += 1
+        stats[1] += timecost
+
+        if self.repeat_threshold and len(stats[2]) < self.repeat_threshold:
+            stats[2].add(repr(args))
+            if len(stats[2]) == self.repeat_threshold:
+                self.exceed('repeated', sql)
+        if self.soft_statements is not None and \
+                self.statements == self.soft_statements + 1:
+            self.exceed('soft_statements', self.statements)
+        if self.soft_time is not None and self.time > self.soft_time and \
+                self.time - timecost <= self.soft_time:
+            self.exceed('soft_time', round(self.time, 6))
+
+    def exceed(self, kind, detail, hard=False):
+        exc = QueryBudgetExceeded(self.name, kind, detail)
+        self.exceeded.append((kind, detail))
+        buffered_slog('SQL_BUDGET_EXCEEDED %s %s %s' % (self.name, kind,
+                                                        detail))
+        if self.sentry_sample_rate and \
+                random.random() < self.sentry_sample_rate:
+            self.store.send_exception_to_onimaru(exc, self.store)
+        if hard:
+            raise exc
+
+    def summary(self):
+        '''Return statistics of the request, statements executed more than
+        once are listed in `repeated`, most executed first'''
+
+        repeated = [{'sql': sql,
+                     'fingerprint': md5(sql).hexdigest(),
+                     'count': count,
+                     'distinct_args': len(args),
+                     'time': round(timecost, 6)}
+                    for sql, (count, timecost, args)
+                    in self.fingerprints.items() if count > 1]
+        repeated.sort(key=itemgetter('count'), reverse=True)
+        return {
+            'name': self.name,
+            'statements': self.statements,
+            'time': round(self.time, 6),
+            'duration': round(time.time() - self.start, 6),
+            'repeated': repeated,
+            'exceeded': list(self.exceeded),
+        }
+
+
 class PleaseIgnoreThisMySQLException(MySQLdb.OperationalError):
     sentry_dsn = False
 
@@ -125,6 +425,50 @@ class LogCursor(object):
         return getattr(self.cursor, attr)
 
 
+class CaptureCursor(object):
+
+    '''把执行的SQL写入capture文件，用于重放'''
+
+    def __init__(self, cursor, writer, farm_name):
+        self.cursor = cursor
+        self.writer = writer
+        self.farm_name = farm_name
+
+    def execute(self, sql, args=None, **kw):
+        '''提供与MySQLdb.Cursor相同的执行SQL接口'''
+
+        return self._capture(self.cursor.execute, [(sql, args)], sql, args,
+                             **kw)
+
+    def execute_multi(self, statements, **kw):
+        '''批量执行，每条SQL分别写入capture文件'''
+
+        return self._capture(self.cursor.execute_multi, statements,
+                             statements, **kw)
+
+    def _capture(self, func, statements, *args, **kw):
+        time_begin = time.time()
+        ok = False
+        try:
+            retval = func(*args, **kw)
+            ok = True
+            return retval
+        finally:
+            timecost = (time.time() - time_begin) / max(len(statements), 1)
+            try:
+                for sql, sql_args in statements:
+                    self.writer.write(time_begin, self.farm_name, sql,
+                                      sql_args, timecost, ok)
+            except Exception, exc:
+                buffered_slog('CAPTURE_FAIL: %s' % exc)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+
 class WarningCursor(object):
 
     '''警告已经废弃的store调用接口'''
@@ -140,6 +484,246 @@ class WarningCursor(object):
         return getattr(self.cursor, attr)
 
 
+class ConvCursor(object):
+
+    '''用其他的转换函数转换查询结果，见douban.sqlstore.conv'''
+
+    def __init__(self, cursor, decoders):
+        self.cursor = cursor
+        self.decoders = decoders
+
+    def execute(self, *a, **kw):
+        '''提供与MySQLdb.Cursor相同的执行SQL接口，转换函数由LuzCursor在
+        执行时换上，重连后的新连接也一样'''
+
+        cursor = self.cursor
+        while not isinstance(cursor, LuzCursor):
+            cursor = cursor.cursor
+        while cursor.replaced_by is not None:
+            cursor = cursor.replaced_by
+        cursor.decoders = self.decoders
+        try:
+            return self.cursor.execute(*a, **kw)
+        finally:
+            cursor.decoders = None
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+
+DRIVERS = {
+    'mysql': 'MySQLdb',
+    'fake': 'douban.sqlstore.fakedb',
+}
+
+
+def get_driver(name=None):
+    '''Return the DB-API module named `name` in DRIVERS (or the module path
+    itself), MySQLdb by default'''
+
+    module = DRIVERS.get(name or 'mysql', name)
+    if module == 'MySQLdb':
+        return MySQLdb
+    __import__(module)
+    return sys.modules[module]
+
+
+def get_server_side_cursorclass(driver=None):
+    '''Return the unbuffered cursor class of a driver, whose rows are
+    fetched from the server on demand'''
+
+    driver = get_driver(driver)
+    if driver is MySQLdb:
+        from MySQLdb.cursors import SSCursor
+        return SSCursor
+    return driver.SSCursor
+
+
+class SharedConnection(object):
+
+    '''被多个SqlFarm共享的数据库连接'''
+
+    def __init__(self, key, conn, tx_isolation, expire_time):
+        self.key = key
+        self.conn = conn
+        self.tx_isolation = tx_isolation
+        self.expire_time = expire_time
+        self.refs = 0
+        self.farms = weakref.WeakSet()
+
+    def is_usable(self):
+        return bool(self.conn.open) and self.expire_time > time.time()
+
+    def in_transaction(self, store):
+        '''是否有其他store在此连接上有未提交的修改'''
+
+        return any(farm.shared_connection is self and farm.store is not store
+                   and farm.is_modified() for farm in list(self.farms))
+
+
+class ConnectionRegistry(object):
+
+    '''进程内按线程和dbcnf共享的数据库连接
+
+    Farms of different stores with the same dbcnf use one connection in a
+    thread, so a commit or rollback issued by any of these stores applies
+    to all of them. Transaction bookkeeping (modified_cursors etc.) stays
+    per store, and a connection with uncommitted changes of a store is not
+    shared with other stores until they are committed or rolled back.
+
+    Connections opened in the worker threads of parallel_map belong to the
+    thread calling it, see owner_thread_ident(). Entries of threads which
+    exited are dropped when a new connection is registered.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    @staticmethod
+    def make_key(dbcnf):
+        return tuple(sorted((k, repr(v)) for k, v in dbcnf.items()))
+
+    def acquire(self, farm):
+        '''Return the connection shared by farms with the dbcnf of farm in
+        the current thread, None if another store has uncommitted changes
+        on it'''
+
+        key = (owner_thread_ident(), self.make_key(farm.dbcnf))
+        with self.lock:
+            shared = self.connections.get(key)
+        if shared is None or not shared.is_usable():
+            # connect outside of the lock, it may take long
+            conn = farm.open_connection(**farm.dbcnf)
+            expire_ts = farm.dbcnf.get('connection_expire_seconds')
+            expire_time = time.time() + (expire_ts or 3600)
+            new = SharedConnection(key, conn, conn.sqlstore_tx_isolation,
+                                   expire_time)
+            with self.lock:
+                current = self.connections.get(key)
+                if current is not None and current is not shared and \
+                        current.is_usable():
+                    # registered meanwhile by another worker thread of the
+                    # same owner
+                    shared = current
+                else:
+                    self.connections[key] = shared = new
+                    self.drop_dead_threads()
+            if shared is not new:
+                conn.close()
+        if shared.in_transaction(farm.store):
+            return None
+        with self.lock:
+            shared.refs += 1
+        shared.farms.add(farm)
+        return shared
+
+    def drop_dead_threads(self):
+        '''Stop sharing connections of threads which exited, called with
+        the lock held'''
+
+        alive = set(t.ident for t in threading.enumerate())
+        for key in [k for k in self.connections if k[0] not in alive]:
+            del self.connections[key]
+
+    def release(self, shared):
+        with self.lock:
+            shared.refs -= 1
+            if shared.refs > 0:
+                return
+            if self.connections.get(shared.key) is shared:
+                del self.connections[shared.key]
+        try:
+            shared.conn.close()
+        except Exception:
+            pass
+
+    def invalidate(self, shared):
+        '''Stop sharing a broken connection and release it'''
+
+        with self.lock:
+            if self.connections.get(shared.key) is shared:
+                del self.connections[shared.key]
+        self.release(shared)
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        _inherited_connections.extend(shared.conn for shared
+                                      in self.connections.values())
+        self.connections = {}
+
+
+shared_connections = ConnectionRegistry()
+
+# connections inherited from the parent process, referenced until exit so
+# that garbage collecting them does not send COM_QUIT on the socket still
+# used by the parent
+_inherited_connections = []
+# the process module level state belongs to
+_pid = os.getpid()
+
+
+def reset_after_fork():
+    '''Reset module level locks and connections in a forked process'''
+
+    global _pid, _spare_lock, _retries_lock
+    if _pid == os.getpid():
+        return
+    _pid = os.getpid()
+    log_buffer.after_fork()
+    sentry_reporter.after_fork()
+    shared_connections.after_fork()
+    _spare_lock = threading.Lock()
+    _retries_lock = threading.Lock()
+    _stores.lock = threading.Lock()
+    _config_keys.lock = threading.Lock()
+
+
+def after_fork(warmup=False):
+    '''Prepare the stores cached by store_from_config for a child process,
+    call it in the post-fork hook of pre-fork servers (e.g. post_fork of
+    gunicorn), see SqlStore.after_fork. Return {store: warmup report}.
+    '''
+
+    reset_after_fork()
+    return dict((store, store.after_fork(warmup))
+                for store in _stores.values())
+
+
+# guards the hand-off of SqlFarm.spare between the keepalive thread and
+# the thread using the store
+_spare_lock = threading.Lock()
+# guards SqlStore.retries updated by the threads using a store
+_retries_lock = threading.Lock()
+
+
+class KeepaliveThread(threading.Thread):
+
+    '''Call store.maintain_connections() every `interval` seconds until
+    the store is garbage collected or stop() is called'''
+
+    def __init__(self, store, interval):
+        threading.Thread.__init__(self, name='sqlstore-keepalive')
+        self.daemon = True
+        self.store_ref = weakref.ref(store)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            store = self.store_ref()
+            if store is None:
+                break
+            store.maintain_connections()
+            del store
+
+    def stop(self):
+        self.stopped.set()
+
+
 class SqlFarm(object):
 
     '''单个数据库的访问接口'''
@@ -158,10 +742,21 @@ class SqlFarm(object):
         self.host = self.dbcnf.get('host', '')
         self.name = name or '%s_farm' % self.host.split('_')[0]
         self.delete_without_where = delete_without_where
-        self.cursor = None
+        self.capture_writer = None
+        self.shared_connection = None
+        self._cursor = None
+        # connection opened ahead of time by the keepalive thread
+        self.spare = None
+        self.last_used = time.time()
+        self.pid = os.getpid()
+        # farms on the same database with compression switched, see
+        # get_cursor(compress=...)
+        self.compress_farms = {}
+        # only select is allowed outside the transaction of the store
+        self.select_only = False
+        self.store = store or SqlStore(db_config={})
         self.expire_time = None
         self.set_expire_time()
-        self.store = store or SqlStore(db_config={})
         self.tx_isolation = ''
 
     def __str__(self):
@@ -171,37 +766,92 @@ class SqlFarm(object):
 
     __repr__ = __str__
 
-    def connect(self, host, user, passwd, db, **kwargs):
-        '''提供与MySQLdb.Cursor相同的数据库连接接口'''
+    @property
+    def cursor(self):
+        return self._cursor
+
+    @cursor.setter
+    def cursor(self, cursor):
+        if cursor is None and self.shared_connection is not None:
+            # the connection is broken or closed, stop sharing it
+            shared_connections.invalidate(self.shared_connection)
+            self.shared_connection = None
+        self._cursor = cursor
 
+    def open_connection(self, host, user, passwd, db, driver=None, conv=None,
+                        net_read_timeout=None, net_write_timeout=None,
+                        **kwargs):
+        '''建立并初始化数据库连接'''
+
+        driver = get_driver(driver)
         conn_params = dict(host=host, user=user, db=db,
                            init_command='set names utf8', **kwargs)
         if passwd:
             conn_params['passwd'] = passwd
+        conv = get_conv(conv, driver)
+        if conv is not None:
+            conn_params['conv'] = conv
+        if self.store.multi_statements:
+            conn_params['client_flag'] = conn_params.get('client_flag', 0) | \
+                CLIENT.MULTI_STATEMENTS
 
         try:
-            if not getattr(MySQLdb, 'origin_connect', None):
-                conn = MySQLdb.connect(**conn_params)
-            else:
+            if driver is MySQLdb and getattr(MySQLdb, 'origin_connect', None):
                 conn = MySQLdb.origin_connect(**conn_params)
+            else:
+                conn = driver.connect(**conn_params)
         except Exception, exc:
             self.store.send_exception_to_onimaru(exc, self)
             raise
 
+        conn.sqlstore_multi_statements = self.store.multi_statements
         cursor = conn.cursor()
         cursor.execute('set sort_buffer_size=2000000')
         if self.dbcnf.get('disable_mysql_query_cache'):
             cursor.execute('set session query_cache_type = OFF')
+        if net_read_timeout:
+            cursor.execute('set session net_read_timeout=%d' %
+                           net_read_timeout)
+        if net_write_timeout:
+            cursor.execute('set session net_write_timeout=%d' %
+                           net_write_timeout)
         cursor.execute('select @@tx_isolation')
         r = cursor.fetchone()
-        self.tx_isolation = r and r[0] or ''
-        return LuzCursor(cursor, self)
+        conn.sqlstore_tx_isolation = r and r[0] or ''
+        return conn
+
+    def connect(self, host, user, passwd, db, **kwargs):
+        '''提供与MySQLdb.Cursor相同的数据库连接接口'''
+
+        if self.store.share_connections:
+            if self.shared_connection is not None:
+                shared_connections.release(self.shared_connection)
+                self.shared_connection = None
+            shared = shared_connections.acquire(self)
+        else:
+            shared = None
+        if shared is None:
+            conn = self.open_connection(host, user, passwd, db, **kwargs)
+            self.tx_isolation = conn.sqlstore_tx_isolation
+            return LuzCursor(conn.cursor(), self)
+        self.shared_connection = shared
+        self.tx_isolation = shared.tx_isolation
+        return LuzCursor(shared.conn.cursor(), self)
 
     def close(self):
         '''关闭数据库连接'''
 
+        for farm in self.compress_farms.values():
+            farm.close()
+        spare = self.take_spare()
+        if spare is not None:
+            spare.connection.close()
         if self.cursor:
-            self.cursor.connection.close()
+            if self.shared_connection is not None:
+                shared_connections.release(self.shared_connection)
+                self.shared_connection = None
+            else:
+                self.cursor.connection.close()
             self.cursor = None
 
     def is_expired(self):
@@ -212,16 +862,132 @@ class SqlFarm(object):
     def set_expire_time(self):
         '''设置cursor过期时间'''
 
+        if self.shared_connection is not None:
+            self.expire_time = self.shared_connection.expire_time
+            return
         expire_ts = self.dbcnf.get('connection_expire_seconds')
-        self.expire_time = time.time() + (expire_ts or 3600)
+        jitter = self.store.connection_expire_jitter
+        self.expire_time = time.time() + (expire_ts or 3600) + \
+            (random.uniform(0, jitter) if jitter else 0)
+
+    def forget_connection(self):
+        '''fork之后丢弃从父进程继承的连接，但不关闭，以免影响父进程'''
+
+        for farm in self.compress_farms.values():
+            farm.forget_connection()
+        for cursor in (self._cursor, self.spare):
+            if cursor is not None:
+                _inherited_connections.append(cursor)
+        self._cursor = None
+        self.spare = None
+        self.shared_connection = None
+        self.pid = os.getpid()
+
+    def take_spare(self):
+        '''取走keepalive线程预先建立的连接'''
+
+        with _spare_lock:
+            spare, self.spare = self.spare, None
+        return spare
+
+    def maintain(self, now):
+        '''由keepalive线程调用：检查预备连接，为即将过期或空闲过久的连接
+        预先建立新连接。只准备预备连接，是否切换由get_cursor决定'''
+
+        if self.cursor is None or self.shared_connection is not None:
+            return
 
-    # TODO 修改所有调用ro参数的代码，删除已经废弃的ro参数
-    def get_cursor(self, ro=False):
-        '''取得执行SQL的cursor'''
+        spare = self.take_spare()
+        if spare is not None:
+            try:
+                spare.connection.ping()
+            except Exception:
+                spare = None
+        expiring = self.expire_time - now < self.store.keepalive_interval * 2
+        idle = now - self.last_used > self.store.keepalive_idle
+        if spare is None and (expiring or idle):
+            # not connect(), which changes the state of the farm in use
+            conn = self.open_connection(**self.dbcnf)
+            spare = LuzCursor(conn.cursor(), self)
+        if spare is None:
+            return
+        with _spare_lock:
+            if self.spare is None:
+                self.spare, spare = spare, None
+        if spare is not None:
+            spare.connection.close()
 
-        if self.cursor is None or self.is_expired():
-            self.cursor = self.connect(**self.dbcnf)
+    def is_idle(self):
+        '''空闲过久的连接可能已被wait_timeout断开，有预备连接时切换'''
+
+        return self.spare is not None and \
+            time.time() - self.last_used > self.store.keepalive_idle
+
+    def is_pinned(self):
+        '''store在事务中时不切换连接'''
+
+        return self.store.in_transaction or self.is_modified()
+
+    def is_modified(self):
+        '''store是否在此farm上有未提交的修改'''
+
+        return any(c.farm is self for c in list(self.store.modified_cursors))
+
+    def get_compress_farm(self, compress):
+        '''返回开启（或关闭）协议压缩的同一数据库的SqlFarm'''
+
+        compress = int(bool(compress))
+        farm = self.compress_farms.get(compress)
+        if farm is None:
+            conf = ':'.join(str(self.dbcnf[k]) for k in
+                            ('host', 'port', 'db', 'user', 'passwd'))
+            kwargs = dict((k, v) for k, v in self.dbcnf.items()
+                          if k not in ('host', 'port', 'db', 'user',
+                                       'passwd'))
+            kwargs['compress'] = compress
+            farm = SqlFarm(conf, self.delete_without_where, self.store,
+                           self.name, **kwargs)
+            farm.select_only = True
+            self.compress_farms[compress] = farm
+        farm.capture_writer = self.capture_writer
+        return farm
+
+    # TODO 修改所有调用ro参数的代码，删除已经废弃的ro参数
+    def get_cursor(self, ro=False, compress=None):
+        '''取得执行SQL的cursor
+
+        compress与farm的设置不同时，使用另一个只能执行select的连接，
+        不在当前连接的事务中'''
+
+        if compress is not None and \
+                bool(compress) != bool(self.dbcnf.get('compress')):
+            if self.store.in_transaction or self.store.modified_cursors:
+                raise Exception('compress can not be switched in a '
+                                'transaction: %s' %
+                                ','.join(self.store.modified_tables))
+            return self.get_compress_farm(compress).get_cursor()
+        if self.pid != os.getpid():
+            self.store.after_fork()
+            if self.pid != os.getpid():
+                self.forget_connection()
+        shared = self.shared_connection
+        if shared is not None and not self.is_modified() and \
+                shared.in_transaction(self.store):
+            # 其他store在共享的连接上有未提交的修改，改用单独的连接，以免
+            # 其commit或rollback影响此store
+            shared_connections.release(shared)
+            self.shared_connection = None
+            self._cursor = None
+        if self.cursor is None or not self.is_pinned() and \
+                (self.is_expired() or self.is_idle()):
+            spare = self.take_spare() if self.spare is not None else None
+            if spare is not None:
+                self.tx_isolation = spare.connection.sqlstore_tx_isolation
+            self.cursor = spare or self.connect(**self.dbcnf)
             self.set_expire_time()
+            if self.capture_writer:
+                self.cursor = CaptureCursor(self.cursor, self.capture_writer,
+                                            self.name)
 
         return self.cursor
 
@@ -239,6 +1005,21 @@ class SqlFarm(object):
         if isinstance(self.cursor, LogCursor):
             self.cursor = self.cursor.cursor
 
+    def start_capture(self, writer):
+        '''开始把执行的SQL写入capture文件'''
+
+        self.capture_writer = writer
+        cursor = self.get_cursor()
+        if not isinstance(cursor, CaptureCursor):
+            self.cursor = CaptureCursor(cursor, writer, self.name)
+
+    def stop_capture(self):
+        '''停止写入capture文件'''
+
+        self.capture_writer = None
+        if isinstance(self.cursor, CaptureCursor):
+            self.cursor = self.cursor.cursor
+
     def get_log(self, name, log_format='text', with_traceback=False):
         '''获取已经保存的SQL执行记录'''
 
@@ -299,7 +1080,63 @@ class SqlFarm(object):
         return False
 
 
+# options of the connections of a farm, given by `connect_options` of the
+# farm config or of options, or as the query string of its config string,
+# e.g. "host:3306:db:user:passwd?compress=1&read_timeout=30"
+CONNECT_OPTIONS = ('compress', 'connect_timeout', 'read_timeout',
+                   'write_timeout')
+# server side timeouts, set on the session of new connections
+SESSION_OPTIONS = ('net_read_timeout', 'net_write_timeout')
+# client side timeouts, MySQL-python (up to 1.2.5) rejects them, they are
+# only accepted by mysqlclient since 1.3.8
+CLIENT_TIMEOUTS = ('read_timeout', 'write_timeout')
+
+
+def parse_connect_options(options):
+    '''Return connect options as keyword arguments of SqlFarm'''
+
+    kwargs = {}
+    for name, value in options.items():
+        if name not in CONNECT_OPTIONS and name not in SESSION_OPTIONS:
+            raise ValueError('unknown connect option: %s' % name)
+        kwargs[name] = int(value)
+    return kwargs
+
+
+def check_connect_options(dbcnf):
+    '''Raise ValueError if the driver of a farm does not accept its connect
+    options'''
+
+    driver = get_driver(dbcnf.get('driver'))
+    if driver is not MySQLdb:
+        return
+    timeouts = [name for name in CLIENT_TIMEOUTS if name in dbcnf]
+    if timeouts and getattr(MySQLdb, 'version_info', ()) < (1, 3, 8):
+        raise ValueError('%s not supported by MySQLdb %s, use '
+                         'net_read_timeout and net_write_timeout instead' %
+                         (','.join(timeouts),
+                          getattr(MySQLdb, '__version__', '')))
+
+
+def split_connect_options(config_str):
+    '''Split the connect options off a config string, a trailing "?k=v&..."
+    is only taken as options if all its keys are connect options, so that
+    passwords may still contain "?"'''
+
+    head, sep, query = config_str.rpartition('?')
+    if sep:
+        try:
+            options = urlparse.parse_qsl(query, strict_parsing=True)
+        except ValueError:
+            options = None
+        if options and all((k in CONNECT_OPTIONS or k in SESSION_OPTIONS)
+                           and v.isdigit() for k, v in options):
+            return head, dict(options)
+    return config_str, {}
+
+
 def parse_config_string(config_str):
+    config_str, options = split_connect_options(config_str)
     dummy = config_str.split(':')
     if len(dummy) == 4:
         host, db, user, passwd = dummy
@@ -308,7 +1145,118 @@ def parse_config_string(config_str):
         host, port, db, user, passwd = dummy
     else:
         raise ValueError(config_str)
-    return dict(host=host, port=int(port), db=db, user=user, passwd=passwd)
+    dbcnf = dict(host=host, port=int(port), db=db, user=user, passwd=passwd)
+    dbcnf.update(parse_connect_options(options))
+    return dbcnf
+
+
+# default number of threads of parallel_map
+PARALLEL_POOL_SIZE = 16
+
+
+_thread_owner = threading.local()
+
+
+def owner_thread_ident():
+    '''Return the ident of the current thread, or of the thread whose
+    parallel_map started it'''
+
+    return getattr(_thread_owner, 'ident', None) or \
+        threading.current_thread().ident
+
+
+def parallel_map(func, items, pool_size=PARALLEL_POOL_SIZE):
+    '''Call func(item) for every item concurrently, in at most `pool_size`
+    threads (one thread per item if pool_size is None).
+
+    Return a list of (result, exception) tuples in the order of items.
+    '''
+
+    items = list(items)
+    results = [(None, None)] * len(items)
+    pending = iter(enumerate(items))
+    lock = threading.Lock()
+    owner = owner_thread_ident()
+
+    def run():
+        while True:
+            with lock:
+                try:
+                    index, item = next(pending)
+                except StopIteration:
+                    return
+            try:
+                results[index] = (func(item), None)
+            except Exception, exc:
+                results[index] = (None, exc)
+
+    def work():
+        _thread_owner.ident = owner
+        run()
+
+    size = len(items) if pool_size is None else min(pool_size, len(items))
+    if size <= 1:
+        run()
+        return results
+
+    threads = [threading.Thread(target=work) for _ in xrange(size)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+XA_GTRID_PREFIX = 'sqlstore'
+_xa_counter = iter(xrange(1, sys.maxint))
+
+
+def new_xa_gtrid():
+    '''Return a new gtrid: prefix-host-pid-timestamp-counter
+
+    The hostname is hashed so that the gtrid stays within the 64 bytes
+    MySQL allows whatever the hostname is.
+    '''
+
+    return '%s-%s-%d-%d-%d' % (XA_GTRID_PREFIX, md5(host).hexdigest()[:8],
+                               os.getpid(), int(time.time()),
+                               next(_xa_counter))
+
+
+def parse_xa_gtrid(gtrid):
+    '''Return the start timestamp of a sqlstore gtrid, None if the gtrid
+    was not created by sqlstore'''
+
+    if not gtrid.startswith(XA_GTRID_PREFIX + '-'):
+        return None
+    try:
+        return int(gtrid.rsplit('-', 2)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def read_xa_log(path):
+    '''Return {gtrid: {state: timestamp}} of the XA coordinator log written
+    by SqlStore.commit(), states are "prepare" and "commit"'''
+
+    states = {}
+    if not os.path.exists(path):
+        return states
+    with open(path) as f:
+        for line in f:
+            try:
+                gtrid, state, timestamp = line.split()
+                states.setdefault(gtrid, {})[state] = float(timestamp)
+            except ValueError:
+                # a line left partially written
+                continue
+    return states
+
+
+# select ... for update / lock in share mode
+re_locking_read = re.compile(r'\s(for\s+(update|share)|lock\s+in\s+share\s+'
+                             r'mode)\b', re.I)
 
 SQL_PATTERNS = {
     'select': re.compile(r'select\s.*?\sfrom\s+`?(?P<table>\w+)`?',
@@ -332,12 +1280,212 @@ else:
         execute_waylifer = Waylifer(flag=WAY_SQLSTORE_ARGS_LITERAL)
 
 
+class ExecuteContext(object):
+
+    '''State of a statement passed to the hooks of SqlStore.
+
+    `statement` is the statement given by the caller, `sql` the one sent
+    to MySQL, which before hooks may change.
+    '''
+
+    __slots__ = ('cursor', 'statement', 'sql', 'args', 'cmd', 'fingerprint',
+                 'start', 'called_from_store', 'retry_attempts')
+
+    def __init__(self, cursor, statement, args, called_from_store=False):
+        self.cursor = cursor
+        self.statement = self.sql = statement
+        self.args = args
+        self.cmd = statement.split(' ', 1)[0].lower()
+        self.fingerprint = md5(statement).hexdigest()
+        self.start = time.time()
+        self.called_from_store = called_from_store
+        self.retry_attempts = 0
+
+
+class Hook(object):
+
+    '''Hook called around each statement executed by LuzCursor.
+
+    Subclasses define any of:
+
+      * before(ctx): called before the statement is sent to MySQL, may
+        change ctx.sql or raise to reject the statement.
+      * after(ctx, result): called after the statement succeeded.
+      * error(ctx, exc): called with the exception raised by the statement
+        or by other hooks, which is reraised afterwards. Exceptions raised
+        by error() itself are logged and ignored.
+      * wrap(execute): return a function wrapping
+        execute(cursor, sql, args=None, **kwargs).
+
+    Hooks are compiled into flat lists by SqlStore.compile_hooks(), hooks
+    whose enabled(store) returns false are left out and cost nothing.
+    '''
+
+    before = None
+    after = None
+    error = None
+    wrap = None
+
+    def enabled(self, store):
+        return True
+
+
+class BlacklistHook(Hook):
+
+    '''Reject statements disabled by the query blacklist'''
+
+    def before(self, ctx):
+        store = ctx.cursor.farm.store
+
+        # Check if there are full parameterized queries to be blocked
+        if store.disabled_queries_with_args:
+            if ctx.args:
+                _sql = ctx.statement % \
+                    ctx.cursor.cursor.connection.literal(ctx.args)
+            else:
+                _sql = ctx.statement
+            fingerprint = md5(_sql).hexdigest()
+            expire_time = store.disabled_queries_with_args.get(fingerprint)
+            if expire_time:
+                if expire_time > time.time():
+                    raise QueryDisabledException(_sql, expire_time)
+                else:
+                    store.disabled_queries_with_args.pop(fingerprint, None)
+
+        # Check if there are non-parameterized quereis to be blocked
+        if store.disabled_queries:
+            expire_time = store.disabled_queries.get(ctx.fingerprint)
+            if expire_time:
+                if expire_time > time.time():
+                    raise QueryDisabledException(ctx.statement, expire_time)
+                else:
+                    store.disabled_queries.pop(ctx.fingerprint, None)
+
+
+class AnnotationHook(Hook):
+
+    '''Append the source, fingerprint, user and client to the statement'''
+
+    def before(self, ctx):
+        source = os.environ.get('SQLSTORE_SOURCE') or CMDLINE
+        source = source.replace('%', '%%')
+        ctx.sql = ctx.sql + ' -- SRC:' + source + ' MD5:' + \
+            ctx.fingerprint + ' USER:' + USER + ' CLIENT:' + \
+            ctx.cursor.client_info
+
+
+class WarningHook(Hook):
+
+    '''Log MySQL warnings of statements, or treat them as errors'''
+
+    def enabled(self, store):
+        return bool(store.show_warnings or store.treat_warning_as_error or
+                    store.treat_warning_as_error_sampling_rate)
+
+    def after(self, ctx, result):
+        cursor = ctx.cursor
+        store = cursor.farm.store
+        chosen_by_god = random.random() < \
+            store.treat_warning_as_error_sampling_rate
+        if not store.show_warnings and not store.treat_warning_as_error and \
+                not chosen_by_god:
+            return
+
+        warnings = cursor._get_warnings()
+        if not warnings:
+            return
+        if store.treat_warning_as_error or chosen_by_god:
+            cursor.cursor.connection.rollback()
+            exc = InvalidMySQLDataException(warnings[0][-1], ctx.sql,
+                                            ctx.args)
+            store.send_exception_to_onimaru(exc, cursor)
+            raise exc
+
+        # aggregated by LogBuffer per fingerprint and warning
+        for level, code, message in warnings:
+            buffered_slog('MYSQL_WARNING %s %s %s(%s): %s' %
+                          (cursor.farm.name, ctx.fingerprint, level, code,
+                           message))
+
+
+class StatsdHook(Hook):
+
+    '''Send the timing of statements to statsd'''
+
+    def enabled(self, store):
+        return bool(store.statsd)
+
+    def timing(self, ctx, key):
+        store = ctx.cursor.farm.store
+        try:
+            store.statsd.timing_since(key, ctx.start,
+                                      store.statsd_sample_rate)
+        except Exception:
+            pass
+
+    def after(self, ctx, result):
+        self.timing(ctx, 'sqlstore.%s.%s' % (ctx.cursor.farm.host, ctx.cmd))
+
+    def error(self, ctx, exc):
+        try:
+            error_code = getattr(exc, 'args', [0])[0]
+        except IndexError:
+            # exc may be self-defined exceptions like
+            # QueryDisabledException which does not have meaningful
+            # error code
+            error_code = 0
+        self.timing(ctx, 'sqlstore.%s.%s.%s' % (ctx.cursor.farm.host,
+                                                ctx.cmd, error_code))
+
+
+class WaylifeHook(Hook):
+
+    '''Wrap execute with waylife, enabled by the SQLSTORE_WAYLIFE
+    environment variable'''
+
+    def enabled(self, store):
+        return execute_waylifer is not None
+
+    def wrap(self, execute):
+        return execute_waylifer(execute)
+
+
+DEFAULT_HOOKS = (BlacklistHook(), AnnotationHook(), WarningHook(),
+                 StatsdHook(), WaylifeHook())
+
+
+class HookOption(object):
+
+    '''Attribute of SqlStore which enables or disables hooks, the hooks
+    are compiled again when it is changed'''
+
+    def __init__(self, name):
+        self.name = '_' + name
+
+    def __get__(self, store, owner):
+        if store is None:
+            return self
+        return store.__dict__.get(self.name)
+
+    def __set__(self, store, value):
+        store.__dict__[self.name] = value
+        if 'hooks' in store.__dict__:
+            store.compile_hooks()
+
+
 class SqlStore(object):
 
+    show_warnings = HookOption('show_warnings')
+    treat_warning_as_error = HookOption('treat_warning_as_error')
+    treat_warning_as_error_sampling_rate = \
+        HookOption('treat_warning_as_error_sampling_rate')
+    statsd = HookOption('statsd')
+
     def __init__(self, host='', user='', password='', db='luz_farm',
                  db_config=None, tables_map=None, created_via='UNKNOWN_APP',
                  db_config_name=None, **kwargs):
         self._kwargs = kwargs
+        self.created_via = created_via
         if not SqlStore.is_safe(created_via):
             warn('SqlStore should be created via DAE API in async mode '
                  '(created via: %s' % created_via)
@@ -347,11 +1495,20 @@ class SqlStore(object):
 
         self.db_config = db_config
         self.db_config_name = db_config_name
+        # the name before SQLSTORE_CONFIG_OVERRIDE applies, see __reduce_ex__
+        self.original_config_name = db_config_name
         self.farms = {}
         self.tables = {}
+        # table -> farms listing it in their `tables`, see scatter_select
+        self.table_farms = {}
         self.tables_map = tables_map or {}
+        self.shards = {}
         self.disabled_queries = {}
         self.disabled_queries_with_args = {}
+        self.raven_client = None
+        self.sentry_report_interval = 60
+        self.hooks = list(DEFAULT_HOOKS)
+        self.compile_hooks()
 
         # Statsd
         self.statsd = None
@@ -367,8 +1524,27 @@ class SqlStore(object):
         self.show_warnings = False
         self.treat_warning_as_error = False
         self.treat_warning_as_error_sampling_rate = 0
+        self.share_connections = False
+        self.xa_transaction = False
+        self.xa_log = None
+        self.multi_statements = False
+        self.keepalive = None
+        self.keepalive_interval = 0
+        self.keepalive_idle = 600
+        self.connection_expire_jitter = 0
+        self.retry_attempts = 0
+        self.retry_backoff = 0.05
+        self.retry_backoff_max = 1
+        self.retries = 0
+        # query_budget() of each thread
+        self._budget = threading.local()
+        self.query_budget_options = {}
+        self.pid = os.getpid()
+        self.warmup_after_fork = False
         # for transaction
         self.in_transaction = False
+        self.xa_gtrid = None
+        self.xa_cursors = set()
         self.modified_tables = set()
         self.modified_cursors = set()
         self.executed_queries = set()
@@ -391,6 +1567,20 @@ class SqlStore(object):
                                                          'sqlstore')
         self.parse_config(self.db_config)
 
+    def __reduce_ex__(self, protocol):
+        if self.db_config_name is None and self.db_config is None:
+            # deprecated store created via host/user/password/db
+            return object.__reduce_ex__(self, protocol)
+
+        # only pickle config identity and options, farms are recreated and
+        # shared in the unpickling process, see unpickle_store. The override
+        # of the unpickling process applies to the original config name.
+        kwargs = dict(self._kwargs)
+        if self.tables_map:
+            kwargs['tables_map'] = self.tables_map
+        config = self.original_config_name or self.db_config
+        return (unpickle_store, (config, self.created_via, kwargs))
+
     def __getstate__(self):
         d = self.__dict__.copy()
         d['cfgreloader'] = None
@@ -399,13 +1589,22 @@ class SqlStore(object):
         d['modified_tables'] = set()
         d['modified_cursors'] = set()
         d['executed_queries'] = set()
+        d['xa_gtrid'] = None
+        d['xa_cursors'] = set()
+        d['keepalive'] = None
+        d.pop('_budget', None)
         d.pop('config_lock', None)
+        for name in ('before_hooks', 'after_hooks', 'error_hooks',
+                     'execute_call'):
+            d.pop(name, None)
         return d
 
     def __setstate__(self, d):
         # if the object passed down to other dpark member
         d['config_lock'] = threading.Lock()
+        d['_budget'] = threading.local()
         self.__dict__.update(d)
+        self.compile_hooks()
         if self.db_config_name:
             # reinitialize the config from local file system when unpickle
             self._init_db_config_from_file()
@@ -439,27 +1638,57 @@ class SqlStore(object):
         sentry_dsn = db_config.get('sentry_dsn')
         if sentry_dsn and RavenClient:
             self.raven_client = RavenClient(sentry_dsn)
+            self.sentry_report_interval = db_config.get('options', {}).get(
+                'sentry_report_interval', 60)
         else:
             self.raven_client = None
 
+        options = db_config.get('options', {})
         _self_farms = {}
         _self_tables = {}
+        _self_table_farms = {}
         _farms = db_config.get('farms', {})
         for name, farm_config in _farms.items():
+            farm_kwargs = self.get_farm_kwargs(farm_config, options)
+            delete_without_where = farm_kwargs.get('delete_without_where',
+                                                   False)
+            # delete_without_where is not a connection parameter of dbcnf
             new_dbcnf = parse_config_string(farm_config['master'])
+            new_dbcnf.update((k, v) for k, v in farm_kwargs.items()
+                             if k != 'delete_without_where')
+            check_connect_options(new_dbcnf)
             farm = self.get_farm(name, no_default=True)
-            if not farm or farm.dbcnf != new_dbcnf:
+            if not farm or farm.dbcnf != new_dbcnf or \
+                    farm.delete_without_where != delete_without_where:
                 farm = SqlFarm(farm_config['master'],
                                store=self,
                                name=name,
-                               **self._kwargs)
+                               **farm_kwargs)
             _self_farms[name] = farm
             for table in farm_config['tables']:
                 _self_tables[table] = farm
+                _self_table_farms.setdefault(table, []).append(farm)
         if db_config and '*' not in _self_tables:
             raise MySQLdb.DatabaseError('No default farm specified')
+        _self_shards = {}
+        for table, shard_config in db_config.get('shards', {}).items():
+            shard = ShardedTable.from_config(table, shard_config)
+            if table in _self_tables:
+                raise ShardingError('%s is both sharded and in farm %s' %
+                                    (table, _self_tables[table].name))
+            for name in shard.farms:
+                if name not in _self_farms:
+                    raise ShardingError('farm %s of sharded table %s is not '
+                                        'found' % (name, table))
+            _self_shards[table] = shard
+        replaced = [farm for farm in self.farms.values()
+                    if farm not in _self_farms.values()]
         self.farms = _self_farms
         self.tables = _self_tables
+        self.table_farms = _self_table_farms
+        self.shards = _self_shards
+        for farm in replaced:
+            farm.close()
 
         # initialize statsd client
         if db_config.get('statsd', {}).get('config'):
@@ -479,7 +1708,6 @@ class SqlStore(object):
                     self.statsd = None
                     print >> sys.stderr, 'initialize statsd fail:', ex
 
-        options = db_config.get('options', {})
         self.logging = options.get('logging', False)
         if os.getenv('DOUBAN_CORELIB_SQLSTORE_LOGGING'):
             self.logging = True
@@ -492,12 +1720,42 @@ class SqlStore(object):
             self.treat_warning_as_error = True
         self.treat_warning_as_error_sampling_rate = \
             options.get('treat_warning_as_error_sampling_rate', 0)
+        self.share_connections = options.get('share_connections', False)
+        self.xa_transaction = options.get('xa_transaction', False)
+        self.xa_log = options.get('xa_log')
+        self.multi_statements = options.get('multi_statements', False)
+        self.connection_expire_jitter = \
+            options.get('connection_expire_jitter', 0)
+        self.retry_attempts = options.get('retry_attempts', 0)
+        self.retry_backoff = options.get('retry_backoff', 0.05)
+        self.retry_backoff_max = options.get('retry_backoff_max', 1)
+        self.query_budget_options = options.get('query_budget', {})
+        self.warmup_after_fork = options.get('warmup_after_fork', False)
+        self.keepalive_idle = options.get('keepalive_idle', 600)
+        self.keepalive_interval = options.get('keepalive_interval', 0)
+        if self.keepalive is not None:
+            self.keepalive.stop()
+            self.keepalive = None
+        if self.keepalive_interval:
+            self.keepalive = KeepaliveThread(self, self.keepalive_interval)
+            self.keepalive.start()
+        if os.getenv('DOUBAN_CORELIB_SQLSTORE_SHARE_CONNECTIONS'):
+            self.share_connections = True
 
         self.cfgreloader_config_node = \
             db_config.get('cfgreloader', {}).get('config_node', None)
         self.cfgreloader_blacklist_node = \
             db_config.get('cfgreloader', {}).get('blacklist_node', None)
 
+        self.register_cfgreloader()
+
+        self.db_config = db_config
+        self.initialized = True
+        self.config_lock.release()
+
+    def register_cfgreloader(self):
+        """Register callbacks of config and query blacklist nodes"""
+
         if self.cfgreloader_config_node:
             try:
                 if not self.cfgreloader:
@@ -542,9 +1800,96 @@ class SqlStore(object):
                                  exc)
                     print >> sys.stderr, msg
 
-        self.db_config = db_config
-        self.initialized = True
-        self.config_lock.release()
+    def after_fork(self, warmup=None):
+        """Make the store usable in a forked child process.
+
+        Connections inherited from the parent are dropped without being
+        closed, transaction state is cleared, and the keepalive thread and
+        cfgreloader callbacks are set up again. It is called lazily when
+        get_cursor() sees a new pid, or explicitly from a post-fork hook.
+        If `warmup` (defaults to the `warmup_after_fork` option) is true,
+        connections are opened again in parallel and the report of
+        warmup() is returned.
+        """
+
+        if warmup is None:
+            warmup = self.warmup_after_fork
+        if self.pid != os.getpid():
+            reset_after_fork()
+            self.pid = os.getpid()
+            for farm in self.farms.values():
+                farm.forget_connection()
+            self.in_transaction = False
+            self.modified_tables = set()
+            self.modified_cursors = set()
+            self.executed_queries = set()
+            self.xa_gtrid = None
+            self.xa_cursors = set()
+            self.budget = None
+            if self.keepalive is not None:
+                self.keepalive = KeepaliveThread(self, self.keepalive_interval)
+                self.keepalive.start()
+            self.register_cfgreloader()
+        if warmup:
+            return self.warmup()
+        return {}
+
+    def check_fork(self):
+        '''Drop the state inherited from the parent in a forked process,
+        before it is used to commit, roll back or close connections'''
+
+        if self.pid != os.getpid():
+            self.after_fork()
+
+    def add_hook(self, hook, index=None):
+        """Register a Hook, appended to the chain unless `index` is given"""
+
+        if index is None:
+            self.hooks.append(hook)
+        else:
+            self.hooks.insert(index, hook)
+        self.compile_hooks()
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+        self.compile_hooks()
+
+    def compile_hooks(self):
+        """Compile enabled hooks into flat lists called by LuzCursor"""
+
+        hooks = [hook for hook in self.hooks if hook.enabled(self)]
+        self.before_hooks = tuple(h.before for h in hooks if h.before)
+        self.after_hooks = tuple(h.after for h in hooks if h.after)
+        self.error_hooks = tuple(h.error for h in hooks if h.error)
+        execute_call = LuzCursor._run.im_func
+        for hook in reversed(hooks):
+            if hook.wrap:
+                execute_call = hook.wrap(execute_call)
+        self.execute_call = execute_call
+
+    def get_farm_kwargs(self, farm_config, options):
+        '''Return the connection parameters of a farm besides its dbcnf.
+
+        `driver` (see DRIVERS), `driver_options`, `connect_options` (see
+        CONNECT_OPTIONS) and `conv` (see douban.sqlstore.conv) may be given
+        in the farm config, or in `options` for all farms.
+        '''
+
+        kwargs = dict(self._kwargs)
+        driver = farm_config.get('driver', options.get('driver'))
+        if driver:
+            kwargs['driver'] = driver
+        connect_options = dict(options.get('connect_options', {}))
+        connect_options.update(farm_config.get('connect_options', {}))
+        kwargs.update(parse_connect_options(connect_options))
+        conv = farm_config.get('conv', options.get('conv'))
+        if conv:
+            # fail early on unknown profiles
+            get_decoders(conv, None)
+            kwargs['conv'] = conv
+        kwargs.update(options.get('driver_options', {}))
+        kwargs.update(farm_config.get('driver_options', {}))
+        return kwargs
 
     def receive_conf(self, data, version=None, mtime=None):
         ''' callback function for cfgmanager to receive lastest sqlstore config
@@ -608,9 +1953,89 @@ class SqlStore(object):
             return (False, msg)
 
     def close(self):
+        self.check_fork()
         for farm in self.farms.values():
             farm.close()
 
+    def maintain_connections(self):
+        """Keep the connections of farms alive, called by the keepalive
+        thread every `keepalive_interval` seconds.
+
+        A spare connection is opened ahead of time for each farm whose
+        connection expires within two intervals, or has been idle for more
+        than `keepalive_idle` seconds, so that get_cursor() switches to it
+        without connecting on the request path. The connection is not
+        switched while the store is in a transaction. Spare connections are
+        pinged to keep them from wait_timeout. Use the
+        `connection_expire_jitter` option to spread the expiration of
+        connections opened at the same time.
+        """
+
+        now = time.time()
+        for farm in self.farms.values():
+            try:
+                farm.maintain(now)
+            except Exception, exc:
+                buffered_slog('KEEPALIVE_FAIL %s %s' % (farm.name, exc))
+
+    def warmup(self, farms=None, parallel=True):
+        """Connect to `farms` (names, all farms by default) ahead of the first
+        query, concurrently if `parallel` is true, and validate the
+        connections with a ping. With `share_connections`, one farm of each
+        database is connected and the others share its connection.
+
+        Return {farm_name: connect seconds, or the exception raised}.
+        """
+
+        if farms is None:
+            farms = sorted(self.farms.values(), key=lambda f: f.name)
+        else:
+            farms = [self.get_farm(name) for name in farms]
+
+        def connect(farm):
+            start = time.time()
+            cursor = farm.get_cursor()
+            cursor.connection.ping()
+            return time.time() - start
+
+        def connect_all(farms):
+            if parallel:
+                return parallel_map(connect, farms)
+            results = []
+            for farm in farms:
+                try:
+                    results.append((connect(farm), None))
+                except Exception, exc:
+                    results.append((None, exc))
+            return results
+
+        if self.share_connections:
+            databases = collections.OrderedDict()
+            for farm in farms:
+                databases.setdefault(ConnectionRegistry.make_key(farm.dbcnf),
+                                     []).append(farm)
+            first = [group[0] for group in databases.values()]
+            results = dict(zip(first, connect_all(first)))
+            for group in databases.values():
+                for farm in group[1:]:
+                    if results[group[0]][1] is not None:
+                        results[farm] = results[group[0]]
+                    else:
+                        # shares the connection in the calling thread
+                        results[farm] = connect_all([farm])[0]
+            results = [results[farm] for farm in farms]
+        else:
+            results = connect_all(farms)
+
+        report = {}
+        for farm, (timecost, exc) in zip(farms, results):
+            if exc is not None:
+                buffered_slog('WARMUP_FAIL %s %s' % (farm.name, exc))
+                report[farm.name] = exc
+            else:
+                report[farm.name] = timecost
+        return report
+
     def get_farm(self, farm_name, no_default=False):
         farm = self.farms.get(farm_name)
 
@@ -632,38 +2057,77 @@ class SqlStore(object):
         else:
             return farm
 
+    def get_farm_by_shard_key(self, table, shard_key=None):
+        """Return the farm of table, if table is sharded, return the farm of
+        its shard of `shard_key`."""
+
+        shard = self.shards.get(table)
+        if shard is None:
+            return self.get_farm_by_table(table)
+        if shard_key is None:
+            raise ShardingError('shard key %s of sharded table %s is not '
+                                'given' % (shard.key, table))
+        return self.get_farm(shard.get_farm_name(shard_key))
+
+    def get_farms_by_sql(self, cmd, sql, tables, args=None):
+        """Return the farms a statement on tables should be executed on,
+        more than one farm if it touches several shards. Like execute(),
+        statements without sharded tables go to the farm of tables[0]."""
+
+        farms = set()
+        for table in tables:
+            shard = self.shards.get(table)
+            if shard is None:
+                continue
+            keys = shard.extract_keys(cmd, sql, args)
+            if keys is None:
+                farms.update(self.get_farm(name) for name in shard.farms)
+            else:
+                farms.update(self.get_farm(shard.get_farm_name(key))
+                             for key in keys)
+        return farms or set([self.get_farm_by_table(tables[0])])
+
     def _flush_get_cursor_log(self, cursor):
         if len(cursor.queries) > 1:
-            syslog.syslog('get_cursor: %s' % '|'.join(cursor.queries))
+            buffered_syslog('get_cursor: %s' % '|'.join(cursor.queries))
         cursor.queries = []
 
     def _flush_accessed_tables(self, cursor):
         cursor.tables = set()
 
     # TODO 修改所有调用ro参数的代码，删除已经废弃的ro参数
-    def get_cursor(self, ro=False, farm=None, table='*', tables=None):
+    def get_cursor(self, ro=False, farm=None, table='*', tables=None,
+                   shard_key=None, raw=False, conv=None, compress=None):
         """get a cursor according to table or tables.
 
         Note:
 
           * If `tables` is given, `table` is ignored.
           * If `farm` is given, `table` and `tables` are both ignored.
+          * `shard_key` is required for sharded tables.
+          * `conv` converts results with another profile than the one of
+            the farm, see douban.sqlstore.conv; `raw` is conv='raw'.
+          * `compress` switches protocol compression on or off for large
+            result sets, if it differs from the `compress` connect option
+            of the farm, the cursor is on another connection, which only
+            executes select, and can not be used in a transaction.
         """
 
         not_specifying_table = False
         if farm:
             farm = self.get_farm(farm)
         elif tables:
-            farms = set(self.get_farm_by_table(table) for table in tables)
+            farms = set(self.get_farm_by_shard_key(table, shard_key)
+                        for table in tables)
             if len(farms) > 1:
                 raise MySQLdb.DatabaseError('%s are not in the same farm' %
                                             tables)
             farm = farms.pop()
         else:
-            farm = self.get_farm_by_table(table)
+            farm = self.get_farm_by_shard_key(table, shard_key)
             if table == '*':
                 not_specifying_table = True
-        cursor = farm.get_cursor()
+        cursor = farm.get_cursor(compress=compress)
         self._flush_get_cursor_log(cursor)
         self._flush_accessed_tables(cursor)
         if not_specifying_table:
@@ -671,6 +2135,11 @@ class SqlStore(object):
                 traceback.extract_stack(limit=2)[0]
             _query = '%s|%d|%s' % (_file, _lineno, _line)
             cursor.queries.append(_query)
+        if raw:
+            conv = 'raw'
+        if conv is not None:
+            driver = get_driver(farm.dbcnf.get('driver'))
+            cursor = ConvCursor(cursor, get_decoders(conv, driver))
         return cursor
 
     def parse_execute_sql(self, sql):
@@ -682,7 +2151,8 @@ class SqlStore(object):
         if not match:
             raise Exception(sql)
 
-        tables = [t for t in find_tables(sql) if t in self.tables]
+        tables = [t for t in find_tables(sql)
+                  if t in self.tables or t in self.shards]
         table = match.group('table')
 
         if table in tables:
@@ -690,7 +2160,15 @@ class SqlStore(object):
 
         return cmd, [table] + list(tables)
 
-    def transaction_begin(self):
+    def transaction_begin(self, xa=None):
+        """Begin a transaction.
+
+        If `xa` is true (defaults to the `xa_transaction` option), the
+        transaction is run as a MySQL XA transaction: a branch is started on
+        every farm touched before commit, and commit() uses two-phase commit
+        so that writes in different farms are committed atomically.
+        """
+
         if self.in_transaction or self.modified_cursors:
             raise Exception('another transaction has not been finished: %s' %
                             ','.join(self.modified_tables))
@@ -698,27 +2176,204 @@ class SqlStore(object):
         self.modified_tables = set()
         self.modified_cursors = set()
         self.executed_queries = set()
+        if xa is None:
+            xa = self.xa_transaction
+        self.xa_gtrid = new_xa_gtrid() if xa else None
+        self.xa_cursors = set()
 
     def transaction_end(self):
         if self.in_transaction:
-            if len(self.modified_cursors) > 1:
+            if len(self.modified_cursors) > 1 and not self.xa_gtrid:
                 message = 'WRITE_TABLES_IN_DIFFERENT_FARM %s' % \
                     ','.join(self.modified_tables)
                 warn(message)
                 if self.logging:
-                    slog(message)
+                    buffered_slog(message)
             self.in_transaction = False
 
-    def execute(self, sql, args=None):
+    def xa_start(self, cursor):
+        '''Start the XA transaction branch of cursor\'s farm'''
+
+        for other in self.xa_cursors:
+            if other.connection is cursor.connection:
+                raise Exception('XA branches of farm %s and %s would share '
+                                'one connection, disable share_connections '
+                                'for XA transactions' %
+                                (other.farm.name, cursor.farm.name))
+        # XA START fails if the connection has an implicit transaction
+        # opened by previous reads
+        cursor.connection.rollback()
+        cursor.cursor.execute('XA START %s, %s',
+                              (self.xa_gtrid, cursor.farm.name))
+        self.xa_cursors.add(cursor)
+        self.modified_cursors.add(cursor)
+
+    def _xa_statement(self, statement, cursor, suffix=''):
+        try:
+            cursor.cursor.execute(statement + ' %s, %s' + suffix,
+                                  (self.xa_gtrid, cursor.farm.name))
+        except MySQLdb.OperationalError, exc:
+            if 2000 <= exc.args[0] < 3000:
+                cursor.farm.cursor = None
+            raise
+
+    def _xa_prepare(self, cursor):
+        self._xa_statement('XA END', cursor)
+        self._xa_statement('XA PREPARE', cursor)
+
+    def _xa_commit(self, cursor):
+        self._xa_statement('XA COMMIT', cursor)
+
+    def _xa_commit_one_phase(self, cursor):
+        self._xa_statement('XA END', cursor)
+        self._xa_statement('XA COMMIT', cursor, suffix=' ONE PHASE')
+
+    def _xa_rollback(self, cursor):
+        try:
+            self._xa_statement('XA END', cursor)
+        except MySQLdb.Error:
+            # already ended or prepared
+            pass
+        self._xa_statement('XA ROLLBACK', cursor)
+
+    def _xa_log_state(self, state):
+        '''Append the state of the XA transaction to the coordinator log'''
+
+        if not self.xa_log:
+            return
+        with open(self.xa_log, 'a') as f:
+            f.write('%s %s %.3f\n' % (self.xa_gtrid, state, time.time()))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _xa_finish(self, commit):
+        cursors = list(self.xa_cursors)
+        try:
+            if not commit:
+                results = parallel_map(self._xa_rollback, cursors)
+            elif len(cursors) == 1:
+                # no need to prepare a single branch
+                results = parallel_map(self._xa_commit_one_phase, cursors)
+            else:
+                self._xa_log_state('prepare')
+                results = parallel_map(self._xa_prepare, cursors)
+                if any(exc for _, exc in results):
+                    parallel_map(self._xa_rollback, cursors)
+                else:
+                    # all branches are prepared, the transaction must be
+                    # committed from now on
+                    self._xa_log_state('commit')
+                    results = parallel_map(self._xa_commit, cursors)
+            errors = [exc for _, exc in results if exc]
+            if errors:
+                raise errors[0]
+        finally:
+            self.xa_gtrid = None
+            self.xa_cursors.clear()
+            self.modified_cursors.clear()
+            self.modified_tables.clear()
+            self.executed_queries.clear()
+
+    def xa_recover(self, action=None, older_than=60, xa_log=None):
+        """List prepared XA transactions left in doubt by sqlstore, e.g.
+        when the process died between the prepare and commit phases.
+
+        Only transactions prepared more than `older_than` seconds ago are
+        returned, the prepare time is read from the coordinator log
+        `xa_log` (defaults to the `xa_log` option, appended by commit()),
+        or is the start time of transactions not in the log. Return
+        {farm_name: [(gtrid, bqual), ...]}.
+
+        If `action` is 'commit' or 'rollback', they are resolved
+        accordingly. Rolling back needs the coordinator log, and with the
+        log only transactions whose commit was decided (all branches
+        prepared) are committed, and only the others are rolled back.
+        """
+
+        if action not in (None, 'commit', 'rollback'):
+            raise ValueError(action)
+        xa_log = xa_log or self.xa_log
+        if action == 'rollback' and not xa_log:
+            raise Exception('rolling back XA transactions in doubt needs '
+                            'the coordinator log (xa_log)')
+        states = read_xa_log(xa_log) if xa_log else {}
+
+        deadline = time.time() - older_than
+        in_doubt = {}
+        seen = set()
+        for name, farm in sorted(self.farms.items()):
+            key = ConnectionRegistry.make_key(farm.dbcnf)
+            if key in seen:
+                continue
+            seen.add(key)
+
+            cursor = farm.get_cursor()
+            cursor.cursor.execute('XA RECOVER')
+            for _, gtrid_length, _, data in cursor.cursor.fetchall():
+                gtrid = data[:gtrid_length]
+                bqual = data[gtrid_length:]
+                start_time = parse_xa_gtrid(gtrid)
+                if start_time is None:
+                    continue
+                state = states.get(gtrid, {})
+                if state.get('prepare', start_time) > deadline:
+                    continue
+                in_doubt.setdefault(name, []).append((gtrid, bqual))
+                if xa_log and action and \
+                        ('commit' in state) != (action == 'commit'):
+                    continue
+                if action:
+                    cursor.cursor.execute('XA %s %%s, %%s' % action.upper(),
+                                          (gtrid, bqual))
+        return in_doubt
+
+    def execute(self, sql, args=None, scatter=False, safe=False,
+                compress=None):
+        """Execute sql on the farm of its tables.
+
+        `safe` marks a statement which can be executed again, see the
+        `retry_attempts` option; select statements are always safe.
+        `compress` switches protocol compression, see get_cursor().
+
+        Statements on sharded tables are routed by the values of the shard
+        key in sql and args. A statement touching several shards raises
+        ShardingError, unless `scatter` is true: then it is executed on each
+        of the farms, and the rows of a select, or the sum of affected rows,
+        are returned.
+        """
+
         cmd, tables = self.parse_execute_sql(sql)
+        if compress is not None and cmd != 'select':
+            raise Exception('compress only applies to select: %s' % sql)
         if self.logging and len(tables) > 1:
             message = 'MULTIPLE_TABLES_WITH_SINGLE_CURSOR %s %s' % \
                 (sql, ','.join(tables))
-            slog(message)
+            buffered_slog(message)
+
+        if not self.shards:
+            return self._execute(self.get_cursor(table=tables[0],
+                                                 compress=compress),
+                                 cmd, sql, args, tables, safe)
+
+        farms = self.get_farms_by_sql(cmd, sql, tables, args)
+        if len(farms) == 1:
+            return self._execute(self.get_cursor(farm=farms.pop().name,
+                                                 compress=compress),
+                                 cmd, sql, args, tables, safe)
+        if not scatter or cmd in ('insert', 'replace'):
+            raise ShardingError('%s touches multiple farms: %s' %
+                                (sql, ','.join(sorted(f.name for f in farms))))
+        results = [self._execute(self.get_cursor(farm=farm.name,
+                                                 compress=compress),
+                                 cmd, sql, args, tables, safe)
+                   for farm in sorted(farms, key=lambda f: f.name)]
+        if cmd == 'select':
+            return sum((tuple(rows) for rows in results), ())
+        return sum(results)
 
-        cursor = self.get_cursor(table=tables[0])
+    def _execute(self, cursor, cmd, sql, args, tables, safe=False):
         self._flush_get_cursor_log(cursor)
-        ret = cursor.execute(sql, args, called_from_store=True)
+        ret = cursor.execute(sql, args, called_from_store=True, safe=safe)
         if cmd == 'select':
             return cursor.fetchall()
         else:
@@ -729,8 +2384,221 @@ class SqlStore(object):
                 ret = cursor.lastrowid
             return ret
 
+    def scatter_select(self, sql, args=None, farms=None):
+        """Execute a select on several farms concurrently and merge the rows.
+
+        `farms` defaults to the shards of the sharded tables in sql, or the
+        farms listing the tables of sql in their `tables` (or routed to by
+        `tables_map`); ValueError is raised if there is none. Farms on the
+        same database are only queried once. Sorted results are merged
+        according to ORDER BY, LIMIT is pushed down to each farm, and
+        COUNT/SUM/MIN/MAX are combined, see ScatterQuery.
+        """
+
+        query = ScatterQuery(sql, args)
+        if farms is None:
+            cmd, tables = self.parse_execute_sql(sql)
+            if any(table in self.shards for table in tables):
+                farms = self.get_farms_by_sql(cmd, sql, tables, args)
+            else:
+                farms = set()
+                for table in tables:
+                    farms.update(self.table_farms.get(table, ()))
+                    if table in self.tables_map:
+                        farms.add(self.get_farm(self.tables_map[table]))
+                if not farms:
+                    raise ValueError('no farm lists tables %s, give the '
+                                     'farms to query: %s' %
+                                     (','.join(tables), sql))
+        else:
+            farms = [self.get_farm(name) for name in farms]
+        databases = {}
+        for farm in sorted(farms, key=lambda f: f.name):
+            databases.setdefault(ConnectionRegistry.make_key(farm.dbcnf),
+                                 farm)
+
+        farm_sql = query.farm_sql
+
+        def select(farm):
+            cursor = farm.get_cursor()
+            self._flush_get_cursor_log(cursor)
+            cursor.execute(farm_sql, query.args, called_from_store=True)
+            return cursor.description, cursor.fetchall()
+
+        results = parallel_map(select, sorted(databases.values(),
+                                              key=lambda f: f.name))
+        for _, exc in results:
+            if exc is not None:
+                raise exc
+        return query.merge([result for result, _ in results])
+
+    def query_columns(self, sql, args=None, dtypes=None, batch_size=10000,
+                      compress=None):
+        """Execute a select and return its result as typed column arrays,
+        see douban.sqlstore.columns:
+
+            columns = store.query_columns('select id, score from t',
+                                          dtypes={'score': 'float32'})
+            columns['score'], columns.masks['score']
+
+        Rows are streamed from the server with an unbuffered cursor and
+        converted `batch_size` rows at a time, so neither the rows nor the
+        tuples of MySQLdb are kept in memory. `compress` switches protocol
+        compression, see get_cursor().
+        """
+
+        cmd, tables = self.parse_execute_sql(sql)
+        if cmd != 'select':
+            raise ValueError('query_columns only executes select: %s' % sql)
+        if self.shards:
+            farms = self.get_farms_by_sql(cmd, sql, tables, args)
+            if len(farms) > 1:
+                raise ShardingError('%s touches multiple farms: %s' % (
+                    sql, ','.join(sorted(f.name for f in farms))))
+            cursor = self.get_cursor(farm=farms.pop().name,
+                                     compress=compress)
+        else:
+            cursor = self.get_cursor(table=tables[0], compress=compress)
+        self._flush_get_cursor_log(cursor)
+        with cursor.server_side():
+            cursor.execute(sql, args, called_from_store=True)
+            builder = ColumnBuilder(
+                cursor.description, dtypes,
+                flags=getattr(cursor, 'description_flags', None))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                builder.append(rows)
+        return builder.result()
+
+    def export_table(self, table, fileobj, format='tsv', where=None,
+                     args=None, columns=None, farm=None, batch_size=10000,
+                     progress=None, compress=None):
+        """Write the rows of table to fileobj in tsv or csv format, see
+        douban.sqlstore.bulk, and return the number of rows.
+
+        `where` (with `args`) restricts the rows, `columns` defaults to all
+        columns. Rows are streamed from the server with an unbuffered cursor
+        as raw bytes, and written `batch_size` rows at a time, after which
+        progress(rows, bytes) is called. `farm` is required for sharded
+        tables. `compress` switches protocol compression, see get_cursor().
+        """
+
+        check_format(format)
+        sql = 'select %s from `%s`' % (
+            ', '.join('`%s`' % c for c in columns) if columns else '*',
+            table)
+        if where:
+            sql += ' where %s' % where
+        if farm:
+            cursor = self.get_cursor(farm=farm, raw=True, compress=compress)
+        else:
+            cursor = self.get_cursor(table=table, raw=True,
+                                     compress=compress)
+        self._flush_get_cursor_log(cursor)
+        rows = nbytes = 0
+        with cursor.server_side():
+            cursor.execute(sql, args, called_from_store=True)
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                data = format_rows(batch, format)
+                fileobj.write(data)
+                rows += len(batch)
+                nbytes += len(data)
+                if progress:
+                    progress(rows, nbytes)
+        return rows
+
+    def load_file(self, table, path, columns=None, format='tsv',
+                  duplicate=None, chunk_size=None, progress=None, farm=None):
+        """Load a tsv or csv file into table with LOAD DATA LOCAL INFILE,
+        see douban.sqlstore.bulk, and return the number of rows loaded.
+
+        `columns` are the columns of the fields in the file, all columns of
+        table by default. `duplicate` ("replace" or "ignore") handles rows
+        with duplicate keys. A tsv file is loaded with one statement for
+        each `chunk_size` bytes if given, after each statement
+        progress(rows, bytes) is called. The rows are loaded in the current
+        transaction, call commit() afterwards. `farm` is required for
+        sharded tables, the file must only hold rows of its shard.
+        """
+
+        check_format(format)
+        if farm:
+            farm = self.get_farm(farm)
+        elif table in self.shards:
+            raise ShardingError('farm of sharded table %s is not given' %
+                                table)
+        else:
+            farm = self.get_farm_by_table(table)
+        if chunk_size and format != 'tsv':
+            raise ValueError('only tsv files can be loaded in chunks')
+        sql = load_statement(table, format, columns, duplicate)
+        if chunk_size:
+            chunks = split_file(path, chunk_size)
+        else:
+            chunks = [(path, os.path.getsize(path))]
+        cursor = farm.get_cursor()
+        self._flush_get_cursor_log(cursor)
+        rows = nbytes = 0
+        for chunk_path, size in chunks:
+            rows += cursor.execute(sql, chunk_path, called_from_store=True)
+            nbytes += size
+            self.modified_tables.add(table)
+            if progress:
+                progress(rows, nbytes)
+        self.executed_queries.add(sql)
+        return rows
+
+    @property
+    def budget(self):
+        return getattr(self._budget, 'budget', None)
+
+    @budget.setter
+    def budget(self, budget):
+        self._budget.budget = budget
+
+    @contextmanager
+    def query_budget(self, name=None, **limits):
+        """Account statements executed in the block, e.g. per web request:
+
+            with store.query_budget('/people/', hard_statements=500) as b:
+                ...
+            summary = b.summary()
+
+        `limits` (soft_statements, hard_statements, soft_time, hard_time,
+        repeat_threshold, sentry_sample_rate) default to the `query_budget`
+        option. See QueryBudget.
+        """
+
+        kwargs = dict(self.query_budget_options, **limits)
+        budget = QueryBudget(self, name, **kwargs)
+        previous, self.budget = self.budget, budget
+        try:
+            yield budget
+        finally:
+            self.budget = previous
+
+    def pipeline(self):
+        """Return a Pipeline which sends statements on the same farm to MySQL
+        with one round trip, e.g.:
+
+            with store.pipeline() as p:
+                r1 = p.execute('select * from a where id=%s', 1)
+                r2 = p.execute('update b set x=1 where id=%s', 2)
+            rows, rowcount = r1.value, r2.value
+        """
+
+        return Pipeline(self)
+
     def commit(self):
+        self.check_fork()
         self.transaction_end()
+        if self.xa_gtrid:
+            return self._xa_finish(commit=True)
         first_error = None
         try:
             for cursor in self.modified_cursors:
@@ -747,7 +2615,7 @@ class SqlStore(object):
                 sqls = '\n'.join(self.executed_queries)
                 message = 'MULTIPLE_TABLES_IN_TRANSACTION %s %s' % \
                     (sqls, ','.join(self.modified_tables))
-                slog(message)
+                buffered_slog(message)
         finally:
             self.modified_cursors.clear()
             self.modified_tables.clear()
@@ -756,7 +2624,10 @@ class SqlStore(object):
                 raise first_error
 
     def rollback(self):
+        self.check_fork()
         self.transaction_end()
+        if self.xa_gtrid:
+            return self._xa_finish(commit=False)
         first_error = None
         try:
             for cursor in self.modified_cursors:
@@ -773,7 +2644,7 @@ class SqlStore(object):
                 sqls = '\n'.join(self.executed_queries)
                 message = 'MULTIPLE_TABLES_IN_TRANSACTION %s %s' % \
                     (sqls, ','.join(self.modified_tables))
-                slog(message)
+                buffered_slog(message)
         finally:
             self.modified_cursors.clear()
             self.modified_tables.clear()
@@ -781,7 +2652,21 @@ class SqlStore(object):
             if first_error:
                 raise first_error
 
+    def is_dirty(self):
+        self.check_fork()
+        return bool(self.modified_cursors or self.modified_tables or
+                    self.executed_queries or self.xa_gtrid)
+
     def rollback_all(self, force=False):
+        self.check_fork()
+        if not force and not self.is_dirty():
+            return
+        if self.xa_gtrid:
+            self.in_transaction = False
+            try:
+                self._xa_finish(commit=False)
+            except Exception:
+                pass
         try:
             if force:
                 for farm in self.farms.values():
@@ -814,6 +2699,25 @@ class SqlStore(object):
         for farm in self.farms.values():
             farm.stop_log()
 
+    def start_capture(self, path_or_file):
+        """Capture executed statements of all farms to a capture file, which
+        can be replayed by sqlstore-replay. Return the CaptureWriter.
+        """
+
+        writer = CaptureWriter(path_or_file)
+        for farm in self.farms.values():
+            farm.start_capture(writer)
+        return writer
+
+    def stop_capture(self):
+        writers = set()
+        for farm in self.farms.values():
+            if farm.capture_writer:
+                writers.add(farm.capture_writer)
+            farm.stop_capture()
+        for writer in writers:
+            writer.close()
+
     # TODO 检查所有使用detail参数的代码，删除已经废弃的detail参数
     def get_log(self, detail=False, log_format='text', with_traceback=False):
         """Return SQL logs in two formats: text or dict
@@ -858,45 +2762,50 @@ class SqlStore(object):
                 cursor.connection.commit()
 
     def send_exception_to_onimaru(self, exception=None, source=None):
-        if not getattr(self, 'raven_client', None):
+        client = getattr(self, 'raven_client', None)
+        if not client:
             return
 
         try:
-            frames = get_stack_info(iter_stack_frames())
-            frames = list(reversed(frames))[:-2]
-            data = {
-                'sentry.interfaces.Stacktrace': {
-                    'frames': frames
-                }
-            }
             _extra = {
                 'source': CMDLINE,
                 'user': USER,
                 'host': host,
                 'start_time': start_time,
+                'store': str(self),
+                'db_config_name': self.db_config_name,
             }
-            if source:
-                if isinstance(source, LuzCursor):
-                    _extra['cursor'] = source.__dict__
-                    _extra['farm'] = source.farm.__dict__
-                    _extra['store'] = source.farm.store.__dict__
-                elif isinstance(source, SqlFarm):
-                    _extra['farm'] = source.__dict__
-                    _extra['store'] = source.store.__dict__
-                elif isinstance(source, SqlStore):
-                    _extra['store'] = source.__dict__
+            farm = None
+            if isinstance(source, (LuzCursor, LogCursor)):
+                _extra['cursor'] = str(source)
+                farm = source.farm
+            elif isinstance(source, SqlFarm):
+                farm = source
+            if farm is not None:
+                dbcnf = dict(farm.dbcnf)
+                dbcnf.pop('passwd', None)
+                _extra['farm'] = str(farm)
+                _extra['dbcnf'] = dbcnf
             if exception:
                 message = '%s: %s' % (exception.__class__.__name__,
                                       str(exception))
             else:
                 message = 'sqlstore'
-            self.raven_client.captureMessage(message, data=data, extra=_extra)
+            key = (exception.__class__.__name__ if exception else None,
+                   farm.name if farm is not None else None)
+            sentry_reporter.report(client, key, message, get_raw_frames(),
+                                   _extra, self.sentry_report_interval)
         except Exception, exc:
-            slog('SEND_TO_SENTRY_FAIL: %s' % exc)
+            buffered_slog('SEND_TO_SENTRY_FAIL: %s' % exc)
 
 
 class LuzCursor():
 
+    # the cursor on the new connection after a retry, see _retry()
+    replaced_by = None
+    # decoders of the statement being executed via ConvCursor
+    decoders = None
+
     def __init__(self, cursor, farm):
         self.cursor = cursor
         self.farm = farm
@@ -934,166 +2843,429 @@ class LuzCursor():
     __repr__ = __str__
 
     def __getattr__(self, name):
-        return getattr(self.cursor, name)
+        return getattr(self.replaced_by or self.cursor, name)
 
     def execute(self, sql, args=None, **kwargs):
-        query_start = time.time()
-        sql = sql.strip(self.garbage_chars)
-        cmd = sql.split(' ', 1)[0].lower()
-        host = self.farm.dbcnf['host']
+        if self.replaced_by is not None:
+            return self.replaced_by.execute(sql, args, **kwargs)
+        return self.farm.store.execute_call(self, sql, args, **kwargs)
+
+    def _run(self, sql, args=None, **kwargs):
+        '''Execute a statement through the hooks of the store, see Hook'''
+
+        store = self.farm.store
+        ctx = ExecuteContext(self, sql.strip(self.garbage_chars), args,
+                             kwargs.pop('called_from_store', False))
+        self.farm.last_used = ctx.start
+        ctx.retry_attempts = self._get_retry_attempts(
+            ctx.cmd, ctx.statement, kwargs.pop('safe', False))
+        budget = store.budget
+        if budget is not None:
+            budget.check()
         try:
-            key = 'sqlstore.{host}.{cmd}'.format(host=host, cmd=cmd)
-            return self._execute(cmd, sql, args, **kwargs)
+            self._prepare(ctx)
+            result = self._execute(ctx)
+            for after in store.after_hooks:
+                after(ctx, result)
+            return result
         except Exception:
-            exc_class, exception, tb = sys.exc_info()
-            try:
-                error_code = getattr(exception, 'args', [0])[0]
-            except IndexError:
-                # exc may be self-defined exceptions like
-                # QueryDisabledException which does not have meaningful
-                # error code
-                error_code = 0
-            key = 'sqlstore.{host}.{cmd}.{error_code}'
-            key = key.format(host=host, cmd=cmd, error_code=error_code)
-            raise exc_class, exception, tb
+            exc_class, exc, tb = sys.exc_info()
+            self._run_error_hooks(ctx, exc)
+            raise exc_class, exc, tb
         finally:
-            if self.farm.store.statsd:
-                try:
-                    sample_rate = self.farm.store.statsd_sample_rate
-                    self.farm.store.statsd.timing_since(key,
-                                                        query_start,
-                                                        sample_rate)
-                except Exception:
-                    pass
-
-    def _execute(self, cmd, sql, args=None, **kwargs):
-        self.latest_ten_queries.append((time.time(), sql, args))
-        called_from_store = kwargs.pop('called_from_store', False)
-
-        if cmd != 'select':
-            self.farm.store.modified_cursors.add(self)
-
-        # Check if there are full parameterized queries to be blocked
-        if self.farm.store.disabled_queries_with_args:
-            if args:
-                _sql = sql % self.cursor.connection.literal(args)
-            else:
-                _sql = sql
-            fingerprint = md5(_sql).hexdigest()
-            expire_time = \
-                self.farm.store.disabled_queries_with_args.get(fingerprint)
-            if expire_time:
-                if expire_time > time.time():
-                    raise QueryDisabledException(_sql, expire_time)
-                else:
-                    self.farm.store.disabled_queries_with_args.pop(fingerprint,
-                                                                   None)
-
-        # Check if there are non-parameterized quereis to be blocked
-        fingerprint = md5(sql).hexdigest()
-        if self.farm.store.disabled_queries:
-            expire_time = self.farm.store.disabled_queries.get(fingerprint)
-            if expire_time:
-                if expire_time > time.time():
-                    raise QueryDisabledException(sql, expire_time)
-                else:
-                    self.farm.store.disabled_queries.pop(fingerprint, None)
-
-        if args is None and '%' in sql:
-            message = 'POSSIBLE_MISTAKENLY_ESCAPED_SQL %s' % sql
-            slog(message)
+            if budget is not None:
+                budget.record(ctx.statement, args, time.time() - ctx.start)
 
-        source = os.environ.get('SQLSTORE_SOURCE') or CMDLINE
-        source = source.replace('%', '%%')
-        sql = sql + ' -- SRC:' + source + ' MD5:' + fingerprint + ' USER:' + \
-            USER + ' CLIENT:' + self.client_info
-
-        try:
-            if self.farm.store.logging and not called_from_store:
-                pre_table_cnt = len(self.tables)
-                _tables = [t for t in find_tables(sql) if t in
-                           self.farm.store.tables]
-                self.tables.update(_tables)
-                if len(self.tables) > 1 and pre_table_cnt != len(self.tables):
-                    message = 'MULTIPLE_TABLES_WITH_SINGLE_CURSOR %s %s' % \
-                        (sql, ','.join(self.tables))
-                    slog(message)
-
-                if self.queries:
-                    self.queries.append(sql)
-
-            norm = sql.lower()
-            if not self.delete_without_where and norm.startswith('delete ') \
-                    and 'where' not in norm:
-                raise Exception('delete without where is forbidden')
-            if not self.delete_without_where and norm.startswith('update ') \
-                    and 'where' not in norm:
-                raise Exception('update without where is forbidden')
-
-            chosen_by_god = random.random() < \
-                self.farm.store.treat_warning_as_error_sampling_rate
-
-            if not self.farm.store.show_warnings and \
-                    not self.farm.store.treat_warning_as_error and \
-                    not chosen_by_god:
-                return self.cursor.execute(sql, () if args is None else args)
-
-            with catch_warnings(record=True) as w:
-                ret = self.cursor.execute(sql, () if args is None else args)
-                if w:
-                    if self.farm.store.treat_warning_as_error or chosen_by_god:
-                        self.cursor.connection.rollback()
-                        exc = InvalidMySQLDataException(w[0].message,
-                                                        sql,
-                                                        args)
-                        self.farm.store.send_exception_to_onimaru(exc, self)
-                        raise exc
-
-                    print >> sys.stderr, '=== MySQL warnings start ==='
-                    for _w in w:
-                        print >> sys.stderr, formatwarning(_w.message,
-                                                           _w.category,
-                                                           _w.filename,
-                                                           _w.lineno,
-                                                           _w.line)
-
-                    print >> sys.stderr, '-' * 40
-                    print >> sys.stderr, 'SQL:', sql
-                    print >> sys.stderr, 'args:', args
-
-                    print >> sys.stderr, '-' * 40
-                    print >> sys.stderr, ''.join(traceback.format_stack())
-                    print >> sys.stderr, '=== MySQL warnings end ===\n'
-                return ret
-        except MySQLdb.OperationalError, exc:
-            self.farm.store.send_exception_to_onimaru(exc, self)
+    def _run_error_hooks(self, ctx, exc):
+        '''Run the error hooks of the store, a failing hook is logged and
+        does not replace exc'''
 
+        for error in self.farm.store.error_hooks:
+            try:
+                error(ctx, exc)
+            except Exception, hook_exc:
+                hook = getattr(error, 'im_self', error)
+                buffered_slog('ERROR_HOOK_FAIL %s %s %s' % (
+                    hook.__class__.__name__, ctx.fingerprint, hook_exc))
+
+    def _get_retry_attempts(self, cmd, sql, safe):
+        '''Return how many times a statement may be executed again on a new
+        connection, only safe statements outside transactions are retried.
+        Locking reads are not safe, their locks would be taken on another
+        connection than the previous statements.'''
+
+        store = self.farm.store
+        if store.retry_attempts and \
+                (safe or cmd == 'select' and not re_locking_read.search(sql)) \
+                and not store.in_transaction and not store.xa_gtrid and \
+                self not in store.modified_cursors:
+            return store.retry_attempts
+        return 0
+
+    def _prepare(self, ctx):
+        '''Check a statement and run the before hooks of the store, which
+        may change ctx.sql sent to MySQL'''
+
+        store = self.farm.store
+        if self.farm.select_only and ctx.cmd != 'select':
+            raise Exception('%s is forbidden with compression switched' %
+                            ctx.cmd)
+        self.latest_ten_queries.append((ctx.start, ctx.statement, ctx.args))
+
+        if ctx.cmd != 'select':
+            store.modified_cursors.add(self)
+
+        if store.xa_gtrid and self not in store.xa_cursors:
+            store.xa_start(self)
+
+        if not self.delete_without_where and ctx.cmd in ('delete', 'update'):
+            if 'where' not in ctx.statement.lower():
+                raise Exception('%s without where is forbidden' % ctx.cmd)
+
+        if ctx.args is None and '%' in ctx.statement:
+            message = 'POSSIBLE_MISTAKENLY_ESCAPED_SQL %s' % ctx.statement
+            buffered_slog(message)
+
+        for before in store.before_hooks:
+            before(ctx)
+
+        if store.logging and not ctx.called_from_store:
+            pre_table_cnt = len(self.tables)
+            _tables = [t for t in find_tables(ctx.sql) if t in store.tables]
+            self.tables.update(_tables)
+            if len(self.tables) > 1 and pre_table_cnt != len(self.tables):
+                message = 'MULTIPLE_TABLES_WITH_SINGLE_CURSOR %s %s' % \
+                    (ctx.sql, ','.join(self.tables))
+                buffered_slog(message)
+
+            if self.queries:
+                self.queries.append(ctx.sql)
+
+    def _handle_error(self):
+        '''Handle the MySQL error being raised, always reraise it'''
+
+        exc_class, exc, tb = sys.exc_info()
+        self.farm.store.send_exception_to_onimaru(exc, self)
+
+        if isinstance(exc, MySQLdb.OperationalError):
             if 2000 <= exc.args[0] < 3000:
                 self.farm.cursor = None
             # Only DBA needs to keep an eye on server gone away error
             if exc.args[0] == SERVER_GONE_ERROR:
                 raise PleaseIgnoreThisMySQLException(*exc.args)
-            else:
-                raise
-        except MySQLdb.ProgrammingError, exc:
-            exc_class, exception, tb = sys.exc_info()
-            self.farm.store.send_exception_to_onimaru(exc, self)
-
+        elif isinstance(exc, MySQLdb.ProgrammingError):
             # 从 Commands out of sync 错误中自动恢复
             if exc.args[0] == COMMANDS_OUT_OF_SYNC:
                 self.farm.cursor = None
                 try:
                     for query in self.latest_ten_queries:
                         message = '%r COMMANDS_OUT_OF_SYNC %r' % (self, query)
-                        slog(message)
+                        buffered_slog(message)
                 except Exception:
                     pass
 
-            raise exc_class, exception, tb
+        raise exc_class, exc, tb
+
+    def _get_warnings(self):
+        '''Return [(level, code, message), ...] of the last statement.
+
+        The warning count sent by the server is checked first, so nothing
+        is sent to MySQL unless the statement did produce warnings.
+        '''
+
+        count = getattr(self.cursor, '_warnings', None)
+        if count is None:
+            count = self.cursor.connection.warning_count()
+        if not count:
+            return []
+
+        # MySQLdb fetches the warnings itself into cursor.messages
+        warnings = [m[1] for m in getattr(self.cursor, 'messages', [])
+                    if issubclass(m[0], MySQLdb.Warning) and
+                    isinstance(m[1], tuple)]
+        if not warnings:
+            cursor = self.cursor.connection.cursor()
+            try:
+                cursor.execute('show warnings')
+                warnings = list(cursor.fetchall())
+            finally:
+                cursor.close()
+        return warnings
+
+    def _retry(self, attempt, exc, fingerprint):
+        '''Wait with exponential backoff, then reconnect to the farm. Return
+        the LuzCursor of the new connection, None if connecting failed'''
+
+        store = self.farm.store
+        with _retries_lock:
+            store.retries += 1
+        buffered_slog('MYSQL_RETRY %s %s %s' % (self.farm.name, fingerprint,
+                                                exc.args[0]))
+        if store.statsd:
+            try:
+                store.statsd.incr('sqlstore.%s.retry' % self.farm.host,
+                                  store.statsd_sample_rate)
+            except Exception:
+                pass
+
+        delay = min(store.retry_backoff * 2 ** (attempt - 1),
+                    store.retry_backoff_max)
+        time.sleep(delay * random.uniform(0.5, 1))
+        self.farm.cursor = None
+        try:
+            cursor = self.farm.get_cursor()
+        except MySQLdb.OperationalError:
+            # the next attempt fails on the broken connection again
+            return None
+        while not isinstance(cursor, LuzCursor):
+            cursor = cursor.cursor
+        return cursor
+
+    def _execute(self, ctx):
+        cursor = self
+        attempt = 0
+        while True:
+            try:
+                result = cursor._cursor_execute(
+                    ctx.sql, () if ctx.args is None else ctx.args,
+                    self.decoders)
+                if cursor is not self:
+                    # the result and later statements are on the new
+                    # connection
+                    self.replaced_by = cursor
+                return result
+            except (MySQLdb.OperationalError, MySQLdb.ProgrammingError), exc:
+                if attempt < ctx.retry_attempts and \
+                        isinstance(exc, MySQLdb.OperationalError) and \
+                        exc.args[0] in (SERVER_GONE_ERROR, SERVER_LOST):
+                    attempt += 1
+                    cursor = self._retry(attempt, exc, ctx.fingerprint) or \
+                        cursor
+                    continue
+                self._handle_error()
+
+    def _cursor_execute(self, sql, args, decoders=None):
+        '''Execute on the MySQLdb cursor, converting the result with
+        decoders instead of the converters of the connection if given'''
+
+        if decoders is None:
+            return self.cursor.execute(sql, args)
+        connection = self.cursor.connection
+        converter = connection.converter
+        connection.converter = decoders
+        try:
+            return self.cursor.execute(sql, args)
+        finally:
+            connection.converter = converter
+
+    @contextmanager
+    def server_side(self):
+        '''Execute statements in the block on an unbuffered cursor, the
+        connection can not be used by others until all rows are fetched'''
+
+        buffered = self.cursor
+        driver = self.farm.dbcnf.get('driver')
+        unbuffered = buffered.connection.cursor(
+            get_server_side_cursorclass(driver))
+        self.cursor = unbuffered
+        try:
+            yield self
+        finally:
+            try:
+                # discard the rows not fetched
+                unbuffered.close()
+            finally:
+                if self.cursor is unbuffered:
+                    self.cursor = buffered
+
+    def _fetch_result(self):
+        return self.cursor.fetchall(), self.cursor.rowcount, \
+            self.cursor.lastrowid
+
+    def execute_multi(self, statements, **kwargs):
+        """Execute statements [(sql, args), ...] and return their results
+        [(rows, rowcount, lastrowid), ...].
+
+        If the connection is opened with the `multi_statements` option, all
+        statements are sent to MySQL in one packet, otherwise they are
+        executed one by one. Statements are checked and annotated the same
+        way as execute(), and the hooks of the store are run for each.
+
+        MySQL stops at the first failing statement. The exception raised
+        has the results of the statements executed before it in its
+        `sqlstore_results` attribute.
+        """
+
+        if self.replaced_by is not None:
+            return self.replaced_by.execute_multi(statements, **kwargs)
+        conn = self.cursor.connection
+        results = []
+        if len(statements) < 2 or \
+                not getattr(conn, 'sqlstore_multi_statements', False):
+            try:
+                for sql, args in statements:
+                    self.execute(sql, args, **kwargs)
+                    # after a retry the result is on the new cursor
+                    results.append((self.replaced_by or self)._fetch_result())
+            except Exception, exc:
+                exc.sqlstore_results = results
+                raise
+            return results
+
+        store = self.farm.store
+        called_from_store = kwargs.pop('called_from_store', False)
+        self.farm.last_used = time.time()
+        ctxs = []
+        queries = []
+        try:
+            for sql, args in statements:
+                ctx = ExecuteContext(self, sql.strip(self.garbage_chars),
+                                     args, called_from_store)
+                ctxs.append(ctx)
+                self._prepare(ctx)
+                sql = ctx.sql
+                if isinstance(sql, unicode):
+                    sql = sql.encode(conn.character_set_name())
+                queries.append(sql % conn.literal(() if args is None
+                                                  else args))
+        except Exception, exc:
+            self._run_error_hooks(ctxs[-1], exc)
+            exc.sqlstore_results = results
+            raise
+
+        budget = store.budget
+        if budget is not None:
+            budget.check()
+        start = time.time()
+        exc_info = None
+        done = 0
+        try:
+            try:
+                # annotations are "--" comments, statements must be
+                # separated by new lines
+                self.cursor.execute(';\n'.join(queries), None)
+                results.append(self._fetch_result())
+                while self.cursor.nextset():
+                    results.append(self._fetch_result())
+            except (MySQLdb.OperationalError, MySQLdb.ProgrammingError):
+                try:
+                    self._handle_error()
+                except Exception:
+                    exc_info = sys.exc_info()
+            try:
+                for ctx, result in zip(ctxs, results):
+                    for after in store.after_hooks:
+                        after(ctx, result[1])
+                    done += 1
+            except Exception:
+                exc_info = sys.exc_info()
+            if exc_info is None:
+                return results
+            exc_class, exc, tb = exc_info
+            self._run_error_hooks(ctxs[done], exc)
+            exc.sqlstore_results = results[:done]
+            raise exc_class, exc, tb
+        finally:
+            if budget is not None:
+                timecost = (time.time() - start) / len(statements)
+                for sql, args in statements:
+                    budget.record(sql.strip(self.garbage_chars), args,
+                                  timecost)
+
+
+class PipelineResult(object):
+
+    '''Result of a statement executed in Pipeline'''
+
+    def __init__(self, cmd, sql, args):
+        self.cmd = cmd
+        self.sql = sql
+        self.args = args
+        self.done = False
+        self.error = None
+        self._value = None
+
+    def set(self, rows, rowcount, lastrowid):
+        if self.cmd == 'select':
+            self._value = rows
+        elif self.cmd == 'insert' and lastrowid:
+            self._value = lastrowid
+        else:
+            self._value = rowcount
+        self.done = True
+
+    @property
+    def value(self):
+        '''Same as the return value of SqlStore.execute()'''
+
+        if self.error is not None:
+            raise self.error
+        if not self.done:
+            raise Exception('pipeline is not executed yet: %s' % self.sql)
+        return self._value
+
+
+class Pipeline(object):
+
+    '''Statements collected per farm and executed by LuzCursor.execute_multi
+    '''
+
+    def __init__(self, store):
+        self.store = store
+        self.statements = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+    def __len__(self):
+        return sum(len(v) for v in self.statements.values())
 
+    def execute(self, sql, args=None):
+        cmd, tables = self.store.parse_execute_sql(sql)
+        if self.store.shards:
+            farms = self.store.get_farms_by_sql(cmd, sql, tables, args)
+            if len(farms) > 1:
+                raise ShardingError('%s touches multiple farms' % sql)
+            farm = farms.pop()
+        else:
+            farm = self.store.get_farm_by_table(tables[0])
+        result = PipelineResult(cmd, sql, args)
+        self.statements.setdefault(farm, []).append((tables, result))
+        return result
+
+    def flush(self):
+        '''Execute collected statements, raise the first error if any'''
+
+        statements, self.statements = \
+            self.statements, collections.OrderedDict()
+        first_error = None
+        for farm, items in statements.items():
+            cursor = farm.get_cursor()
+            self.store._flush_get_cursor_log(cursor)
+            try:
+                results = cursor.execute_multi(
+                    [(r.sql, r.args) for _, r in items],
+                    called_from_store=True)
+            except Exception, exc:
+                first_error = first_error or exc
+                # only the statements from the failing one on failed
+                results = getattr(exc, 'sqlstore_results', [])
+                for _, result in items[len(results):]:
+                    result.error = exc
+
+            for (tables, result), _result in zip(items, results):
+                result.set(*_result)
+                if result.cmd != 'select':
+                    self.store.modified_cursors.add(cursor)
+                    self.store.modified_tables.update(tables)
+                    self.store.executed_queries.add(result.sql)
 
-if execute_waylifer:
-    LuzCursor.execute = execute_waylifer(LuzCursor.execute)
+        if first_error is not None:
+            raise first_error
 
 
 def replace_sqlstore_config(old, new):
@@ -1123,24 +3295,137 @@ def check_override(db_config_name):
     return _configs.get(db_config_name, db_config_name)
 
 
-_stores = {}
+STORE_CACHE_SIZE = 64
+
+
+class StoreCache(object):
+
+    '''LRU cache of SqlStore objects created by store_from_config,
+    on_evict(value) is called for values evicted'''
+
+    def __init__(self, maxsize=STORE_CACHE_SIZE, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.lock = threading.Lock()
+        self.data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.data.pop(key, None)
+            if value is None:
+                return default
+            self.data[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        evicted = []
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                evicted.append(self.data.popitem(last=False)[1])
+        if self.on_evict is not None:
+            for value in evicted:
+                self.on_evict(value)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def values(self):
+        with self.lock:
+            return self.data.values()
+
+
+def close_evicted_store(store):
+    '''Release the connections of a store evicted from the cache, unless it
+    is in a transaction. It still reconnects if used again.'''
+
+    try:
+        if store.is_dirty():
+            return
+        if store.keepalive is not None:
+            store.keepalive.stop()
+            store.keepalive = None
+        store.close()
+    except Exception, exc:
+        buffered_slog('CLOSE_EVICTED_STORE_FAIL %s %s' % (store, exc))
+
+
+_stores = StoreCache(on_evict=close_evicted_store)
+
+# id(config) -> (config, version, digest), keeps a reference to config so
+# that its id can not be reused while the entry is alive
+_config_keys = StoreCache()
+
+
+def config_digest(config):
+    '''Return the md5 digest of the content of a dict config'''
+
+    return md5(repr(canonical_config(config))).hexdigest()
+
+
+def canonical_config(obj):
+    if isinstance(obj, dict):
+        return sorted((repr(k), canonical_config(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [canonical_config(v) for v in obj]
+    if isinstance(obj, (set, frozenset)):
+        return sorted(canonical_config(v) for v in obj)
+    return obj
+
+
+def get_cache_key(config, kwargs):
+    '''Return the _stores key of (config, kwargs), None if not cachable.
+
+    Config names are interned so that lookups compare by identity. Dict
+    configs are keyed by the digest of their content, so equal dicts share
+    a store. The digest is computed once per dict object and kept while its
+    `version` item is unchanged, a dict mutated in place must change its
+    `version` (or be passed as a new dict) to get another store.
+    '''
+
+    if isinstance(config, basestring):
+        key = intern(config) if isinstance(config, str) else config
+    elif isinstance(config, dict):
+        version = config.get('version')
+        entry = _config_keys.get(id(config))
+        if entry is None or entry[0] is not config or entry[1] != version:
+            entry = (config, version, config_digest(config))
+            _config_keys[id(config)] = entry
+        key = entry[2]
+    else:
+        # unexpected config format, do not cache
+        return None
+
+    if kwargs:
+        key = (key, hashdict(kwargs))
+    if not isinstance(key, collections.Hashable):
+        return None
+    return key
 
 
 def store_from_config(config, use_cache=True, created_via='UNKNOWN_APP',
-                      **kwargs):
+                      warmup=False, **kwargs):
     if not SqlStore.is_safe(created_via):
         warn('SqlStore should be created via DAE API in async mode '
              '(created via: %s' % created_via)
-    if isinstance(config, basestring):
-        config = check_override(config)
-    if isinstance(config, (dict, basestring)):
-        cache_key = hashdict([config, kwargs])
-    else:
-        # unexpected config format, make it unhashable, do not cache
-        cache_key = {}
-
-    cachable = use_cache and isinstance(cache_key, collections.Hashable)
-    store = _stores.get(cache_key) if cachable else None
+    # the override is applied by SqlStore, stores of a name and of the name
+    # it is overridden by are cached together
+    key_config = check_override(config) \
+        if isinstance(config, basestring) else config
+    cache_key = get_cache_key(key_config, kwargs) if use_cache else None
+    store = _stores.get(cache_key) if cache_key is not None else None
     if store is None:
         db_config_name = None
         db_config = None
@@ -1150,11 +3435,23 @@ def store_from_config(config, use_cache=True, created_via='UNKNOWN_APP',
             db_config = config
         store = SqlStore(db_config=db_config, db_config_name=db_config_name,
                          created_via=created_via, **kwargs)
-        if cachable:
+        if cache_key is not None:
             _stores[cache_key] = store
+        if warmup:
+            store.warmup()
     store.rollback_all()
     return store
 
 
+def unpickle_store(config, created_via, kwargs):
+    '''Recreate a pickled SqlStore.
+
+    Stores unpickled in the same process with the same config share one
+    SqlStore object, so that the config is parsed only once per process.
+    '''
+
+    return store_from_config(config, created_via=created_via, **kwargs)
+
+
 
 # vim: set et ts=4 sw=4 :
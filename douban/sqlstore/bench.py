@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''sqlstore-bench: benchmark scenarios and load generator for sqlstore
+
+Run scenarios against a sqlstore config and report throughput and latency
+percentiles as JSON, with the first error of a scenario if any:
+
+    sqlstore-bench -c shire-online -t user -T user,user_profile \\
+        --ids 1-100000 -n 10000 -j 8 point_select routed_execute
+
+With --fake a builtin config on the in-process fake driver is used, so
+that only the client side cost of sqlstore is measured. Scenarios
+executing writes roll back or update rows to the same value, but should
+still only be run against testing databases.
+
+The wide_select scenarios need the bench_wide table of the fake config and
+only run by default with --fake.
+'''
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+from douban.sqlstore import store_from_config
+from douban.sqlstore import fakedb
+
+FAKE_CONFIG = {
+    'farms': {
+        'bench1_farm': {
+            'master': 'fake1:3306:bench1:bench:bench',
+            'tables': ['bench_table1', '*'],
+        },
+        'bench2_farm': {
+            'master': 'fake2:3306:bench2:bench:bench',
+            'tables': ['bench_table2'],
+        },
+    },
+    'options': {
+        'driver': 'fake',
+    },
+}
+FAKE_TABLES = {
+    'bench_table1': ('fake1', 'bench1'),
+    'bench_table2': ('fake2', 'bench2'),
+}
+FAKE_ROWS = 1000
+# bench_wide: id, 6 integer, 6 real and 7 varchar columns
+FAKE_WIDE_COLUMNS = ['id integer primary key'] + \
+    ['i%d integer' % i for i in range(1, 7)] + \
+    ['f%d real' % i for i in range(1, 7)] + \
+    ['s%d varchar(20)' % i for i in range(1, 8)]
+
+
+def prepare_fake(latency=0):
+    '''Create and fill the tables of FAKE_CONFIG, return the config'''
+
+    fakedb.reset()
+    for table, (host, db) in FAKE_TABLES.items():
+        sql = ['create table %s (id integer primary key, name varchar(20), '
+               'value integer not null default 0);' % table]
+        sql.extend("insert into %s values (%d, 'name%d', 0);" % (table, i, i)
+                   for i in xrange(1, FAKE_ROWS + 1))
+        fakedb.execute_script(db, '\n'.join(sql), host=host)
+    sql = ['create table bench_wide (%s);' % ', '.join(FAKE_WIDE_COLUMNS)]
+    sql.extend("insert into bench_wide values (%d, %s, %s, %s);" % (
+        i, ', '.join(str(i * j) for j in range(1, 7)),
+        ', '.join(str(i / float(j)) for j in range(1, 7)),
+        ', '.join("'value%d_%d'" % (i, j) for j in range(1, 8)))
+        for i in xrange(1, FAKE_ROWS + 1))
+    fakedb.execute_script('bench1', '\n'.join(sql), host='fake1')
+    config = dict(FAKE_CONFIG)
+    config['options'] = dict(config['options'],
+                             driver_options={'latency': latency})
+    return config
+
+
+class Scenario(object):
+
+    '''A benchmark scenario, run() executes one operation and may return the
+    number of rows fetched'''
+
+    def __init__(self, store, args, rand=None):
+        self.store = store
+        self.args = args
+        self.table = args.table
+        self.tables = args.tables
+        self.random = rand or random.Random(args.seed)
+
+    def random_id(self):
+        return self.random.randint(self.args.id_min, self.args.id_max)
+
+    def setup(self):
+        pass
+
+    def run(self):
+        raise NotImplementedError
+
+
+class PointSelect(Scenario):
+
+    '''select a row by primary key via get_cursor()'''
+
+    def run(self):
+        cursor = self.store.get_cursor(table=self.table)
+        cursor.execute('select * from %s where id=%%s' % self.table,
+                       self.random_id())
+        cursor.fetchall()
+
+
+class RoutedExecute(Scenario):
+
+    '''select a row by primary key via store.execute()'''
+
+    def run(self):
+        self.store.execute('select * from %s where id=%%s' % self.table,
+                           self.random_id())
+
+
+class Transaction(Scenario):
+
+    '''update one row in each table of --tables, then commit'''
+
+    def run(self):
+        self.store.transaction_begin()
+        try:
+            for table in self.tables:
+                self.store.execute('update %s set id=id where id=%%s' % table,
+                                   self.random_id())
+            self.store.commit()
+        except Exception:
+            self.store.rollback()
+            raise
+
+
+class Blacklisted(PointSelect):
+
+    '''point select with --blacklist-size non-matching fingerprints in both
+    query blacklists'''
+
+    def setup(self):
+        expire_time = time.time() + 86400
+        for i in xrange(self.args.blacklist_size):
+            self.store.disabled_queries['%032x' % i] = expire_time
+            self.store.disabled_queries_with_args['%032x' % i] = expire_time
+
+
+class Logging(PointSelect):
+
+    '''point select with sqlstore logging enabled'''
+
+    def setup(self):
+        self.store.logging = True
+
+
+class ConnectionChurn(PointSelect):
+
+    '''point select, expiring the connection every --churn-every operations
+    as if connection_expire_seconds elapsed'''
+
+    def setup(self):
+        self.count = 0
+
+    def run(self):
+        self.count += 1
+        if self.count % self.args.churn_every == 0:
+            self.store.get_farm_by_table(self.table).expire_time = 0
+        PointSelect.run(self)
+
+
+class WideSelect(Scenario):
+
+    '''select --wide-rows rows of --wide-table via get_cursor(), converted
+    with the conv profile of the farm'''
+
+    conv = None
+
+    def run(self):
+        table = self.args.wide_table
+        cursor = self.store.get_cursor(table=table, conv=self.conv)
+        cursor.execute('select * from %s limit %d' %
+                       (table, self.args.wide_rows))
+        return len(cursor.fetchall())
+
+
+class WideSelectLight(WideSelect):
+
+    '''wide_select converted with the light conv profile'''
+
+    conv = 'light'
+
+
+class WideSelectRaw(WideSelect):
+
+    '''wide_select returning raw bytes'''
+
+    conv = 'raw'
+
+
+class WideSelectColumns(Scenario):
+
+    '''wide_select into typed column arrays via store.query_columns(),
+    compare with wide_select fetching tuples'''
+
+    def run(self):
+        return len(self.store.query_columns(
+            'select * from %s limit %d' % (self.args.wide_table,
+                                           self.args.wide_rows),
+            batch_size=self.args.wide_rows))
+
+
+SCENARIOS = {
+    'point_select': PointSelect,
+    'routed_execute': RoutedExecute,
+    'transaction': Transaction,
+    'blacklisted': Blacklisted,
+    'logging': Logging,
+    'connection_churn': ConnectionChurn,
+    'wide_select': WideSelect,
+    'wide_select_light': WideSelectLight,
+    'wide_select_raw': WideSelectRaw,
+    'wide_select_columns': WideSelectColumns,
+}
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def run_scenario(name, config, args):
+    '''Run scenario `name` with args.concurrency threads, each with its own
+    store and random generator seeded by --seed and its index, and return
+    the report'''
+
+    latencies = []
+    errors = []
+    rows = []
+    first_error = []
+    lock = threading.Lock()
+
+    def record_error(e):
+        with lock:
+            if not first_error:
+                first_error.append('%s: %s' % (e.__class__.__name__, e))
+
+    def worker(index):
+        _latencies = []
+        _errors = 0
+        _rows = 0
+        store = store_from_config(config, use_cache=False)
+        try:
+            scenario = SCENARIOS[name](store, args,
+                                       random.Random((args.seed, index)))
+            scenario.setup()
+            for _ in xrange(args.warmup):
+                scenario.run()
+        except Exception, e:
+            record_error(e)
+            _errors += 1
+        else:
+            for _ in xrange(args.requests):
+                start = time.time()
+                try:
+                    _rows += scenario.run() or 0
+                except Exception, e:
+                    if not _errors:
+                        record_error(e)
+                    _errors += 1
+                _latencies.append(time.time() - start)
+        store.rollback_all()
+        store.close()
+        with lock:
+            latencies.extend(_latencies)
+            errors.append(_errors)
+            rows.append(_rows)
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in xrange(args.concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+
+    latencies.sort()
+    ms = lambda seconds: round(seconds * 1000, 4)
+    report = {
+        'scenario': name,
+        'concurrency': args.concurrency,
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'duration': round(duration, 4),
+        'throughput': round(len(latencies) / duration, 2) if duration else 0,
+        'latency_ms': {
+            'min': ms(latencies[0]) if latencies else 0,
+            'p50': ms(percentile(latencies, 50)),
+            'p90': ms(percentile(latencies, 90)),
+            'p99': ms(percentile(latencies, 99)),
+            'max': ms(latencies[-1]) if latencies else 0,
+        },
+    }
+    if first_error:
+        report['first_error'] = first_error[0]
+    if sum(rows):
+        report['rows'] = sum(rows)
+        report['rows_per_sec'] = round(sum(rows) / duration, 2) \
+            if duration else 0
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark sqlstore and report results as JSON')
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help='scenarios to run, all by default (wide_select* '
+                        'only with --fake): %s' % ', '.join(sorted(SCENARIOS)))
+    parser.add_argument('-c', '--config', help='sqlstore config')
+    parser.add_argument('--fake', action='store_true',
+                        help='use a builtin config on the fake driver')
+    parser.add_argument('--fake-latency', type=float, default=0,
+                        metavar='SECONDS',
+                        help='latency per statement of the fake driver')
+    parser.add_argument('-t', '--table', default='bench_table1',
+                        help='table with integer primary key "id"')
+    parser.add_argument('-T', '--tables', default='bench_table1,bench_table2',
+                        help='comma separated tables updated in transaction')
+    parser.add_argument('--ids', default='1-%d' % FAKE_ROWS,
+                        help='range of ids to query, e.g. 1-1000')
+    parser.add_argument('-n', '--requests', type=int, default=1000,
+                        help='operations per thread')
+    parser.add_argument('-j', '--concurrency', type=int, default=1,
+                        help='number of threads')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='operations per thread before measuring')
+    parser.add_argument('--blacklist-size', type=int, default=1000)
+    parser.add_argument('--churn-every', type=int, default=100)
+    parser.add_argument('--wide-table', default='bench_wide',
+                        help='table selected by the wide_select scenarios')
+    parser.add_argument('--wide-rows', type=int, default=200,
+                        help='rows per wide select')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for reproducible runs, each thread '
+                        'seeds its own generator with it and its index')
+    args = parser.parse_args(argv)
+
+    if not args.config and not args.fake:
+        parser.error('either --config or --fake must be specified')
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: %s' % ', '.join(sorted(unknown)))
+    args.scenarios = args.scenarios or sorted(
+        name for name in SCENARIOS
+        if args.fake or not name.startswith('wide_select'))
+    args.tables = [t for t in args.tables.split(',') if t]
+    try:
+        args.id_min, args.id_max = [int(i) for i in args.ids.split('-')]
+    except ValueError:
+        parser.error('invalid --ids: %s' % args.ids)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.fake:
+        config = prepare_fake(args.fake_latency)
+    else:
+        config = args.config
+
+    results = [run_scenario(name, config, args) for name in args.scenarios]
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    print
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Formats of SqlStore.export_table and SqlStore.load_file
+
+  * tsv: the default format of SELECT ... INTO OUTFILE and LOAD DATA,
+    fields are separated by tabs, NULL is \\N, and backslash, tab, newline
+    and NUL in values are escaped with a backslash.
+  * csv: fields are separated by commas, strings are enclosed by double
+    quotes (quotes are doubled) and numbers are not. NULL is the unquoted
+    word NULL, which LOAD DATA reads as NULL, while "NULL" and "" are
+    strings.
+
+Files are loaded with LOAD DATA LOCAL INFILE, which needs the connections
+of the farm opened with local_infile, e.g. with the `driver_options` of
+the farm:
+
+    'driver_options': {'local_infile': 1},
+'''
+
+import os
+import tempfile
+from decimal import Decimal
+
+FORMATS = ('tsv', 'csv')
+
+TSV_ESCAPES = [('\\', '\\\\'), ('\0', '\\0'), ('\t', '\\t'), ('\n', '\\n')]
+
+LOAD_OPTIONS = {
+    'tsv': '',
+    'csv': (" fields terminated by ',' optionally enclosed by '\"' "
+            "escaped by '' lines terminated by '\\n'"),
+}
+
+
+def check_format(format):
+    if format not in FORMATS:
+        raise ValueError('unknown format: %s' % format)
+
+
+def to_bytes(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def escape_tsv(value):
+    if value is None:
+        return '\\N'
+    value = to_bytes(value)
+    for char, escaped in TSV_ESCAPES:
+        if char in value:
+            value = value.replace(char, escaped)
+    return value
+
+
+def quote_csv(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (int, long, float, Decimal)):
+        return to_bytes(value)
+    return '"%s"' % to_bytes(value).replace('"', '""')
+
+
+def format_rows(rows, format):
+    '''Return rows formatted as lines of a tsv or csv file'''
+
+    escape = escape_tsv if format == 'tsv' else quote_csv
+    sep = '\t' if format == 'tsv' else ','
+    return ''.join(sep.join([escape(v) for v in row]) + '\n' for row in rows)
+
+
+def load_statement(table, format, columns=None, duplicate=None):
+    '''Return LOAD DATA LOCAL INFILE of table, the path of the file is the
+    argument of the statement. `duplicate` is None, "replace" or "ignore"'''
+
+    if duplicate not in (None, 'replace', 'ignore'):
+        raise ValueError('duplicate must be replace or ignore: %s' %
+                         duplicate)
+    sql = 'load data local infile %%s %sinto table `%s` character set utf8' \
+        % (duplicate + ' ' if duplicate else '', table)
+    sql += LOAD_OPTIONS[format]
+    if columns:
+        sql += ' (%s)' % ', '.join('`%s`' % c for c in columns)
+    return sql
+
+
+def split_file(path, chunk_size):
+    '''Split a tsv file into temporary files of about chunk_size bytes at
+    line boundaries, yield (path of a chunk, number of bytes)'''
+
+    with open(path, 'rb') as f:
+        while True:
+            lines = f.readlines(chunk_size)
+            if not lines:
+                break
+            fd, chunk_path = tempfile.mkstemp(prefix='sqlstore-load-')
+            try:
+                with os.fdopen(fd, 'wb') as chunk:
+                    chunk.writelines(lines)
+                yield chunk_path, sum(len(l) for l in lines)
+            finally:
+                os.remove(chunk_path)
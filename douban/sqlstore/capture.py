@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Workload capture file format
+
+A capture file is a stream of JSON lines, gzip compressed if the file name
+ends with ".gz". The first line is a header:
+
+    {"version": 1, "start": 1400000000.0, "host": "...", "cmdline": "..."}
+
+and each following line records one statement:
+
+    [offset, farm, sql, args, timecost, ok]
+
+where `offset` is the number of seconds since "start" when the statement
+was issued, and `ok` is false if the statement raised an exception.
+'''
+
+import datetime
+import decimal
+import gzip
+import json
+import socket
+import sys
+import threading
+import time
+
+VERSION = 1
+
+
+def _default(obj):
+    if isinstance(obj, (datetime.date, datetime.time, datetime.timedelta,
+                        decimal.Decimal)):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    return repr(obj)
+
+
+def open_capture(path, mode='r'):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b')
+    return open(path, mode)
+
+
+class CaptureWriter(object):
+
+    '''Write captured statements to a capture file'''
+
+    def __init__(self, path_or_file):
+        if isinstance(path_or_file, basestring):
+            self.file = open_capture(path_or_file, 'w')
+            self.own_file = True
+        else:
+            self.file = path_or_file
+            self.own_file = False
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.count = 0
+        header = {
+            'version': VERSION,
+            'start': self.start,
+            'host': socket.gethostname(),
+            'cmdline': ' '.join(sys.argv),
+        }
+        self.file.write(json.dumps(header) + '\n')
+
+    def write(self, issued_at, farm, sql, args, timecost, ok=True):
+        line = json.dumps([round(issued_at - self.start, 6), farm, sql, args,
+                           round(timecost, 6), ok],
+                          default=_default, separators=(',', ':'))
+        with self.lock:
+            self.file.write(line + '\n')
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            if self.own_file:
+                self.file.close()
+            else:
+                self.file.flush()
+
+
+def _encode(obj):
+    if isinstance(obj, unicode):
+        return obj.encode('utf8')
+    if isinstance(obj, list):
+        return tuple(_encode(o) for o in obj)
+    if isinstance(obj, dict):
+        return dict((_encode(k), _encode(v)) for k, v in obj.items())
+    return obj
+
+
+def read_capture(path_or_file):
+    '''Return (header, iterator of records) of a capture file, records are
+    (offset, farm, sql, args, timecost, ok) tuples'''
+
+    if isinstance(path_or_file, basestring):
+        f = open_capture(path_or_file)
+    else:
+        f = path_or_file
+    header = json.loads(f.readline())
+    if header.get('version') != VERSION:
+        raise ValueError('unsupported capture version: %r' %
+                         header.get('version'))
+
+    def records():
+        for line in f:
+            if line.strip():
+                offset, farm, sql, args, timecost, ok = json.loads(line)
+                yield (offset, _encode(farm), _encode(sql), _encode(args),
+                       timecost, ok)
+
+    return header, records()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Fetch the result of a SELECT into typed column arrays
+
+Rows are fetched in batches and appended column by column to NumPy arrays,
+or to array.array when NumPy is not installed, instead of keeping a tuple
+of boxed values for every row. A NULL value is stored as 0 (NaN for float
+columns) and flagged in the mask of its column.
+
+The type of a column is given by `dtypes`, a list in select order or a
+dict {column name: dtype}:
+
+    int8 int16 int32 int64 uint8 uint16 uint32 uint64
+    float32 float64 bool object
+
+It defaults to the MySQL type of the column: int64 for integer columns,
+uint64 for UNSIGNED ones when the cursor has the column flags (MySQLdb
+cursor.description_flags), float64 for FLOAT and DOUBLE, object (a list
+without NumPy) for others.
+'''
+
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# array.array type codes
+TYPECODES = {
+    'int8': 'b',
+    'int16': 'h',
+    'int32': 'i',
+    'int64': 'l',
+    'uint8': 'B',
+    'uint16': 'H',
+    'uint32': 'I',
+    'uint64': 'L',
+    'float32': 'f',
+    'float64': 'd',
+    'bool': 'B',
+    'object': None,
+}
+
+# MySQLdb.constants.FIELD_TYPE
+INTEGER_TYPES = (1, 2, 3, 8, 9, 13)  # TINY SHORT LONG LONGLONG INT24 YEAR
+FLOAT_TYPES = (4, 5)  # FLOAT DOUBLE
+# MySQLdb.constants.FLAG
+UNSIGNED_FLAG = 32
+
+
+def default_dtype(type_code, flags=0):
+    if type_code in INTEGER_TYPES:
+        if flags & UNSIGNED_FLAG:
+            return 'uint64'
+        return 'int64'
+    if type_code in FLOAT_TYPES:
+        return 'float64'
+    return 'object'
+
+
+class Column(object):
+
+    def __init__(self, name, dtype, use_numpy=None):
+        if dtype not in TYPECODES:
+            raise ValueError('unknown dtype of column %s: %s' % (name, dtype))
+        self.name = name
+        self.dtype = dtype
+        self.use_numpy = numpy is not None if use_numpy is None else use_numpy
+        if dtype == 'object':
+            self.fill = None
+        elif dtype.startswith('float'):
+            self.fill = float('nan')
+        else:
+            self.fill = 0
+        self.chunks = []
+        self.mask_chunks = []
+        if not self.use_numpy:
+            typecode = TYPECODES[dtype]
+            self.values = array.array(typecode) if typecode else []
+            self.mask = array.array('B')
+
+    def append(self, values):
+        mask = [v is None for v in values]
+        if True in mask:
+            fill = self.fill
+            values = [fill if v is None else v for v in values]
+        if self.use_numpy:
+            self.chunks.append(numpy.array(values, dtype=self.dtype))
+            self.mask_chunks.append(numpy.array(mask, dtype=bool))
+        else:
+            self.values.extend(values)
+            self.mask.extend(mask)
+
+    def result(self):
+        if not self.use_numpy:
+            return self.values, self.mask
+        if not self.chunks:
+            return numpy.array([], dtype=self.dtype), \
+                numpy.array([], dtype=bool)
+        return numpy.concatenate(self.chunks), \
+            numpy.concatenate(self.mask_chunks)
+
+
+class Columns(object):
+
+    '''Typed column arrays of a result set, columns[name] is the array of
+    values of a column and columns.masks[name] its NULL mask'''
+
+    def __init__(self, names, values, masks):
+        self.names = names
+        self.values = dict(zip(names, values))
+        self.masks = dict(zip(names, masks))
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        if not self.names:
+            return 0
+        return len(self.masks[self.names[0]])
+
+    def __repr__(self):
+        return '<Columns %s rows:%d>' % (','.join(self.names), len(self))
+
+
+class ColumnBuilder(object):
+
+    '''Append batches of rows to typed columns, `flags` are the column
+    flags of the cursor if known'''
+
+    def __init__(self, description, dtypes=None, use_numpy=None, flags=None):
+        self.names = [d[0] for d in description]
+        if dtypes is None:
+            dtypes = {}
+        if isinstance(dtypes, dict):
+            unknown = set(dtypes) - set(self.names)
+            if unknown:
+                raise ValueError('dtypes of unknown columns: %s' %
+                                 ','.join(sorted(unknown)))
+            flags = flags or [0] * len(description)
+            dtypes = [dtypes.get(d[0]) or default_dtype(d[1], f)
+                      for d, f in zip(description, flags)]
+        elif len(dtypes) != len(self.names):
+            raise ValueError('%d dtypes for %d columns' %
+                             (len(dtypes), len(self.names)))
+        self.columns = [Column(name, dtype, use_numpy)
+                        for name, dtype in zip(self.names, dtypes)]
+
+    def append(self, rows):
+        for column, values in zip(self.columns, zip(*rows)):
+            column.append(values)
+
+    def result(self):
+        results = [column.result() for column in self.columns]
+        return Columns(self.names, [values for values, _ in results],
+                       [mask for _, mask in results])
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Conversion profiles of the values fetched from MySQL
+
+MySQLdb converts every value of a result with the `conv` map of the
+connection, building Decimal, datetime etc. objects. A profile replaces
+the decoders of the map:
+
+  * default: the converters of the driver.
+  * raw: no decoder, values are returned as the bytes sent by the server
+    (None for NULL).
+  * light: int for integer columns and float for FLOAT and DOUBLE, other
+    columns, including DECIMAL and temporal columns, are returned as bytes.
+  * a dict {field type: decoder}, or "module:attribute" naming one.
+
+The profile of a farm is set with the `conv` option of the sqlstore config
+or of the farm, and for a single cursor with store.get_cursor(conv=...) or
+get_cursor(raw=True).
+'''
+
+import sys
+
+import MySQLdb
+
+from .columns import INTEGER_TYPES, FLOAT_TYPES
+
+LIGHT_DECODERS = dict([(t, int) for t in INTEGER_TYPES] +
+                      [(t, float) for t in FLOAT_TYPES])
+
+
+def is_default(profile):
+    return profile is None or profile == 'default'
+
+
+def get_conversions(driver):
+    '''Return the default conv map of driver, None if it has none'''
+
+    if driver is MySQLdb:
+        from MySQLdb.converters import conversions
+        return conversions
+    return getattr(driver, 'conversions', None)
+
+
+def get_decoders(profile, driver):
+    '''Return the decoders (keyed by field type) of profile'''
+
+    if is_default(profile):
+        conversions = get_conversions(driver)
+        if conversions is None:
+            return None
+        return dict((k, v) for k, v in conversions.items()
+                    if isinstance(k, int))
+    if isinstance(profile, dict):
+        return profile
+    if profile == 'raw':
+        return {}
+    if profile == 'light':
+        return LIGHT_DECODERS
+    if isinstance(profile, basestring) and ':' in profile:
+        module, attr = profile.split(':', 1)
+        __import__(module)
+        return getattr(sys.modules[module], attr)
+    raise ValueError('unknown conv profile: %r' % (profile,))
+
+
+def get_conv(profile, driver):
+    '''Return the `conv` argument of driver.connect() for profile, None for
+    the default one'''
+
+    if is_default(profile):
+        return None
+    conv = dict((k, v) for k, v in (get_conversions(driver) or {}).items()
+                if not isinstance(k, int))
+    conv.update(get_decoders(profile, driver))
+    return conv
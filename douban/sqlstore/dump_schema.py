@@ -3,12 +3,184 @@ import re
 import sys
 import pickle
 import argparse
+import threading
 
-from douban.sqlstore import store_from_config
+import MySQLdb
+
+from douban.sqlstore import store_from_config, parallel_map
 
 SCHEMA_CACHE = 'schema_cache.pickle'
 
-def main():
+# table options and definition checksums of all tables and views in one
+# query each, used to decide which tables need "show create table"
+TABLES_SQL = '''select TABLE_NAME, TABLE_TYPE, CREATE_TIME, ENGINE,
+TABLE_COLLATION, CREATE_OPTIONS, TABLE_COMMENT, AUTO_INCREMENT
+from information_schema.TABLES where TABLE_SCHEMA=database()'''
+
+COLUMNS_SQL = '''select TABLE_NAME, md5(group_concat(concat_ws(':',
+COLUMN_NAME, COLUMN_TYPE, IS_NULLABLE, ifnull(COLUMN_DEFAULT, 'NULL'),
+EXTRA, CHARACTER_SET_NAME, COLLATION_NAME, COLUMN_COMMENT)
+order by ORDINAL_POSITION separator '|'))
+from information_schema.COLUMNS where TABLE_SCHEMA=database()
+group by TABLE_NAME'''
+
+INDEXES_SQL = '''select TABLE_NAME, md5(group_concat(concat_ws(':',
+INDEX_NAME, NON_UNIQUE, SEQ_IN_INDEX, COLUMN_NAME, ifnull(SUB_PART, ''),
+INDEX_TYPE) order by INDEX_NAME, SEQ_IN_INDEX separator '|'))
+from information_schema.STATISTICS where TABLE_SCHEMA=database()
+group by TABLE_NAME'''
+
+FOREIGN_KEYS_SQL = '''select k.TABLE_NAME, md5(group_concat(concat_ws(':',
+k.CONSTRAINT_NAME, k.COLUMN_NAME, k.REFERENCED_TABLE_SCHEMA,
+k.REFERENCED_TABLE_NAME, k.REFERENCED_COLUMN_NAME, r.MATCH_OPTION,
+r.UPDATE_RULE, r.DELETE_RULE)
+order by k.CONSTRAINT_NAME, k.ORDINAL_POSITION separator '|'))
+from information_schema.KEY_COLUMN_USAGE k
+join information_schema.REFERENTIAL_CONSTRAINTS r
+on r.CONSTRAINT_SCHEMA=k.CONSTRAINT_SCHEMA
+and r.CONSTRAINT_NAME=k.CONSTRAINT_NAME and r.TABLE_NAME=k.TABLE_NAME
+where k.TABLE_SCHEMA=database() group by k.TABLE_NAME'''
+
+PARTITIONS_SQL = '''select TABLE_NAME, md5(group_concat(concat_ws(':',
+PARTITION_NAME, SUBPARTITION_NAME, PARTITION_METHOD, SUBPARTITION_METHOD,
+PARTITION_EXPRESSION, SUBPARTITION_EXPRESSION, PARTITION_DESCRIPTION,
+PARTITION_COMMENT, TABLESPACE_NAME)
+order by PARTITION_ORDINAL_POSITION, SUBPARTITION_ORDINAL_POSITION
+separator '|'))
+from information_schema.PARTITIONS where TABLE_SCHEMA=database()
+and PARTITION_NAME is not null group by TABLE_NAME'''
+
+VIEWS_SQL = '''select TABLE_NAME, md5(concat_ws(':', VIEW_DEFINITION,
+CHECK_OPTION, DEFINER, SECURITY_TYPE, CHARACTER_SET_CLIENT,
+COLLATION_CONNECTION))
+from information_schema.VIEWS where TABLE_SCHEMA=database()'''
+
+# information_schema.CHECK_CONSTRAINTS only exists since MySQL 8.0.16 (and
+# MariaDB 10.2), older servers do not keep CHECK constraints
+CHECKS_SQL = '''select t.TABLE_NAME, md5(group_concat(concat_ws(':',
+t.CONSTRAINT_NAME, c.CHECK_CLAUSE)
+order by t.CONSTRAINT_NAME separator '|'))
+from information_schema.TABLE_CONSTRAINTS t
+join information_schema.CHECK_CONSTRAINTS c
+on c.CONSTRAINT_SCHEMA=t.CONSTRAINT_SCHEMA
+and c.CONSTRAINT_NAME=t.CONSTRAINT_NAME
+where t.TABLE_SCHEMA=database() and t.CONSTRAINT_TYPE='CHECK'
+group by t.TABLE_NAME'''
+
+# checksums of table definitions in the version of a table, in order
+CHECKSUM_SQLS = (COLUMNS_SQL, INDEXES_SQL, FOREIGN_KEYS_SQL, PARTITIONS_SQL,
+                 VIEWS_SQL, CHECKS_SQL)
+
+re_auto_increment = re.compile('\s+AUTO_INCREMENT=\d+')
+
+print_lock = threading.Lock()
+
+
+def echo(message, stream=sys.stdout):
+    with print_lock:
+        print >>stream, message
+
+
+def get_table_versions(cursor, with_auto_increment=False):
+    '''Return {table: version}, the version changes whenever the definition
+    of the table changes. Its first item is the TABLE_TYPE, "VIEW" for
+    views.'''
+
+    cursor.execute('set session group_concat_max_len = 1048576')
+    cursor.execute(TABLES_SQL)
+    versions = {}
+    for row in cursor.fetchall():
+        table, options, auto_increment = row[0], row[1:-1], row[-1]
+        if with_auto_increment:
+            options += (auto_increment,)
+        versions[table] = tuple(str(o) for o in options)
+    for sql in CHECKSUM_SQLS:
+        try:
+            cursor.execute(sql)
+            checksums = dict(cursor.fetchall())
+        except MySQLdb.Error:
+            if sql is not CHECKS_SQL:
+                raise
+            # unknown table CHECK_CONSTRAINTS
+            checksums = {}
+        for table in versions:
+            versions[table] += (checksums.get(table) or '',)
+    return versions
+
+
+def is_view(version):
+    return version[0] == 'VIEW'
+
+
+def dump_farm(name, farm, args, schema_cache):
+    '''Dump schema of a farm, return (success, schema cache of the farm)'''
+
+    output_file = 'database-{}.sql'.format(name)
+    tmp_output_file = '{}-tmp'.format(output_file)
+    if args.verbose:
+        echo('Dump schema in {} to {}...'.format(name, output_file))
+    cursor = farm.get_cursor()
+    versions = get_table_versions(cursor, args.keep_auto_increment and
+                                  not args.only_meaningful_changes)
+    # views are created after the tables they select from
+    tables = sorted(versions, key=lambda t: (is_view(versions[t]), t))
+    farm_cache = {}
+    fail = False
+    fetched = 0
+    with open(tmp_output_file, 'w') as f:
+        f.write('/*!40101 SET @saved_cs_client = @@character_set_client */;\n')
+        f.write('/*!40101 SET character_set_client = utf8 */;\n\n')
+        for table in tables:
+            try:
+                kind = 'VIEW' if is_view(versions[table]) else 'TABLE'
+                if not args.without_drop_table:
+                    f.write('DROP {} IF EXISTS `{}`;\n'.format(kind, table))
+                _table = '{}.{}'.format(name, table)
+                version = (args.keep_auto_increment,) + versions[table]
+                cached = schema_cache.get(_table)
+                if isinstance(cached, dict) and \
+                        cached.get('version') == version:
+                    # definition does not change, the cached schema also
+                    # keeps AUTO_INCREMENT if only_meaningful_changes
+                    schema = cached['schema']
+                else:
+                    cursor.execute('show create {} `{}`'.format(
+                        kind.lower(), table))
+                    # View, Create View, character_set_client and
+                    # collation_connection for views
+                    schema = cursor.fetchone()[1]
+                    fetched += 1
+                    if not args.keep_auto_increment:
+                        schema = re_auto_increment.sub('', schema)
+                    elif args.only_meaningful_changes and \
+                            isinstance(cached, basestring) and \
+                            re_auto_increment.sub('', cached) == \
+                            re_auto_increment.sub('', schema):
+                        # cache of old format, only AUTO_INCREMENT changes
+                        schema = cached
+                farm_cache[_table] = {'version': version, 'schema': schema}
+                f.write('{};\n\n'.format(schema))
+            except Exception, exc:
+                fail = True
+                msg = 'dump schema of "{}.{}" fail: {}'.format(name, table, exc)
+                echo(msg, sys.stderr)
+                break
+        f.write('/*!40101 SET character_set_client = @saved_cs_client */;\n')
+    if not fail:
+        os.rename(tmp_output_file, output_file)
+        if args.verbose:
+            echo('{}: {} tables, {} changed'.format(name, len(tables),
+                                                    fetched))
+    else:
+        try:
+            os.remove(tmp_output_file)
+        except Exception, exc:
+            echo('remove tmp file "{}" fail: {}'.format(tmp_output_file, exc),
+                 sys.stderr)
+    return not fail, farm_cache
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', help='sqlstore config')
     parser.add_argument('--without-drop-table', action='store_true')
@@ -17,67 +189,44 @@ def main():
     parser.add_argument('--only-meaningful-changes',
                         action='store_true',
                         help='Do not treat as change if only AUTO_INCREMENT changes')
-    args = parser.parse_args()
+    parser.add_argument('--cache-file',
+                        help='cache of table schemas, "show create table" '
+                             'is only issued for changed tables '
+                             '(default: no cache, or %s with '
+                             '--only-meaningful-changes)' % SCHEMA_CACHE)
+    parser.add_argument('--no-cache', action='store_true')
+    args = parser.parse_args(argv)
 
     if not args.config:
         print 'sqlstore config must be specified'
         return 1
 
-    re_auto_increment = re.compile('\s+AUTO_INCREMENT=\d+')
+    if args.no_cache:
+        args.cache_file = None
+    elif args.cache_file is None and args.only_meaningful_changes:
+        # keeps the AUTO_INCREMENT of unchanged tables
+        args.cache_file = SCHEMA_CACHE
 
     schema_cache = {}
-    if args.only_meaningful_changes:
+    if args.cache_file:
         try:
-            schema_cache = pickle.load(open(SCHEMA_CACHE))
+            schema_cache = pickle.load(open(args.cache_file))
         except:
             pass
 
     store = store_from_config(args.config)
-    for name, farm in store.farms.items():
-        output_file = 'database-{}.sql'.format(name)
-        tmp_output_file = '{}-tmp'.format(output_file)
-        if args.verbose:
-            print 'Dump schema in {} to {}...'.format(name, output_file)
-        cursor = farm.get_cursor()
-        cursor.execute('show tables')
-        tables = sorted([r[0] for r in cursor.fetchall()])
-        fail = False
-        with open(tmp_output_file, 'w') as f:
-            f.write('/*!40101 SET @saved_cs_client = @@character_set_client */;\n')
-            f.write('/*!40101 SET character_set_client = utf8 */;\n\n')
-            for table in tables:
-                try:
-                    if not args.without_drop_table:
-                        f.write('DROP TABLE IF EXISTS `{}`;\n'.format(table))
-                    cursor.execute('show create table `{}`'.format(table))
-                    schema = cursor.fetchone()[-1]
-                    if not args.keep_auto_increment:
-                        schema = re_auto_increment.sub('', schema)
-                    elif args.only_meaningful_changes:
-                        _table = '{}.{}'.format(name, table)
-                        _schema = schema_cache.get(_table)
-                        if _schema and (re_auto_increment.sub('', _schema) == \
-                           re_auto_increment.sub('', schema)):
-                            # only AUTO_INCREMENT changes, definition does not
-                            # change, use cached schema to keep AUTO_INCREMENT
-                            schema = _schema
-                        else:
-                            schema_cache[_table] = schema
-                    f.write('{};\n\n'.format(schema))
-                except Exception, exc:
-                    fail = True
-                    msg = 'dump schema of "{}.{}" fail: {}'.format(name, table, exc)
-                    print >>sys.stderr, msg
-                    break
-            f.write('/*!40101 SET character_set_client = @saved_cs_client */;\n')
-        if not fail:
-            os.rename(tmp_output_file, output_file)
-        else:
-            try:
-                os.remove(tmp_output_file)
-            except Exception, exc:
-                print >>sys.stderr, 'remove tmp file "{}" fail: {}'.format(tmp_output_file, exc)
+    farms = sorted(store.farms.items())
+    results = parallel_map(lambda item: dump_farm(item[0], item[1], args,
+                                                  schema_cache),
+                           farms)
+    for (name, _), (result, exc) in zip(farms, results):
+        if exc is not None:
+            echo('dump schema of "{}" fail: {}'.format(name, exc), sys.stderr)
+            continue
+        success, farm_cache = result
+        if success:
+            schema_cache.update(farm_cache)
 
-    if args.only_meaningful_changes:
-        with open(SCHEMA_CACHE, 'w') as f:
+    if args.cache_file:
+        with open(args.cache_file, 'w') as f:
             pickle.dump(schema_cache, f)
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''In-process fake MySQL driver for benchmarks and tests
+
+It implements the part of the MySQLdb interface used by sqlstore on top of
+SQLite, so that the client side cost of sqlstore can be measured without a
+MySQL server. Use it with the `driver` option of a farm or of a sqlstore
+config:
+
+    {
+        'farms': {
+            'luz_farm': {
+                'master': 'localhost:3306:luz_farm:user:passwd',
+                'tables': ['*'],
+                'driver': 'fake',
+            },
+        },
+        'options': {'driver_options': {'latency': 0.0005}},
+    }
+
+`latency` (seconds per statement) and `connect_latency` (seconds per
+connect) simulate the network. MySQL session statements issued by sqlstore
+are answered by scripted responses, see add_script(). Tables have to be
+created with SQLite syntax, e.g. via execute_script(). Like MySQLdb,
+values are turned into bytes and decoded with the `conv` map of the
+connection, see `conversions`.
+'''
+
+import datetime
+import decimal
+import itertools
+import re
+import sqlite3
+import threading
+import time
+
+from MySQLdb import (Warning, Error, InterfaceError, DatabaseError,
+                     DataError, OperationalError, IntegrityError,
+                     InternalError, ProgrammingError, NotSupportedError)
+
+from MySQLdb.constants import CLIENT
+
+apilevel = '2.0'
+threadsafety = 1
+paramstyle = 'format'
+
+SCRIPTS = []
+
+_databases = {}
+_databases_lock = threading.Lock()
+# SQLite connections are shared by all fake connections and threads
+_sqlite_lock = threading.RLock()
+_thread_ids = itertools.count(1)
+
+# MySQL field types of SQLite values: LONGLONG, DOUBLE and VAR_STRING
+FIELD_TYPES = {int: 8, long: 8, float: 5}
+STRING = 253
+
+# values are sent as bytes and decoded by the conv map, like MySQLdb
+conversions = {8: int, 5: float}
+
+re_load_data = re.compile(r"load\s+data\s+local\s+infile\s+"
+                          r"'(?P<path>(?:[^']|'')*)'\s+"
+                          r"((?P<duplicate>replace|ignore)\s+)?"
+                          r"into\s+table\s+`?(?P<table>\w+)`?"
+                          r"(?P<options>[^(]*?)(\((?P<columns>[^)]*)\))?"
+                          r"\s*(--.*)?$", re.I | re.S)
+re_csv_options = re.compile(r"fields\s+terminated\s+by\s+','", re.I)
+re_tsv_escape = re.compile(r'\\(.)', re.S)
+re_csv_field = re.compile(r'"((?:[^"]|"")*)"|([^,\n]*)')
+TSV_ESCAPES = {'0': '\0', 't': '\t', 'n': '\n'}
+
+
+def read_csv(data):
+    '''Return the rows of a csv file of douban.sqlstore.bulk, the unquoted
+    word NULL is None'''
+
+    rows = []
+    row = []
+    pos = 0
+    while pos < len(data):
+        match = re_csv_field.match(data, pos)
+        quoted, value = match.groups()
+        if quoted is not None:
+            row.append(quoted.replace('""', '"'))
+        else:
+            row.append(None if value == 'NULL' else value)
+        pos = match.end()
+        if data[pos:pos + 1] == ',':
+            pos += 1
+        else:
+            rows.append(row)
+            row = []
+            pos += 1
+    return rows
+
+
+def add_script(pattern, result):
+    '''Answer statements matching regular expression `pattern` with
+    `result`, a list of rows or a callable(connection, match) returning
+    one. Scripts added later take precedence.
+    '''
+
+    SCRIPTS.insert(0, (re.compile(pattern, re.I | re.S), result))
+
+
+def _show_tables(conn, match):
+    rows = conn.database.execute("select name from sqlite_master where type "
+                                 "in ('table', 'view') order by name")
+    return rows.fetchall()
+
+
+def _show_create_table(conn, match):
+    rows = conn.database.execute("select name, sql from sqlite_master "
+                                 "where type='table' and name=?",
+                                 (match.group(1),))
+    return rows.fetchall()
+
+
+def _show_create_view(conn, match):
+    rows = conn.database.execute("select name, sql, 'utf8', "
+                                 "'utf8_general_ci' from sqlite_master "
+                                 "where type='view' and name=?",
+                                 (match.group(1),))
+    return rows.fetchall()
+
+
+add_script(r'set\s', [])
+add_script(r'xa\s', [])
+add_script(r'show\s+warnings', [])
+add_script(r'show\s+tables', _show_tables)
+add_script(r'show\s+create\s+table\s+`?(\w+)`?', _show_create_table)
+add_script(r'show\s+create\s+view\s+`?(\w+)`?', _show_create_view)
+add_script(r'select\s+@@', [('',)])
+add_script(r'select\s+@@tx_isolation', [('REPEATABLE-READ',)])
+add_script(r'select\s+host\s+from\s+information_schema.processlist',
+           lambda conn, match: [('localhost:%d' % conn._thread_id,)])
+
+
+def get_database(host, port, db, path=None):
+    '''Return the SQLite database shared by fake connections to host:port/db
+    '''
+
+    key = (host, port, db)
+    with _databases_lock:
+        database = _databases.get(key)
+        if database is None:
+            database = sqlite3.connect(path or ':memory:',
+                                       check_same_thread=False)
+            database.text_factory = str
+            _databases[key] = database
+        return database
+
+
+def execute_script(db, sql, host='localhost', port=3306):
+    '''Execute SQLite statements, e.g. CREATE TABLE, in a fake database'''
+
+    with _sqlite_lock:
+        get_database(host, port, db).executescript(sql)
+
+
+def reset():
+    '''Drop all fake databases'''
+
+    with _databases_lock:
+        for database in _databases.values():
+            database.close()
+        _databases.clear()
+
+
+def escape(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, long, float, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    elif isinstance(value, (datetime.date, datetime.time,
+                            datetime.timedelta)):
+        value = str(value)
+    elif isinstance(value, (list, tuple, set)):
+        return '(%s)' % ','.join(escape(v) for v in value)
+    return "'%s'" % str(value).replace("'", "''")
+
+
+class Connection(object):
+
+    def __init__(self, host='localhost', user='', passwd='', db='', port=3306,
+                 client_flag=0, latency=0, connect_latency=0, path=None,
+                 conv=None, local_infile=0, compress=0, **kwargs):
+        if connect_latency:
+            time.sleep(connect_latency)
+        self.database = get_database(host, port, db, path)
+        self.latency = latency
+        self.multi_statements = bool(client_flag & CLIENT.MULTI_STATEMENTS)
+        self.local_infile = local_infile
+        self.compress = compress
+        if conv is None:
+            conv = conversions
+        self.converter = dict((k, v) for k, v in conv.items()
+                              if isinstance(k, int))
+        self.open = 1
+        self._thread_id = next(_thread_ids)
+
+    def cursor(self, cursorclass=None):
+        self._check_open()
+        return (cursorclass or Cursor)(self)
+
+    def _check_open(self):
+        if not self.open:
+            raise InterfaceError(0, 'connection is closed')
+
+    def commit(self):
+        self._check_open()
+        with _sqlite_lock:
+            self.database.commit()
+
+    def rollback(self):
+        self._check_open()
+        with _sqlite_lock:
+            self.database.rollback()
+
+    def close(self):
+        self.open = 0
+
+    def ping(self, reconnect=False):
+        self._check_open()
+
+    def thread_id(self):
+        return self._thread_id
+
+    def convert(self, value):
+        if value is None:
+            return value
+        decoder = self.converter.get(FIELD_TYPES.get(type(value), STRING))
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        elif isinstance(value, float):
+            value = repr(value)
+        else:
+            value = str(value)
+        return decoder(value) if decoder else value
+
+    def warning_count(self):
+        return 0
+
+    def character_set_name(self):
+        return 'utf8'
+
+    def literal(self, args):
+        if isinstance(args, dict):
+            return dict((k, escape(v)) for k, v in args.items())
+        if isinstance(args, (list, tuple)):
+            return tuple(escape(v) for v in args)
+        return escape(args)
+
+    def query(self, sql):
+        '''Execute a single statement, return (rows, rowcount, lastrowid,
+        description)'''
+
+        self._check_open()
+        if self.latency:
+            time.sleep(self.latency)
+
+        statement = sql.strip()
+        match = re_load_data.match(statement)
+        if match:
+            return self.load_data(match)
+        for pattern, result in SCRIPTS:
+            match = pattern.match(statement)
+            if match:
+                if callable(result):
+                    with _sqlite_lock:
+                        result = result(self, match)
+                rows = tuple(tuple(r) for r in result)
+                return rows, len(rows), 0, None
+
+        try:
+            with _sqlite_lock:
+                cursor = self.database.execute(statement)
+                rows = tuple(cursor.fetchall())
+                rows = tuple(tuple(self.convert(v) for v in row)
+                             for row in rows)
+                rowcount = cursor.rowcount
+                if rowcount < 0:
+                    rowcount = len(rows)
+                return rows, rowcount, cursor.lastrowid or 0, \
+                    cursor.description
+        except sqlite3.IntegrityError, exc:
+            raise IntegrityError(1062, str(exc))
+        except sqlite3.Error, exc:
+            raise ProgrammingError(1064, '%s: %s' % (exc, statement))
+
+    def load_data(self, match):
+        '''LOAD DATA LOCAL INFILE of tsv files and csv files enclosed by
+        double quotes'''
+
+        if not self.local_infile:
+            raise OperationalError(1148, 'The used command is not allowed '
+                                   'with this MySQL version')
+        with open(match.group('path').replace("''", "'"), 'rb') as f:
+            data = f.read()
+        if re_csv_options.search(match.group('options')):
+            rows = read_csv(data)
+        else:
+            rows = [[None if v == '\\N' else re_tsv_escape.sub(
+                lambda m: TSV_ESCAPES.get(m.group(1), m.group(1)), v)
+                for v in line.split('\t')]
+                for line in data.split('\n')[:-1]]
+        if not rows:
+            return (), 0, 0, None
+
+        insert = {'replace': 'insert or replace', 'ignore': 'insert or ignore'}
+        sql = '%s into %s%s values (%s)' % (
+            insert.get((match.group('duplicate') or '').lower(), 'insert'),
+            match.group('table'),
+            ' (%s)' % match.group('columns') if match.group('columns') else '',
+            ', '.join('?' * len(rows[0])))
+        try:
+            with _sqlite_lock:
+                changes = self.database.total_changes
+                self.database.executemany(sql, rows)
+                return (), self.database.total_changes - changes, 0, None
+        except sqlite3.IntegrityError, exc:
+            raise IntegrityError(1062, str(exc))
+        except sqlite3.Error, exc:
+            raise ProgrammingError(1064, '%s: %s' % (exc, sql))
+
+
+class Cursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.arraysize = 1
+        self.messages = []
+        self._warnings = 0
+        self._results = []
+        self._reset()
+
+    def _reset(self):
+        self._rows = ()
+        self._pos = 0
+        self.rowcount = -1
+        self.lastrowid = None
+        self.description = None
+
+    def _next_result(self):
+        self._reset()
+        if not self._results:
+            return None
+        sql = self._results.pop(0)
+        rows, rowcount, lastrowid, description = self.connection.query(sql)
+        self._rows = rows
+        self.rowcount = rowcount
+        self.lastrowid = lastrowid
+        self.description = description
+        return True
+
+    def execute(self, query, args=None):
+        if isinstance(query, unicode):
+            query = query.encode(self.connection.character_set_name())
+        if args is not None:
+            query = query % self.connection.literal(args)
+        if self.connection.multi_statements:
+            self._results = [q for q in query.split(';\n') if q.strip()]
+        else:
+            self._results = [query]
+        self._next_result()
+        return self.rowcount
+
+    def executemany(self, query, args):
+        rowcount = 0
+        for _args in args:
+            rowcount += self.execute(query, _args)
+        self.rowcount = rowcount
+        return rowcount
+
+    def nextset(self):
+        return self._next_result()
+
+    def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        row = self._rows[self._pos]
+        self._pos += 1
+        return row
+
+    def fetchmany(self, size=None):
+        end = self._pos + (size or self.arraysize)
+        rows = self._rows[self._pos:end]
+        self._pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def close(self):
+        self._reset()
+        self._results = []
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+
+class SSCursor(Cursor):
+
+    '''Stands for MySQLdb.cursors.SSCursor, rows are still fetched from
+    SQLite at once'''
+
+
+connect = Connect = Connection
@@ -24,6 +24,9 @@ farms = {
         'port': 3306,
         'dbs': ['luz_farm'],
         'online': True,
+        # optional, bump it when tables are added or dropped, so that
+        # tables cached by --cache-file are discovered again
+        'schema_version': 1,
     },
 }
 
@@ -37,13 +40,15 @@ configs = {
 """
 
 import imp
+import os
 import sys
+import time
 import pprint
 import json
 import argparse
 from StringIO import StringIO
 
-from douban.sqlstore import SqlFarm
+from douban.sqlstore import SqlFarm, parallel_map, PARALLEL_POOL_SIZE
 
 verbose = False
 
@@ -57,12 +62,64 @@ class DuplicatedTable(Exception):
                 ','.join(self.farms)
 
 class FarmManager(object):
-    def __init__(self, config):
+    def __init__(self, config, cache_file=None, cache_ttl=0,
+                 jobs=PARALLEL_POOL_SIZE):
         if isinstance(config, basestring):
             config = imp.load_source('sqlstore_settings', config)
         self._default_params = config.default_params
         self.farms = config.farms
         self.configs = config.configs
+        # farm -> tables or exception, memoized within a run
+        self._tables = {}
+        self._queried = set()
+        self.cache_file = cache_file
+        self.cache_ttl = cache_ttl
+        # number of farms queried concurrently
+        self.jobs = jobs
+        self._disk_cache = self.load_cache()
+
+    def load_cache(self):
+        """On-disk cache of discovered tables: {farm: {'version': ...,
+        'time': ..., 'tables': [...]}}, an entry is valid if 'version' equals
+        the 'schema_version' of the farm in settings, or if the farm has no
+        'schema_version' and the entry is younger than cache_ttl seconds.
+        """
+
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except Exception, exc:
+            print >>sys.stderr, 'Read cache "%s" fail: %s' % (self.cache_file,
+                                                             exc)
+            return {}
+
+    def save_cache(self):
+        if not self.cache_file:
+            return
+        now = time.time()
+        for farm in self._queried:
+            tables = self._tables.get(farm)
+            if isinstance(tables, list):
+                version = self.farms.get(farm, {}).get('schema_version')
+                self._disk_cache[farm] = {'version': version,
+                                          'time': now,
+                                          'tables': tables}
+        with open(self.cache_file, 'w') as f:
+            json.dump(self._disk_cache, f, indent=4, sort_keys=True)
+
+    def get_cached_tables(self, farm):
+        entry = self._disk_cache.get(farm)
+        if not entry:
+            return None
+        version = self.farms.get(farm, {}).get('schema_version')
+        if version is not None:
+            valid = entry.get('version') == version
+        else:
+            valid = entry.get('version') is None and \
+                time.time() - entry.get('time', 0) < self.cache_ttl
+        return [str(t) for t in entry['tables']] if valid else None
 
     def get_conf(self, instance):
         """Get MySQLdb compatible config
@@ -112,15 +169,40 @@ class FarmManager(object):
     def get_tables(self, farm):
         tables = self.farms.get(farm, {}).get('tables')
         if tables:
+            return list(tables)
+
+        if farm not in self._tables:
+            self.discover_tables([farm])
+        tables = self._tables[farm]
+        if isinstance(tables, Exception):
+            raise tables
+        return list(tables)
+
+    def query_tables(self, farm):
+        tables = self.get_cached_tables(farm)
+        if tables is not None:
             return tables
 
         dbcnf = self.get_sqlstore_dbcnf('%s_m' % farm)
-        farm = SqlFarm(dbcnf, connect_timeout=1)
-        cursor = farm.get_cursor()
-        cursor.execute('show tables')
-        tables = [r[0] for r in cursor.fetchall()]
+        sqlfarm = SqlFarm(dbcnf, connect_timeout=1)
+        try:
+            cursor = sqlfarm.get_cursor()
+            cursor.execute('show tables')
+            tables = [r[0] for r in cursor.fetchall()]
+        finally:
+            sqlfarm.close()
+        self._queried.add(farm)
         return tables
 
+    def discover_tables(self, farms):
+        """Discover tables of farms concurrently, results are memoized"""
+
+        farms = sorted(set(f for f in farms if f not in self._tables and
+                           not self.farms.get(f, {}).get('tables')))
+        results = parallel_map(self.query_tables, farms, pool_size=self.jobs)
+        for farm, (tables, exc) in zip(farms, results):
+            self._tables[farm] = exc if exc is not None else tables
+
     def get_sqlstore_dbcnf(self, instance):
         conf = self.get_conf(instance)
         return '%(host)s:%(port)d:%(db)s:%(user)s:%(passwd)s' % conf if conf else ''
@@ -182,11 +264,27 @@ class FarmManager(object):
         conf.update(extras)
         return conf
 
+def get_farm_name(instance):
+    try:
+        name, _ = instance.rsplit('_', 1)
+    except ValueError:
+        name = instance
+    return name
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config',
                         default='/etc/sqlstore/settings.py')
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--cache-file',
+                        help='on-disk cache of discovered tables')
+    parser.add_argument('--cache-ttl', type=int, default=0,
+                        help='seconds to trust cached tables of farms '
+                             'without "schema_version" in settings')
+    parser.add_argument('-j', '--jobs', type=int, default=PARALLEL_POOL_SIZE,
+                        help='number of farms queried concurrently '
+                             '(default: %(default)s)')
     args = parser.parse_args()
 
     global verbose
@@ -198,7 +296,11 @@ def main():
         print >>sys.stderr, 'Read config "%s" "fail: %s' % (args.config, exc)
         return 1
 
-    fm = FarmManager(config)
+    fm = FarmManager(config, cache_file=args.cache_file,
+                     cache_ttl=args.cache_ttl, jobs=args.jobs)
+    fm.discover_tables(get_farm_name(instance)
+                       for options in fm.configs.values()
+                       for instance in options['instances'])
     skipped = 0
     for output_filename, options in fm.configs.items():
         if verbose:
@@ -223,6 +325,7 @@ def main():
                 cf.write(output.getvalue())
         elif _format == 'json':
             json.dump(config, open(output_filename, 'w'), indent=4)
+    fm.save_cache()
     return skipped
 
 if __name__ == '__main__':
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''sqlstore-replay: replay a captured workload against a sqlstore config
+
+Capture a workload with store.start_capture(path) / store.stop_capture(),
+then replay it:
+
+    sqlstore-replay -c shire-offline --speed 2 -j 16 capture.jsonl.gz
+
+Statements are routed by their tables and shard keys in the target config
+(falling back to the captured farm name), so farm moves can be validated. The latency of
+each fingerprint (md5 of the statement without arguments) is compared with
+the captured one and reported as JSON. Statements are dispatched in the
+captured order, but with more than one thread they may complete out of
+order. Writes are rolled back unless --commit is given.
+'''
+
+import argparse
+import json
+import sys
+import threading
+import time
+import Queue
+from hashlib import md5
+
+from douban.sqlstore import store_from_config
+from douban.sqlstore.capture import read_capture
+
+
+class FingerprintStats(object):
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.count = 0
+        self.errors = 0
+        self.captured = 0.0
+        self.replayed = 0.0
+
+    def add(self, captured, replayed, ok):
+        self.count += 1
+        self.captured += captured
+        self.replayed += replayed
+        if not ok:
+            self.errors += 1
+
+    def report(self):
+        captured = self.captured / self.count * 1000
+        replayed = self.replayed / self.count * 1000
+        return {
+            'sql': self.sql,
+            'count': self.count,
+            'errors': self.errors,
+            'captured_ms': round(captured, 4),
+            'replayed_ms': round(replayed, 4),
+            'delta_ms': round(replayed - captured, 4),
+        }
+
+
+class Replayer(object):
+
+    def __init__(self, config, speed=1.0, concurrency=1, read_only=False,
+                 commit=False):
+        self.config = config
+        self.speed = speed
+        self.concurrency = concurrency
+        self.read_only = read_only
+        self.commit = commit
+        self.queue = Queue.Queue(concurrency * 100)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.skipped = 0
+
+    def route(self, store, farm, sql, args=None):
+        '''Return (cmd, keyword arguments of store.get_cursor) of sql. A
+        statement touching several shards goes to the captured farm.'''
+
+        try:
+            cmd, tables = store.parse_execute_sql(sql)
+            farms = store.get_farms_by_sql(cmd, sql, tables, args)
+        except Exception:
+            return sql.lstrip().split(' ', 1)[0].lower(), {'farm': farm}
+        if len(farms) == 1:
+            return cmd, {'farm': farms.pop().name}
+        return cmd, {'farm': farm}
+
+    def execute(self, store, record):
+        offset, farm, sql, args, timecost, captured_ok = record
+        cmd, route = self.route(store, farm, sql, args)
+        if self.read_only and cmd != 'select':
+            with self.lock:
+                self.skipped += 1
+            return
+
+        start = time.time()
+        ok = True
+        try:
+            # connecting may fail too, count it as an error of the statement
+            cursor = store.get_cursor(**route)
+            cursor.execute(sql, args)
+            cursor.fetchall()
+            if cmd != 'select':
+                if self.commit:
+                    cursor.connection.commit()
+                else:
+                    cursor.connection.rollback()
+        except Exception:
+            ok = False
+        replayed = time.time() - start
+
+        fingerprint = md5(sql).hexdigest()
+        with self.lock:
+            stats = self.stats.get(fingerprint)
+            if stats is None:
+                stats = self.stats[fingerprint] = FingerprintStats(sql)
+            stats.add(timecost, replayed, ok or not captured_ok)
+
+    def worker(self):
+        store = store_from_config(self.config, use_cache=False)
+        try:
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    break
+                self.execute(store, record)
+        finally:
+            store.rollback_all(force=True)
+            store.close()
+
+    def run(self, records):
+        threads = [threading.Thread(target=self.worker)
+                   for _ in xrange(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        start = time.time()
+        for record in records:
+            if self.speed:
+                delay = start + record[0] / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self.queue.put(record)
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+        duration = time.time() - start
+
+        fingerprints = sorted((s.report() for s in self.stats.values()),
+                              key=lambda r: r['delta_ms'] * r['count'],
+                              reverse=True)
+        return {
+            'duration': round(duration, 4),
+            'statements': sum(r['count'] for r in fingerprints),
+            'skipped': self.skipped,
+            'fingerprints': fingerprints,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay a captured workload against a sqlstore config')
+    parser.add_argument('capture', help='capture file')
+    parser.add_argument('-c', '--config', required=True,
+                        help='target sqlstore config')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='replay speed relative to the captured timing, '
+                             '0 for as fast as possible')
+    parser.add_argument('-j', '--concurrency', type=int, default=1,
+                        help='number of threads')
+    parser.add_argument('--read-only', action='store_true',
+                        help='only replay select statements')
+    parser.add_argument('--commit', action='store_true',
+                        help='commit replayed writes instead of rolling '
+                             'them back')
+    args = parser.parse_args(argv)
+
+    header, records = read_capture(args.capture)
+    replayer = Replayer(args.config, speed=args.speed,
+                        concurrency=args.concurrency,
+                        read_only=args.read_only, commit=args.commit)
+    report = replayer.run(records)
+    report['capture'] = header
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
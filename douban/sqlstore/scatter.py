@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Merge the results of a SELECT executed on several farms
+
+ScatterQuery parses the parts of a SELECT which have to be applied again
+on the merged results:
+
+  * ORDER BY: the sorted results of the farms are merged with a k-way
+    heap merge.
+  * LIMIT: each farm is queried with "LIMIT offset + count", the offset
+    and count are applied on the merged results. Placeholders of LIMIT are
+    replaced by their arguments.
+  * COUNT/SUM/MIN/MAX: if every column of the select list is one of these
+    aggregations or a GROUP BY column, the rows of the farms are combined
+    by group.
+  * GROUP BY without aggregations and DISTINCT: the same rows of different
+    farms are merged into one.
+'''
+
+import heapq
+import re
+
+AGGREGATES = ('count', 'sum', 'min', 'max')
+
+re_aggregate = re.compile(r'^(?P<func>count|sum|min|max)\s*\((?P<arg>.*)\)'
+                          r'(\s+(as\s+)?`?\w+`?)?$', re.I | re.S)
+re_any_aggregate = re.compile(r'\b(count|sum|min|max|avg|std|stddev|'
+                              r'variance|var_pop|var_samp|group_concat|'
+                              r'bit_and|bit_or|bit_xor)\s*\(', re.I)
+re_distinct = re.compile(r'^\s*distinct\b', re.I)
+re_select = re.compile(r'^\s*select\s+((all|distinct|distinctrow|'
+                       r'high_priority|straight_join|sql_\w+)\s+)*', re.I)
+re_from = re.compile(r'\sfrom\s', re.I)
+re_group_by = re.compile(r'\sgroup\s+by\s', re.I)
+re_order_by = re.compile(r'\sorder\s+by\s', re.I)
+LIMIT_VALUE = r'(\d+|%s|%\(\w+\)s)'
+re_limit = re.compile(r'\slimit\s+{0}(?:\s*,\s*{0}|\s+offset\s+{0})?\s*$'
+                      .format(LIMIT_VALUE), re.I)
+re_distinct_select = re.compile(r'\bdistinct(row)?\b', re.I)
+re_direction = re.compile(r'\s+(asc|desc)\s*$', re.I)
+
+
+def mask(sql):
+    '''Return sql with quoted strings and the content of parentheses
+    replaced by "_", so that only top level keywords are matched'''
+
+    chars = []
+    depth = 0
+    quote = None
+    escaped = False
+    for c in sql:
+        if quote:
+            chars.append('_')
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == quote:
+                quote = None
+            continue
+        if c in '\'"`':
+            quote = c
+            chars.append('_')
+        elif c == '(':
+            depth += 1
+            chars.append(c if depth == 1 else '_')
+        elif c == ')':
+            depth -= 1
+            chars.append(c if depth == 0 else '_')
+        else:
+            chars.append('_' if depth else c)
+    return ''.join(chars)
+
+
+def split_top_level(text, masked):
+    items = []
+    start = 0
+    for index, c in enumerate(masked):
+        if c == ',':
+            items.append(text[start:index].strip())
+            start = index + 1
+    items.append(text[start:].strip())
+    return items
+
+
+class Descending(object):
+
+    '''Reverse the ordering of a value in sort keys'''
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+
+def combine(func, a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if func in ('count', 'sum'):
+        return a + b
+    if func == 'min':
+        return min(a, b)
+    return max(a, b)
+
+
+class ScatterQuery(object):
+
+    '''A SELECT executed on several farms, `args` are the arguments of the
+    statement executed on each farm'''
+
+    def __init__(self, sql, args=None):
+        self.sql = sql.strip()
+        self.args = args
+        masked = mask(self.sql)
+
+        self.offset = 0
+        self.limit = None
+        match = re_limit.search(masked)
+        if match:
+            values = self.get_limit_values(match)
+            if match.group(2) is not None:
+                self.offset, self.limit = values[0], values[1]
+            else:
+                self.offset = values[2] or 0
+                self.limit = values[0]
+            self.sql = self.sql[:match.start()]
+            masked = masked[:match.start()]
+
+        self.order_by = []
+        match = self.search_last(re_order_by, masked)
+        if match:
+            clause = self.sql[match.end():]
+            for item in split_top_level(clause, masked[match.end():]):
+                direction = re_direction.search(item)
+                desc = bool(direction and direction.group(1).lower() ==
+                            'desc')
+                if direction:
+                    item = item[:direction.start()]
+                self.order_by.append((item.strip(), desc))
+
+        select = re_select.match(self.sql)
+        match = re_from.search(masked)
+        if not select or not match:
+            raise ValueError('not a select statement: %s' % sql)
+        self.columns = split_top_level(self.sql[select.end():match.start()],
+                                       masked[select.end():match.start()])
+        self.group_by = bool(self.search_last(re_group_by, masked))
+        self.distinct = bool(re_distinct_select.search(select.group(0)))
+
+        self.aggregates = None
+        if any(re_any_aggregate.search(c) for c in self.columns):
+            self.aggregates = []
+            for column in self.columns:
+                aggregate = re_aggregate.match(column)
+                if aggregate and not re_distinct.match(aggregate.group('arg')):
+                    self.aggregates.append(aggregate.group('func').lower())
+                elif re_any_aggregate.search(column):
+                    raise ValueError('aggregation can not be combined: %s' %
+                                     column)
+                else:
+                    self.aggregates.append(None)
+        elif self.group_by or self.distinct:
+            # same rows of different farms are one group
+            self.aggregates = [None] * len(self.columns)
+
+    def get_limit_values(self, match):
+        '''Return the values of the LIMIT clause, replacing placeholders by
+        the arguments, which are removed from self.args'''
+
+        texts = [None if match.group(i) is None else
+                 self.sql[match.start(i):match.end(i)] for i in (1, 2, 3)]
+        positional = [t for t in texts if t == '%s']
+        arguments = []
+        if positional:
+            args = self.args
+            if not isinstance(args, (tuple, list)):
+                args = () if args is None else (args,)
+            if len(args) < len(positional):
+                raise ValueError('not enough arguments for LIMIT')
+            self.args = tuple(args[:-len(positional)])
+            arguments = list(args[-len(positional):])
+        values = [None if t is None else
+                  arguments.pop(0) if t == '%s' else
+                  self.args[t[2:-2]] if t.startswith('%(') else t
+                  for t in texts]
+        return [None if v is None else int(v) for v in values]
+
+    @staticmethod
+    def search_last(pattern, masked):
+        matches = list(pattern.finditer(masked))
+        return matches[-1] if matches else None
+
+    @property
+    def farm_sql(self):
+        '''The statement executed on each farm'''
+
+        if self.limit is None or self.aggregates is not None:
+            return self.sql
+        return '%s limit %d' % (self.sql, self.offset + self.limit)
+
+    def get_column_index(self, expr, description):
+        if expr.isdigit():
+            return int(expr) - 1
+        names = [d[0].lower() for d in description]
+        candidates = [expr, expr.split('.')[-1].strip('`')]
+        for candidate in candidates:
+            if candidate.lower() in names:
+                return names.index(candidate.lower())
+        columns = [c.lower() for c in self.columns]
+        if expr.lower() in columns:
+            return columns.index(expr.lower())
+        raise ValueError('ORDER BY %s is not in the select list' % expr)
+
+    def get_sort_key(self, description):
+        if not self.order_by:
+            return None
+        keys = [(self.get_column_index(expr, description), desc)
+                for expr, desc in self.order_by]
+
+        def sort_key(row):
+            return tuple(Descending(row[index]) if desc else row[index]
+                         for index, desc in keys)
+        return sort_key
+
+    def combine(self, rows):
+        '''Combine aggregations of rows in the same group'''
+
+        groups = {}
+        order = []
+        # without aggregations the row is the group, also for select *
+        plain = not any(self.aggregates)
+        for row in rows:
+            if plain:
+                key = tuple(row)
+            else:
+                key = tuple(value for value, func in
+                            zip(row, self.aggregates) if func is None)
+            combined = groups.get(key)
+            if combined is None:
+                groups[key] = list(row)
+                order.append(key)
+                continue
+            for index, func in enumerate(self.aggregates):
+                if func is not None:
+                    combined[index] = combine(func, combined[index],
+                                              row[index])
+        return [tuple(groups[key]) for key in order]
+
+    def merge(self, results):
+        '''Merge [(description, rows), ...] of the farms, return a tuple of
+        rows'''
+
+        description = next((d for d, _ in results if d), None)
+        sort_key = self.get_sort_key(description) if description else None
+        if self.aggregates is not None:
+            rows = self.combine(row for _, rows in results for row in rows)
+            if sort_key:
+                rows.sort(key=sort_key)
+        elif sort_key:
+            rows = self.heap_merge([rows for _, rows in results], sort_key)
+        else:
+            rows = (row for _, rows in results for row in rows)
+
+        merged = []
+        end = None if self.limit is None else self.offset + self.limit
+        for index, row in enumerate(rows):
+            if end is not None and index >= end:
+                break
+            if index >= self.offset:
+                merged.append(row)
+        return tuple(merged)
+
+    @staticmethod
+    def heap_merge(results, sort_key):
+        '''k-way merge of sorted results'''
+
+        heap = []
+        iterators = [iter(rows) for rows in results]
+        for index, iterator in enumerate(iterators):
+            for row in iterator:
+                heap.append((sort_key(row), index, row))
+                break
+        heapq.heapify(heap)
+        while heap:
+            _, index, row = heap[0]
+            yield row
+            for next_row in iterators[index]:
+                heapq.heapreplace(heap, (sort_key(next_row), index, next_row))
+                break
+            else:
+                heapq.heappop(heap)
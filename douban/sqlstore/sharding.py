@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Key based sharding of tables across farms
+
+Sharded tables are declared in the `shards` section of the sqlstore
+config, instead of the `tables` of a farm:
+
+    'shards': {
+        'user_event': {
+            'key': 'user_id',
+            'function': 'hash',
+            'farms': ['event0_farm', 'event1_farm'],
+        },
+        'user_log': {
+            'key': 'user_id',
+            'function': 'range',
+            'ranges': [[0, 'log0_farm'], [10000000, 'log1_farm']],
+        },
+    }
+
+With the hash function, a row lives in farms[key % len(farms)] (crc32 of
+the key for non integer keys). With the range function, a row lives in
+the farm of the largest lower bound not greater than the key.
+
+The values of the shard key are extracted from the statement and its
+arguments: `key = ...`, `key in (...)` in the WHERE clause and the `key`
+column of inserted rows. Statements with OR, XOR, NOT, ! or || are not
+restricted to the shard keys they mention.
+'''
+
+import re
+import zlib
+from bisect import bisect_right
+
+import MySQLdb
+
+SHARD_FUNCTIONS = ('hash', 'range')
+
+re_token = re.compile(r'''('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.)*"|`[^`]*`'''
+                      r'''|%\(\w+\)s|%s|%%|[\w.]+|\|\||!=|\S)''')
+re_number = re.compile(r'^-?\d+$')
+
+PARAM = object()
+
+# operators after which other rows may match the statement
+NEGATIONS = ('or', 'xor', '||', 'not', '!')
+
+
+class ShardingError(MySQLdb.DatabaseError):
+    pass
+
+
+def normalize_key(value):
+    if isinstance(value, basestring) and re_number.match(value):
+        return int(value)
+    return value
+
+
+def tokenize(sql, args):
+    '''Return tokens of sql, with placeholders and literals replaced by
+    (PARAM, values) tuples'''
+
+    if args is None:
+        args = ()
+    elif not isinstance(args, (tuple, list, dict)):
+        args = (args,)
+    index = 0
+    tokens = []
+    for token in re_token.findall(sql):
+        if token == '%s' and not isinstance(args, dict):
+            value = args[index] if index < len(args) else None
+            index += 1
+        elif token.startswith('%(') and isinstance(args, dict):
+            value = args.get(token[2:-2])
+        elif token[0] in '\'"':
+            value = token[1:-1]
+        elif re_number.match(token):
+            value = int(token)
+        else:
+            tokens.append(token.strip('`').lower())
+            continue
+        if isinstance(value, (tuple, list, set, frozenset)):
+            tokens.append((PARAM, list(value)))
+        else:
+            tokens.append((PARAM, [value]))
+    return tokens
+
+
+def is_param(token):
+    return isinstance(token, tuple)
+
+
+class ShardedTable(object):
+
+    '''A table sharded across farms by the value of its `key` column'''
+
+    def __init__(self, table, key, function='hash', farms=None, ranges=None):
+        if function not in SHARD_FUNCTIONS:
+            raise ShardingError('unknown shard function of %s: %s' %
+                                (table, function))
+        self.table = table
+        self.key = key.lower()
+        self.function = function
+        if function == 'hash':
+            if not farms:
+                raise ShardingError('no farms of sharded table %s' % table)
+            self.farms = list(farms)
+        else:
+            if not ranges:
+                raise ShardingError('no ranges of sharded table %s' % table)
+            ranges = sorted(ranges)
+            self.lower_bounds = [lower for lower, _ in ranges]
+            self.farms = [farm for _, farm in ranges]
+
+    @classmethod
+    def from_config(cls, table, config):
+        return cls(table, config['key'], config.get('function', 'hash'),
+                   farms=config.get('farms'), ranges=config.get('ranges'))
+
+    def get_farm_name(self, key):
+        key = normalize_key(key)
+        if key is None:
+            raise ShardingError('shard key %s of %s is NULL' %
+                                (self.key, self.table))
+        if self.function == 'hash':
+            if isinstance(key, (int, long)):
+                index = key % len(self.farms)
+            else:
+                if isinstance(key, unicode):
+                    key = key.encode('utf8')
+                index = (zlib.crc32(str(key)) & 0xffffffff) % len(self.farms)
+            return self.farms[index]
+        index = bisect_right(self.lower_bounds, key) - 1
+        if index < 0:
+            raise ShardingError('shard key %s=%r of %s is out of range' %
+                                (self.key, key, self.table))
+        return self.farms[index]
+
+    def is_key(self, token):
+        return not is_param(token) and \
+            (token == self.key or token.endswith('.' + self.key))
+
+    def extract_keys(self, cmd, sql, args=None):
+        '''Return the values of the shard key in the statement, or None if
+        the statement is not restricted to certain keys'''
+
+        tokens = tokenize(sql, args)
+        if any(op in tokens for op in NEGATIONS):
+            # the other branch, or the negated condition, is not restricted
+            # to the shard key
+            return None
+        if cmd in ('insert', 'replace'):
+            keys = self.extract_inserted_keys(tokens)
+            if keys is not None:
+                return keys
+        elif cmd == 'update':
+            # assignments of SET are not conditions
+            if 'where' not in tokens:
+                return None
+            tokens = tokens[tokens.index('where'):]
+
+        keys = []
+        for i, token in enumerate(tokens):
+            if not self.is_key(token) or i + 2 >= len(tokens):
+                continue
+            if tokens[i + 1] == '=' and is_param(tokens[i + 2]):
+                keys.extend(tokens[i + 2][1])
+            elif tokens[i + 1] == 'in':
+                values = self.extract_list(tokens, i + 2)
+                if values is not None:
+                    keys.extend(values)
+        return keys or None
+
+    def extract_list(self, tokens, start):
+        '''Return the values of "(v1, v2, ...)" or "%s" at tokens[start]'''
+
+        if is_param(tokens[start]):
+            return tokens[start][1]
+        if tokens[start] != '(':
+            return None
+        values = []
+        for token in tokens[start + 1:]:
+            if token == ')':
+                return values
+            elif is_param(token):
+                values.extend(token[1])
+            elif token != ',':
+                # sub query or expression
+                return None
+        return None
+
+    def extract_inserted_keys(self, tokens):
+        try:
+            start = tokens.index('(')
+            end = tokens.index(')', start)
+        except ValueError:
+            return None
+        columns = [t for t in tokens[start + 1:end] if t != ',']
+        if self.key not in columns or 'values' not in tokens[end:]:
+            return None
+        position = columns.index(self.key)
+
+        keys = []
+        depth = 0
+        row = []
+        for token in tokens[tokens.index('values', end) + 1:]:
+            if token == '(':
+                depth += 1
+                if depth == 1:
+                    row = [[]]
+                    continue
+            elif token == ')':
+                depth -= 1
+                if depth == 0:
+                    value = row[position] if position < len(row) else []
+                    if len(value) != 1 or not is_param(value[0]):
+                        return None
+                    keys.extend(value[0][1])
+                    continue
+            elif depth == 0:
+                if token == ',':
+                    continue
+                # on duplicate key update ...
+                break
+            if depth == 1 and token == ',':
+                row.append([])
+            elif depth >= 1:
+                row[-1].append(token)
+        return keys or None
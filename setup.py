@@ -19,6 +19,9 @@ PACKAGES = find_packages(exclude=['tests.*',
                                   'examples.*',
                                   'examples'])
 ENTRY_POINTS = """
+[console_scripts]
+sqlstore-bench = douban.sqlstore.bench:main
+sqlstore-replay = douban.sqlstore.replay:main
 """
 
 # dependencies
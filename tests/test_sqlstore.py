@@ -1,5 +1,6 @@
 # encoding=utf8
 
+import copy
 import os
 import pwd
 import tempfile
@@ -64,6 +65,44 @@ class ModuleTest(TestCase):
         store2 = M.store_from_config(self.database, use_cache=False)
         ok_(store1 is not store2, 'store1 and store2 are same')
 
+    def test_store_from_config_should_evict_least_recently_used(self):
+        cache = M.StoreCache(maxsize=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        eq_(cache.get('a'), 1)
+        cache['c'] = 3
+        ok_('a' in cache)
+        ok_('b' not in cache)
+        eq_(len(cache), 2)
+
+    def test_store_from_config_should_key_dicts_by_content(self):
+        key1 = M.get_cache_key(self.database, {})
+        key2 = M.get_cache_key(copy.deepcopy(self.database), {})
+        eq_(key1, key2)
+        ok_(M.get_cache_key(self.database, {'a': 1}) != key1)
+        database = copy.deepcopy(self.database)
+        database['options'] = {'logging': True}
+        ok_(M.get_cache_key(database, {}) != key1)
+        ok_(M.get_cache_key([], {}) is None)
+
+    def test_dict_config_should_be_digested_once_per_version(self):
+        database = copy.deepcopy(self.database)
+        key = M.get_cache_key(database, {})
+        with patch.object(M, 'config_digest') as config_digest:
+            eq_(M.get_cache_key(database, {}), key)
+            eq_(config_digest.call_count, 0)
+            database['version'] = 2
+            M.get_cache_key(database, {})
+            eq_(config_digest.call_count, 1)
+
+    def test_rollback_all_should_be_noop_when_not_dirty(self):
+        store = self.prepare_store()
+        ok_(not store.is_dirty())
+        store.execute("update test_table1 set id=id where id=1")
+        ok_(store.is_dirty())
+        store.rollback_all()
+        ok_(not store.is_dirty())
+
     def prepare_store(self, use_cache=False, created_via='test_sqlstore',
                       **kwargs):
         return M.store_from_config(self.database, use_cache=use_cache,
@@ -107,6 +146,46 @@ class ModuleTest(TestCase):
         store.transaction_begin()
         store.transaction_end()
 
+    def test_xa_transaction(self):
+        store = self.prepare_store()
+
+        store.transaction_begin(xa=True)
+        store.execute("update test_table1 set id=id where id=1")
+        store.execute("update test_table2 set id=id where id=1")
+        eq_(len(store.xa_cursors), 2)
+        store.commit()
+        ok_(store.xa_gtrid is None)
+        eq_(len(store.modified_cursors), 0)
+
+        store.transaction_begin(xa=True)
+        store.execute("update test_table1 set id=id where id=1")
+        store.rollback()
+        eq_(store.xa_recover(older_than=0), {})
+
+    def test_pipeline(self):
+        database = dict(self.database, options={'multi_statements': True})
+        store = M.store_from_config(database, use_cache=False)
+        with store.pipeline() as p:
+            r1 = p.execute("select id from test_table1 where id=%s", 1)
+            r2 = p.execute("update test_table1 set id=id where id=1")
+            r3 = p.execute("select id from test_table2 where id=%s", (1,))
+            self.assertRaises(Exception, lambda: r1.value)
+        ok_(isinstance(r1.value, tuple))
+        ok_(isinstance(r3.value, tuple))
+        eq_(r2.value, 0)
+        eq_(len(store.modified_cursors), 1)
+        store.rollback_all()
+
+    def test_pipeline_should_check_each_statement(self):
+        store = self.prepare_store()
+        p = store.pipeline()
+        r1 = p.execute("select id from test_table1 where id=1")
+        r2 = p.execute("delete from test_table1")
+        self.assertRaises(Exception, p.flush)
+        # statements are executed one by one, only the failing one fails
+        ok_(isinstance(r1.value, tuple))
+        self.assertRaises(Exception, lambda: r2.value)
+
     def test_modified_cursor(self):
         store = self.prepare_store()
         # test_table1 is in farm1
@@ -121,6 +200,48 @@ class ModuleTest(TestCase):
         store.rollback_all()
         eq_(len(store.modified_cursors), 0)
 
+    def test_share_connections_between_stores(self):
+        database = dict(self.database, options={'share_connections': True})
+        store1 = M.store_from_config(database, use_cache=False)
+        store2 = M.store_from_config(dict(database), use_cache=False)
+        cursor1 = store1.get_cursor(table='test_table1')
+        cursor2 = store2.get_cursor(table='test_table1')
+        ok_(cursor1 is not cursor2)
+        ok_(cursor1.connection is cursor2.connection)
+
+        store1.execute("update test_table1 set id=id where id=1")
+        eq_(len(store1.modified_cursors), 1)
+        eq_(len(store2.modified_cursors), 0)
+        store1.rollback_all()
+
+        store1.close()
+        ok_(cursor2.connection.open)
+        store2.close()
+        ok_(not cursor2.connection.open)
+
+    def test_warnings_should_be_fetched_only_when_counted(self):
+        store = self.prepare_store()
+        cursor = store.get_cursor(table='test_table1')
+        with patch.object(cursor, 'cursor') as raw:
+            raw._warnings = 0
+            eq_(cursor._get_warnings(), [])
+            ok_(not raw.connection.cursor.called)
+
+            warning = ('Warning', 1265, "Data truncated for column 'name'")
+            raw._warnings = 1
+            raw.messages = [(MySQLdb.Warning, warning)]
+            eq_(cursor._get_warnings(), [warning])
+
+    def test_treat_warning_as_error(self):
+        store = self.prepare_store()
+        store.treat_warning_as_error = True
+        cursor = store.get_cursor(table='test_table1')
+        warning = ('Warning', 1265, "Data truncated for column 'name'")
+        with patch.object(M.LuzCursor, '_get_warnings',
+                          return_value=[warning]):
+            self.assertRaises(M.InvalidMySQLDataException, cursor.execute,
+                              "select * from test_table1 limit 1")
+
     def test_sqlstore_should_not_allow_unsafe_use(self):
         os.environ['DAE_WORKER'] = 'async'
         with catch_warnings(record=True) as w:
@@ -166,6 +287,21 @@ class LogTest(TestCase):
         ok_(mock.send.called, 'Does not use scribeclient')
         douban.utils.slog.scribeclient = temp
 
+    def test_log_buffer_should_aggregate_messages(self):
+        writer = Mock()
+        buf = M.LogBuffer(interval=3600, maxsize=2)
+        buf.log(writer, 'message1')
+        buf.log(writer, 'message1')
+        buf.log(writer, 'message2')
+        buf.log(writer, 'message3')
+        eq_(buf.dropped, 1)
+        ok_(not writer.called)
+        with patch.object(M, 'slog') as slog:
+            buf.flush()
+            slog.assert_called_once_with('LOG_BUFFER_DROPPED 1')
+        eq_([c[0][0] for c in writer.call_args_list],
+            ['message1 (repeated 2 times)', 'message2'])
+
 
 class TestSqlStoreConfigLoad(TestCase):
 
@@ -232,6 +368,29 @@ class TestSqlStoreConfigLoad(TestCase):
         eq_(_store_2.db_config_name, 'test-offline')
         eq_(store.get_farm('farm1').dbcnf['db'], 'test_sqlstore1')
 
+    def test_unpickled_stores_should_share_farms(self):
+        import pickle
+        store = M.store_from_config('test-online', use_cache=False)
+        buf = pickle.dumps(store)
+        ok_('farm1' not in buf, 'farms should not be pickled')
+        _store1 = pickle.loads(buf)
+        _store2 = pickle.loads(buf)
+        ok_(_store1 is _store2)
+        ok_(_store1.get_farm('farm1') is _store2.get_farm('farm1'))
+
+    def test_pickle_should_apply_override_once(self):
+        import pickle
+        M.replace_sqlstore_config('test-online', 'test-offline')
+        M.replace_sqlstore_config('test-offline', 'test-other')
+        try:
+            store = M.store_from_config('test-online', use_cache=False)
+            eq_(store.db_config_name, 'test-offline')
+            with patch.object(M, 'store_from_config') as store_from_config:
+                pickle.loads(pickle.dumps(store))
+            eq_(store_from_config.call_args[0][0], 'test-online')
+        finally:
+            del M.os.environ['SQLSTORE_CONFIG_OVERRIDE']
+
 
 class SentryTest(TestCase):
     database = {
@@ -261,6 +420,34 @@ class SentryTest(TestCase):
         },
     }
 
+    def test_sentry_reports_should_be_rate_limited(self):
+        client = Mock()
+        reporter = M.SentryReporter()
+        key = ('OperationalError', 'farm1')
+        ok_(reporter.report(client, key, 'msg', [], {}, 60))
+        ok_(not reporter.report(client, key, 'msg', [], {}, 60))
+        ok_(reporter.report(client, ('OperationalError', 'farm2'), 'msg',
+                            [], {}, 60))
+        # stores with another client
+        other = Mock()
+        ok_(reporter.report(other, key, 'msg', [], {}, 60))
+        reporter.flush()
+        eq_(client.captureMessage.call_count, 2)
+        eq_(other.captureMessage.call_count, 1)
+
+    def test_send_exception_should_not_block(self):
+        store = M.store_from_config(self.database, use_cache=False)
+        ok_(store.raven_client)
+        store.raven_client = Mock()
+        farm = store.get_farm('farm1')
+        store.send_exception_to_onimaru(Exception('test'), farm)
+        M.sentry_reporter.flush()
+        message, = store.raven_client.captureMessage.call_args[0]
+        eq_(message, 'Exception: test')
+
+        store = M.store_from_config(self.database_no_sentry, use_cache=False)
+        ok_(store.raven_client is None)
+
 
 class ConfigPushTest(TestCase):
     database = {
@@ -0,0 +1,75 @@
+# encoding=utf8
+
+import json
+from StringIO import StringIO
+from unittest import TestCase
+
+from mock import patch
+from nose.tools import eq_, ok_
+
+from douban.sqlstore import bench, fakedb
+
+
+class BenchTest(TestCase):
+
+    def tearDown(self):
+        fakedb.reset()
+
+    def test_fake_run_should_report_json(self):
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            eq_(bench.main(['--fake', '-n', '5', '-j', '2', '--warmup', '1',
+                            'point_select', 'transaction']), 0)
+        results = json.loads(stdout.getvalue())
+        eq_([r['scenario'] for r in results], ['point_select', 'transaction'])
+        for result in results:
+            eq_(result['requests'], 10)
+            eq_(result['errors'], 0)
+            ok_(result['latency_ms']['p50'] > 0)
+
+    def test_wide_select_should_report_rows(self):
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            eq_(bench.main(['--fake', '-n', '3', '--warmup', '0',
+                            '--wide-rows', '10', 'wide_select',
+                            'wide_select_raw', 'wide_select_columns']), 0)
+        results = json.loads(stdout.getvalue())
+        for result in results:
+            eq_(result['errors'], 0)
+            eq_(result['rows'], 30)
+            ok_(result['rows_per_sec'] > 0)
+
+    def test_errors_should_be_reported(self):
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            eq_(bench.main(['--fake', '-n', '3', '-j', '2', '--warmup', '0',
+                            '-t', 'no_such_table', 'point_select']), 0)
+        result, = json.loads(stdout.getvalue())
+        eq_(result['errors'], 6)
+        ok_('no_such_table' in result['first_error'])
+
+    def test_default_scenarios(self):
+        eq_(bench.parse_args(['--fake']).scenarios, sorted(bench.SCENARIOS))
+        ok_(not [name for name in bench.parse_args(['-c', 'test']).scenarios
+                 if name.startswith('wide_select')])
+
+    def test_seed_should_be_reproducible_per_thread(self):
+        args = bench.parse_args(['--fake', '--seed', '1', '-n', '5', '-j',
+                                 '3', '--warmup', '0'])
+        config = bench.prepare_fake()
+
+        def run():
+            scenarios = []
+
+            def scenario(store, args, rand):
+                s = bench.PointSelect(store, args, rand)
+                s.ids = []
+                s.run = lambda: s.ids.append(s.random_id())
+                scenarios.append(s)
+                return s
+
+            with patch.dict(bench.SCENARIOS, point_select=scenario):
+                bench.run_scenario('point_select', config, args)
+            return sorted(s.ids for s in scenarios)
+
+        ids = run()
+        eq_(len(ids), 3)
+        eq_(run(), ids)
+        ok_(ids[0] != ids[1])
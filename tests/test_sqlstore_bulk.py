@@ -0,0 +1,105 @@
+# encoding=utf8
+
+import os
+import tempfile
+from StringIO import StringIO
+from unittest import TestCase
+
+from nose.tools import eq_
+
+import douban.sqlstore as M
+from douban.sqlstore import fakedb
+from douban.sqlstore.bulk import format_rows, load_statement
+
+
+class FormatTest(TestCase):
+
+    def test_format_rows(self):
+        rows = [(1, 'a\tb\\c\nd', None), (2L, u'中', 0.5)]
+        eq_(format_rows(rows, 'tsv'),
+            '1\ta\\tb\\\\c\\nd\t\\N\n2\t中\t0.5\n')
+        eq_(format_rows(rows, 'csv'),
+            '1,"a\tb\\c\nd",NULL\n2,"中",0.5\n')
+        eq_(format_rows([('NULL', '', 'a"b')], 'csv'), '"NULL","","a""b"\n')
+
+    def test_load_statement(self):
+        eq_(load_statement('t', 'tsv', ['a', 'b'], 'replace'),
+            'load data local infile %s replace into table `t` character set '
+            'utf8 (`a`, `b`)')
+        self.assertRaises(ValueError, load_statement, 't', 'tsv',
+                          duplicate='update')
+
+
+class BulkTest(TestCase):
+    database = {
+        'farms': {
+            "farm1": {
+                "master": "fake1:3306:test_sqlstore1:sqlstore:sqlstore",
+                "tables": ["*"],
+                "driver_options": {"local_infile": 1},
+            },
+        },
+        'options': {
+            'driver': 'fake',
+        },
+    }
+
+    def setUp(self):
+        fakedb.execute_script('test_sqlstore1', 'create table test_table1 '
+                              '(id integer primary key, name varchar(10), '
+                              'memo varchar(10))', host='fake1')
+        self.store = M.store_from_config(self.database, use_cache=False)
+        for i in range(1, 6):
+            self.store.execute('insert into test_table1 values (%s, %s, %s)',
+                               (i, 'name\t%d' % i, None if i % 2 else 'x'))
+        self.store.commit()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        self.store.close()
+        fakedb.reset()
+        os.remove(self.path)
+
+    def test_export_and_load(self):
+        store = self.store
+        progress = []
+        with open(self.path, 'wb') as f:
+            eq_(store.export_table('test_table1', f, where='id > %s', args=1,
+                                   batch_size=2,
+                                   progress=lambda *a: progress.append(a)),
+                4)
+        eq_([rows for rows, _ in progress], [2, 4])
+        eq_(progress[-1][1], os.path.getsize(self.path))
+
+        store.execute('delete from test_table1 where id > 1')
+        progress = []
+        eq_(store.load_file('test_table1', self.path, chunk_size=10,
+                            progress=lambda *a: progress.append(a)), 4)
+        store.commit()
+        eq_(progress[-1], (4, os.path.getsize(self.path)))
+        rows = store.execute('select id, name, memo from test_table1 '
+                             'order by id')
+        eq_(rows, ((1, 'name\t1', None), (2, 'name\t2', 'x'),
+                   (3, 'name\t3', None), (4, 'name\t4', 'x'),
+                   (5, 'name\t5', None)))
+
+        eq_(store.load_file('test_table1', self.path, duplicate='ignore'), 0)
+        store.rollback()
+
+    def test_csv(self):
+        store = self.store
+        out = StringIO()
+        eq_(store.export_table('test_table1', out, format='csv',
+                               columns=['id', 'memo'], where='id < 3'), 2)
+        eq_(out.getvalue(), '"1",NULL\n"2","x"\n')
+        with open(self.path, 'wb') as f:
+            f.write('6,y\n7,"z,"\n8,NULL\n9,"NULL"\n10,""\n')
+        eq_(store.load_file('test_table1', self.path, ['id', 'memo'],
+                            format='csv'), 5)
+        eq_(store.execute('select memo from test_table1 where id > 5 '
+                          'order by id'),
+            (('y',), ('z,',), (None,), ('NULL',), ('',)))
+        self.assertRaises(ValueError, store.load_file, 'test_table1',
+                          self.path, format='csv', chunk_size=10)
+        store.rollback()
@@ -0,0 +1,109 @@
+# encoding=utf8
+
+import math
+from decimal import Decimal
+from unittest import TestCase
+
+from nose.tools import eq_, ok_
+from mock import patch
+
+import douban.sqlstore as M
+from douban.sqlstore import columns, fakedb
+from douban.sqlstore.columns import ColumnBuilder
+
+
+DESCRIPTION = (('id', 8), ('score', 246), ('name', 253))
+
+
+class ColumnBuilderTest(TestCase):
+
+    def test_array(self):
+        builder = ColumnBuilder(DESCRIPTION, {'score': 'float32'},
+                                use_numpy=False)
+        builder.append([(1, Decimal('0.5'), 'a'), (2, None, None)])
+        builder.append([(None, 1, 'c')])
+        result = builder.result()
+        eq_(result.names, ['id', 'score', 'name'])
+        eq_(len(result), 3)
+        eq_(result['id'].typecode, 'l')
+        eq_(list(result['id']), [1, 2, 0])
+        eq_(list(result.masks['id']), [0, 0, 1])
+        eq_(result['score'].typecode, 'f')
+        eq_(result['score'][0], 0.5)
+        ok_(math.isnan(result['score'][1]))
+        eq_(list(result.masks['score']), [0, 1, 0])
+        eq_(result['name'], ['a', None, 'c'])
+
+    def test_numpy(self):
+        if columns.numpy is None:
+            return
+        builder = ColumnBuilder(DESCRIPTION, ['int32', 'float64', 'object'])
+        builder.append([(1, 0.5, 'a'), (None, None, 'b')])
+        result = builder.result()
+        eq_(result['id'].dtype, columns.numpy.int32)
+        eq_(result['id'].tolist(), [1, 0])
+        eq_(result.masks['score'].tolist(), [False, True])
+        eq_(result['name'].tolist(), ['a', 'b'])
+
+    def test_unsigned_columns(self):
+        flags = (columns.UNSIGNED_FLAG, 0, 0)
+        builder = ColumnBuilder(DESCRIPTION, use_numpy=False, flags=flags)
+        builder.append([(2 ** 64 - 1, 0.5, 'a')])
+        result = builder.result()
+        eq_(result['id'].typecode, 'L')
+        eq_(list(result['id']), [2 ** 64 - 1])
+        eq_(ColumnBuilder(DESCRIPTION, use_numpy=False).columns[0].dtype,
+            'int64')
+
+    def test_invalid_dtypes(self):
+        self.assertRaises(ValueError, ColumnBuilder, DESCRIPTION,
+                          {'no_such_column': 'int64'})
+        self.assertRaises(ValueError, ColumnBuilder, DESCRIPTION, ['int64'])
+        self.assertRaises(ValueError, ColumnBuilder, DESCRIPTION,
+                          {'id': 'complex'})
+
+
+class QueryColumnsTest(TestCase):
+    database = {
+        'farms': {
+            "farm1": {
+                "master": "fake1:3306:test_sqlstore1:sqlstore:sqlstore",
+                "tables": ["*"],
+            },
+        },
+        'options': {
+            'driver': 'fake',
+        },
+    }
+
+    def setUp(self):
+        fakedb.execute_script('test_sqlstore1', 'create table test_table1 '
+                              '(id integer primary key, score real, '
+                              'name varchar(10))', host='fake1')
+        self.store = M.store_from_config(self.database, use_cache=False)
+        for i in range(5):
+            self.store.execute('insert into test_table1 values (%s, %s, %s)',
+                               (i, i * 0.5 if i % 2 else None, str(i)))
+        self.store.commit()
+
+    def tearDown(self):
+        self.store.close()
+        fakedb.reset()
+
+    @patch.object(columns, 'numpy', None)
+    def test_query_columns(self):
+        store = self.store
+        result = store.query_columns('select id, score, name from test_table1 '
+                                     'where id > %s order by id', 0,
+                                     dtypes=['int32', 'float64', 'object'],
+                                     batch_size=2)
+        eq_(len(result), 4)
+        eq_(list(result['id']), [1, 2, 3, 4])
+        eq_(list(result.masks['score']), [0, 1, 0, 1])
+        eq_(result['name'], ['1', '2', '3', '4'])
+
+        cursor = store.get_cursor(table='test_table1')
+        ok_(not isinstance(cursor.cursor, fakedb.SSCursor))
+        eq_(store.execute('select count(*) from test_table1'), ((5,),))
+        self.assertRaises(ValueError, store.query_columns,
+                          'delete from test_table1 where id=1')
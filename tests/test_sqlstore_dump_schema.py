@@ -0,0 +1,132 @@
+# encoding=utf8
+
+import os
+import pickle
+import re
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+
+import douban.sqlstore as M
+from douban.sqlstore import dump_schema, fakedb
+
+
+class TableVersionsTest(TestCase):
+
+    def get_versions(self, checksums, error=None,
+                     error_sql=dump_schema.CHECKS_SQL):
+        results = {
+            dump_schema.TABLES_SQL: [('t1', 'BASE TABLE', 'ctime', 'InnoDB',
+                                      'utf8', '', '', 10),
+                                     ('t2', 'BASE TABLE', 'ctime', 'InnoDB',
+                                      'utf8', '', '', 20),
+                                     ('v1', 'VIEW', None, None, None, None,
+                                      'VIEW', None)],
+        }
+        results.update(checksums)
+        cursor = Mock()
+
+        def execute(sql):
+            if sql is error_sql and error:
+                raise error
+            cursor.fetchall.return_value = results.get(sql, [])
+
+        cursor.execute.side_effect = execute
+        return dump_schema.get_table_versions(cursor)
+
+    def test_get_table_versions(self):
+        versions = self.get_versions({
+            dump_schema.COLUMNS_SQL: [('t1', 'c1'), ('t2', 'c2')],
+            dump_schema.FOREIGN_KEYS_SQL: [('t2', 'fk')],
+            dump_schema.VIEWS_SQL: [('v1', 'view')],
+        })
+        eq_(versions['t1'], ('BASE TABLE', 'ctime', 'InnoDB', 'utf8', '', '',
+                             'c1', '', '', '', '', ''))
+        eq_(versions['t2'][-6:], ('c2', '', 'fk', '', '', ''))
+        ok_(dump_schema.is_view(versions['v1']))
+        eq_(versions['v1'][-2], 'view')
+
+        for sql in (dump_schema.FOREIGN_KEYS_SQL, dump_schema.PARTITIONS_SQL,
+                    dump_schema.CHECKS_SQL):
+            changed = self.get_versions({sql: [('t1', 'changed')]})
+            ok_(changed['t1'] != versions['t1'])
+
+        # servers without CHECK_CONSTRAINTS
+        error = M.MySQLdb.OperationalError(1109, 'Unknown table')
+        eq_(self.get_versions({}, error)['t1'][-1], '')
+        self.assertRaises(M.MySQLdb.OperationalError, self.get_versions,
+                          {}, error, dump_schema.PARTITIONS_SQL)
+
+
+class DumpSchemaTest(TestCase):
+    database = {
+        'farms': {
+            "farm1": {
+                "master": "fake1:3306:test_sqlstore1:sqlstore:sqlstore",
+                "tables": ["*"],
+            },
+        },
+        'options': {
+            'driver': 'fake',
+        },
+    }
+
+    def setUp(self):
+        fakedb.execute_script('test_sqlstore1', 'create table test_table1 '
+                              '(id integer primary key); create view '
+                              'test_view1 as select id from test_table1',
+                              host='fake1')
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+        fakedb.reset()
+
+    def dump(self, *argv):
+        store = M.store_from_config(self.database, use_cache=False)
+        with patch.object(dump_schema, 'store_from_config',
+                          return_value=store), \
+                patch.object(dump_schema, 'get_table_versions',
+                             return_value={
+                                 'test_view1': ('VIEW', 'v1'),
+                                 'test_table1': ('BASE TABLE', 'v1')}):
+            dump_schema.main(['-c', 'test'] + list(argv))
+        store.close()
+        with open('database-farm1.sql') as f:
+            return f.read()
+
+    def test_cache_should_only_be_written_when_requested(self):
+        ok_('CREATE TABLE test_table1' in self.dump())
+        ok_(not os.path.exists(dump_schema.SCHEMA_CACHE))
+
+        self.dump('--cache-file', 'cache.pickle')
+        cache = pickle.load(open('cache.pickle'))
+        eq_(cache['farm1.test_table1']['version'],
+            (False, 'BASE TABLE', 'v1'))
+        ok_(not os.path.exists(dump_schema.SCHEMA_CACHE))
+
+        # schemas of unchanged tables are read from the cache
+        def fail(conn, match):
+            raise M.MySQLdb.OperationalError(2013, 'Lost connection')
+
+        os.remove('database-farm1.sql')
+        scripts = [(re.compile(r'show\s+create\s+table', re.I), fail)]
+        with patch.object(fakedb, 'SCRIPTS', scripts + fakedb.SCRIPTS):
+            ok_('CREATE TABLE test_table1' in
+                self.dump('--cache-file', 'cache.pickle'))
+
+        self.dump('--only-meaningful-changes')
+        ok_(os.path.exists(dump_schema.SCHEMA_CACHE))
+
+    def test_views_should_be_dumped_after_tables(self):
+        dump = self.dump()
+        ok_('DROP VIEW IF EXISTS `test_view1`;\nCREATE VIEW test_view1 as '
+            'select id from test_table1;' in dump)
+        ok_(dump.index('CREATE TABLE test_table1') <
+            dump.index('CREATE VIEW test_view1'))
@@ -0,0 +1,680 @@
+# encoding=utf8
+
+import os
+import re
+import tempfile
+import threading
+import time
+from hashlib import md5
+from StringIO import StringIO
+from unittest import TestCase
+
+from mock import patch
+from nose.tools import eq_, ok_
+
+import douban.sqlstore as M
+from douban.sqlstore import fakedb
+from douban.sqlstore.capture import read_capture
+from douban.sqlstore.replay import Replayer
+
+
+class FakeDBTest(TestCase):
+    database = {
+        'farms': {
+            "farm1": {
+                "master": "fake1:3306:test_sqlstore1:sqlstore:sqlstore",
+                "tables": ["test_table1", "*"],
+            },
+            "farm2": {
+                "master": "fake2:3306:test_sqlstore2:sqlstore:sqlstore",
+                "tables": ["test_table2"],
+            },
+        },
+        'options': {
+            'driver': 'fake',
+        },
+    }
+
+    def setUp(self):
+        schema = ('create table {} (id integer primary key autoincrement, '
+                  'name varchar(10) not null)')
+        fakedb.execute_script('test_sqlstore1', schema.format('test_table1'),
+                              host='fake1')
+        fakedb.execute_script('test_sqlstore2', schema.format('test_table2'),
+                              host='fake2')
+
+    def tearDown(self):
+        fakedb.reset()
+
+    def prepare_store(self, **options):
+        database = dict(self.database)
+        database['options'] = dict(database['options'], **options)
+        return M.store_from_config(database, use_cache=False)
+
+    def test_get_driver(self):
+        ok_(M.get_driver() is M.MySQLdb)
+        ok_(M.get_driver('fake') is fakedb)
+
+    def test_execute(self):
+        store = self.prepare_store()
+        eq_(store.execute("insert into test_table1 (name) values (%s)", 'a'),
+            1)
+        eq_(store.execute("insert into test_table2 (name) values (%s)",
+                          ("b'c",)), 1)
+        store.commit()
+        eq_(store.execute("select id, name from test_table1"), ((1, 'a'),))
+        eq_(store.execute("select name from test_table2 where id=%s", 1),
+            (("b'c",),))
+        cursor = store.get_cursor(table='test_table2')
+        ok_(isinstance(cursor.cursor, fakedb.Cursor))
+        eq_(cursor.farm.tx_isolation, 'REPEATABLE-READ')
+
+    def test_sqlstore_checks_should_apply(self):
+        store = self.prepare_store()
+        self.assertRaises(Exception, store.execute, "delete from test_table1")
+        self.assertRaises(M.MySQLdb.ProgrammingError, store.execute,
+                          "select * from no_such_table")
+
+    def test_multi_statements(self):
+        store = self.prepare_store(multi_statements=True)
+        with store.pipeline() as p:
+            r1 = p.execute("insert into test_table1 (name) values ('a')")
+            r2 = p.execute("select count(*) from test_table1")
+        eq_(r1.value, 1)
+        eq_(r2.value, ((1,),))
+        store.rollback()
+
+    def test_multi_statements_should_fail_from_the_failing_one(self):
+        class Tracer(M.Hook):
+            def __init__(self):
+                self.calls = []
+
+            def after(self, ctx, result):
+                self.calls.append(('after', ctx.statement, result))
+
+            def error(self, ctx, exc):
+                self.calls.append(('error', ctx.statement))
+
+        for multi_statements in (True, False):
+            store = self.prepare_store(multi_statements=multi_statements)
+            tracer = Tracer()
+            store.add_hook(tracer)
+            p = store.pipeline()
+            r1 = p.execute("insert into test_table1 (name) values ('a')")
+            r2 = p.execute("select * from no_such_table")
+            r3 = p.execute("select count(*) from test_table1")
+            self.assertRaises(M.MySQLdb.ProgrammingError, p.flush)
+            eq_(r1.value, 1)
+            self.assertRaises(M.MySQLdb.ProgrammingError, lambda: r2.value)
+            self.assertRaises(M.MySQLdb.ProgrammingError, lambda: r3.value)
+            eq_(tracer.calls, [
+                ('after', "insert into test_table1 (name) values ('a')", 1),
+                ('error', "select * from no_such_table")])
+            store.rollback()
+            store.close()
+
+    def test_share_connections(self):
+        store1 = self.prepare_store(share_connections=True)
+        store2 = self.prepare_store(share_connections=True)
+        cursor1 = store1.get_cursor(table='test_table1')
+        cursor2 = store2.get_cursor(table='test_table1')
+        ok_(cursor1.connection is cursor2.connection)
+
+        # not shared across threads
+        cursors = []
+        thread = threading.Thread(target=lambda: cursors.append(
+            self.prepare_store(share_connections=True).get_cursor(
+                table='test_table1')))
+        thread.start()
+        thread.join()
+        ok_(cursors[0].connection is not cursor1.connection)
+
+        # not shared with a store in a transaction
+        store1.execute("insert into test_table1 (name) values ('a')")
+        cursor2 = store2.get_cursor(table='test_table1')
+        ok_(cursor2.connection is not cursor1.connection)
+        # the rollback of store2 does not apply to store1
+        store2.rollback()
+        store1.commit()
+        eq_(store2.execute("select count(*) from test_table1"), ((1,),))
+        store3 = self.prepare_store(share_connections=True)
+        ok_(store3.get_cursor(table='test_table1').connection is
+            cursor1.connection)
+        store1.close()
+        store2.close()
+        store3.close()
+
+    def test_shared_connections_should_belong_to_the_calling_thread(self):
+        database = dict(self.database, farms=dict(self.database['farms']))
+        database['farms']['farm3'] = dict(database['farms']['farm1'],
+                                          tables=['test_table3'])
+        database['options'] = {'driver': 'fake', 'share_connections': True}
+        store = M.store_from_config(database, use_cache=False)
+        farms = [store.get_farm('farm1'), store.get_farm('farm3')]
+        results = M.parallel_map(lambda f: f.get_cursor().connection, farms)
+        eq_([exc for _, exc in results], [None, None])
+        ok_(results[0][0] is results[1][0])
+        ident = threading.current_thread().ident
+        ok_(all(farm.shared_connection.key[0] == ident for farm in farms))
+
+        # entries of threads which exited are dropped
+        other = self.prepare_store(share_connections=True)
+        thread = threading.Thread(target=other.get_cursor,
+                                  kwargs={'table': 'test_table2'})
+        thread.start()
+        thread.join()
+        dead = other.get_farm('farm2').shared_connection.key
+        ok_(dead in M.shared_connections.connections)
+        store.get_cursor(table='test_table2')
+        ok_(dead not in M.shared_connections.connections)
+        store.close()
+        other.close()
+
+    def test_warmup_should_share_connections(self):
+        database = dict(self.database, farms=dict(self.database['farms']))
+        database['farms']['farm3'] = dict(database['farms']['farm1'],
+                                          tables=['test_table3'])
+        database['options'] = {'driver': 'fake', 'share_connections': True}
+        store = M.store_from_config(database, use_cache=False)
+        with patch.object(M.SqlFarm, 'open_connection',
+                          autospec=True,
+                          side_effect=M.SqlFarm.open_connection) as connect:
+            report = store.warmup()
+        eq_(sorted(report), ['farm1', 'farm2', 'farm3'])
+        ok_(all(isinstance(v, float) for v in report.values()))
+        eq_(connect.call_count, 2)
+        ok_(store.get_farm('farm1').cursor.connection is
+            store.get_farm('farm3').cursor.connection)
+        store.close()
+
+    def test_latency(self):
+        database = dict(self.database)
+        database['options'] = {'driver': 'fake',
+                               'driver_options': {'latency': 0.01}}
+        store = M.store_from_config(database, use_cache=False)
+        store.get_cursor(table='test_table1')
+        start = time.time()
+        store.execute("select * from test_table1")
+        ok_(time.time() - start >= 0.01)
+
+    def test_capture_and_replay(self):
+        store = self.prepare_store()
+        f = StringIO()
+        store.start_capture(f)
+        store.execute("insert into test_table1 (name) values (%s)", 'a')
+        store.commit()
+        store.execute("select name from test_table1 where id=%s", 1)
+        cursor = store.get_cursor(table='test_table2')
+        cursor.execute("select * from test_table2")
+        cursor.execute_multi([("select * from test_table2 where id=%s", 1),
+                              ("select * from test_table2 where id=%s", 2)])
+        store.stop_capture()
+        store.execute("select * from test_table2")
+
+        f.seek(0)
+        header, records = read_capture(f)
+        records = list(records)
+        eq_([r[1:4] for r in records],
+            [('farm1', "insert into test_table1 (name) values (%s)", 'a'),
+             ('farm1', "select name from test_table1 where id=%s", 1),
+             ('farm2', "select * from test_table2", None),
+             ('farm2', "select * from test_table2 where id=%s", 1),
+             ('farm2', "select * from test_table2 where id=%s", 2)])
+        ok_(all(r[5] for r in records))
+
+        replayer = Replayer(self.database, speed=0, concurrency=2,
+                            read_only=True)
+        report = replayer.run(records)
+        eq_(report['statements'], 4)
+        eq_(report['skipped'], 1)
+        eq_(sum(r['errors'] for r in report['fingerprints']), 0)
+
+        # connection errors are counted, the workers keep running
+        replayer = Replayer(self.database, speed=0, concurrency=2,
+                            read_only=True)
+        with patch.object(M.SqlFarm, 'open_connection',
+                          side_effect=M.MySQLdb.OperationalError(2003, '')):
+            report = replayer.run(records)
+        eq_(report['statements'], 4)
+        eq_(sum(r['errors'] for r in report['fingerprints']), 4)
+
+    def test_parallel_map(self):
+        running = []
+        peak = []
+
+        def func(item):
+            running.append(item)
+            peak.append(len(running))
+            time.sleep(0.01)
+            running.remove(item)
+            if item == 3:
+                raise ValueError(item)
+            return item * 2
+
+        results = M.parallel_map(func, range(10), pool_size=2)
+        eq_([r for r, _ in results], [0, 2, 4, None, 8, 10, 12, 14, 16, 18])
+        ok_(isinstance(results[3][1], ValueError))
+        ok_(max(peak) <= 2)
+
+    def test_xa_recover(self):
+        fd, xa_log = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, xa_log)
+        store = self.prepare_store(xa_log=xa_log)
+        store.transaction_begin(xa=True)
+        store.execute("insert into test_table1 (name) values ('a')")
+        store.execute("insert into test_table2 (name) values ('b')")
+        committed = store.xa_gtrid
+        store.commit()
+        eq_(sorted(M.read_xa_log(xa_log)[committed]), ['commit', 'prepare'])
+
+        old = 'sqlstore-host-1-%d-1' % (time.time() - 3600)
+        # started long ago, prepared just now
+        recent = 'sqlstore-host-1-%d-2' % (time.time() - 3600)
+        with open(xa_log, 'a') as f:
+            f.write('%s prepare %.3f\n' % (recent, time.time()))
+        rows = [(1, len(gtrid), 5, gtrid + 'farm1')
+                for gtrid in (committed, old, recent, 'other')]
+        resolved = []
+        scripts = [(M.re.compile(r'xa\s+recover', M.re.I), rows),
+                   (M.re.compile(r'xa\s+(commit|rollback)\s', M.re.I),
+                    lambda conn, match: resolved.append(
+                        (match.group(1).lower(), match.string)) or [])]
+        with patch.object(fakedb, 'SCRIPTS', scripts + fakedb.SCRIPTS):
+            eq_(store.xa_recover(older_than=10)['farm1'],
+                [(old, 'farm1')])
+            eq_(store.xa_recover(older_than=0)['farm1'],
+                [(committed, 'farm1'), (old, 'farm1'), (recent, 'farm1')])
+            eq_(resolved, [])
+            store.xa_recover('rollback', older_than=0)
+            eq_([(action, committed in sql) for action, sql in resolved],
+                [('rollback', False)] * 4)
+            del resolved[:]
+            store.xa_recover('commit', older_than=0)
+            eq_([(action, committed in sql) for action, sql in resolved],
+                [('commit', True)] * 2)
+            store.xa_log = None
+            self.assertRaises(Exception, store.xa_recover, 'rollback')
+
+    def test_xa_gtrid_should_fit_mysql_limit(self):
+        with patch.object(M, 'host', 'h' * 255):
+            gtrid = M.new_xa_gtrid()
+        ok_(len(gtrid) <= 64)
+        ok_(abs(M.parse_xa_gtrid(gtrid) - time.time()) < 10)
+
+    def test_xa_branches_should_not_share_connections(self):
+        database = dict(self.database, farms=dict(self.database['farms']))
+        database['farms']['farm3'] = dict(database['farms']['farm1'],
+                                          tables=['test_table3'])
+        database['options'] = {'driver': 'fake', 'share_connections': True}
+        fakedb.execute_script('test_sqlstore1', 'create table test_table3 '
+                              '(id integer primary key, name varchar(10))',
+                              host='fake1')
+        store = M.store_from_config(database, use_cache=False)
+        store.transaction_begin(xa=True)
+        store.execute("insert into test_table1 (name) values ('a')")
+        try:
+            store.execute("insert into test_table3 (name) values ('b')")
+        except Exception, exc:
+            ok_('share one connection' in str(exc))
+        else:
+            ok_(False, 'XA branches share a connection')
+        store.rollback()
+        store.close()
+
+    def test_warmup(self):
+        database = dict(self.database)
+        database['options'] = {'driver': 'fake',
+                               'driver_options': {'connect_latency': 0.05}}
+        store = M.store_from_config(database, use_cache=False)
+        start = time.time()
+        report = store.warmup()
+        ok_(time.time() - start < 0.1)
+        eq_(sorted(report), ['farm1', 'farm2'])
+        ok_(all(t >= 0.05 for t in report.values()))
+        start = time.time()
+        store.execute("select * from test_table2")
+        ok_(time.time() - start < 0.05)
+        report = store.warmup(['farm1'], parallel=False)
+        ok_(report['farm1'] < 0.05)
+
+    def test_keepalive(self):
+        database = dict(self.database)
+        database['options'] = {'driver': 'fake',
+                               'driver_options': {'connect_latency': 0.05},
+                               'keepalive_interval': 0.02,
+                               'keepalive_idle': 0.1}
+        store = M.store_from_config(database, use_cache=False)
+        ok_(store.keepalive.is_alive())
+        store.execute("select * from test_table1")
+        farm = store.get_farm('farm1')
+        cursor = farm.cursor
+        time.sleep(0.3)
+        ok_(farm.spare is not None)
+        start = time.time()
+        store.execute("select * from test_table1")
+        ok_(time.time() - start < 0.05)
+        ok_(farm.cursor is not cursor)
+        ok_(farm.spare is None)
+        # not touched since the farm has never been used
+        ok_(store.get_farm('farm2').spare is None)
+
+        # not switched in a transaction
+        store.execute("insert into test_table1 (name) values ('a')")
+        cursor = farm.cursor
+        time.sleep(0.3)
+        ok_(farm.spare is not None)
+        store.execute("select * from test_table1")
+        ok_(farm.cursor is cursor)
+        store.commit()
+        eq_(farm.tx_isolation, 'REPEATABLE-READ')
+        store.keepalive.stop()
+        store.close()
+
+    def test_retry(self):
+        store = self.prepare_store(retry_attempts=2, retry_backoff=0.001)
+        broken = []
+
+        def server_gone(conn, match):
+            if conn in broken:
+                raise M.MySQLdb.OperationalError(2006, 'gone away')
+            return [(1,)]
+
+        fakedb.add_script(r'select id from test_table1', server_gone)
+        try:
+            sql = "select id from test_table1 where id=%s"
+            broken.append(store.get_cursor(table='test_table1').connection)
+            eq_(store.execute(sql, 1), ((1,),))
+            eq_(store.retries, 1)
+            ok_(store.get_cursor(table='test_table1').connection
+                not in broken)
+
+            # the cursor is replaced by the one on the new connection
+            cursor = store.get_cursor(table='test_table1')
+            broken.append(cursor.connection)
+            cursor.execute(sql, 1)
+            eq_(cursor.fetchall(), ((1,),))
+            eq_(store.retries, 2)
+            fresh = store.get_cursor(table='test_table1')
+            ok_(fresh is not cursor and fresh.cursor is not cursor.cursor)
+            ok_(cursor.replaced_by is fresh)
+            eq_(cursor.execute(sql, 2), 1)
+            eq_(fresh.fetchall(), ((1,),))
+
+            # locking reads are not retried
+            broken.append(fresh.connection)
+            self.assertRaises(M.MySQLdb.OperationalError, store.execute,
+                              sql + ' for update', 1)
+            eq_(store.retries, 2)
+            store.rollback()
+
+            store.transaction_begin()
+            broken.append(store.get_cursor(table='test_table1').connection)
+            self.assertRaises(M.MySQLdb.OperationalError, store.execute,
+                              sql, 1)
+            store.rollback()
+            eq_(store.retries, 2)
+        finally:
+            fakedb.SCRIPTS.pop(0)
+
+    def test_query_budget(self):
+        store = self.prepare_store(query_budget={'repeat_threshold': 3})
+        sql = "select * from test_table1 where id=%s"
+        with store.query_budget('request', soft_statements=4,
+                                hard_statements=6) as budget:
+            for i in xrange(5):
+                store.execute(sql, i)
+            store.execute("select * from test_table2")
+            self.assertRaises(M.QueryBudgetExceeded, store.execute,
+                              "select * from test_table2")
+        ok_(store.budget is None)
+        summary = budget.summary()
+        eq_(summary['name'], 'request')
+        eq_(summary['statements'], 6)
+        eq_([(r['sql'], r['count'], r['distinct_args'])
+             for r in summary['repeated']], [(sql, 5, 3)])
+        eq_([kind for kind, _ in summary['exceeded']],
+            ['repeated', 'soft_statements', 'hard_statements'])
+
+        # the budget of a thread does not account other threads
+        with store.query_budget('request') as budget:
+            thread = threading.Thread(target=store.execute,
+                                      args=("select * from test_table2",))
+            thread.start()
+            thread.join()
+            store.execute("select * from test_table1")
+        eq_(budget.summary()['statements'], 1)
+
+    def test_hooks(self):
+        store = self.prepare_store()
+        eq_(len(store.after_hooks), 0)
+        store.show_warnings = True
+        eq_(len(store.after_hooks), 1)
+
+        class Tracer(M.Hook):
+            def __init__(self):
+                self.calls = []
+
+            def before(self, ctx):
+                ctx.sql = '/* traced */ ' + ctx.sql
+
+            def after(self, ctx, result):
+                self.calls.append((ctx.cmd, ctx.statement, result))
+
+            def error(self, ctx, exc):
+                self.calls.append((ctx.cmd, ctx.statement, exc))
+
+        tracer = Tracer()
+        store.add_hook(tracer, 0)
+        store.execute("insert into test_table1 (name) values (%s)", 'a')
+        self.assertRaises(M.QueryDisabledException, self.disable_and_execute,
+                          store, "select * from test_table1")
+        store.remove_hook(tracer)
+        store.execute("select * from test_table1")
+        eq_([c[:2] for c in tracer.calls],
+            [('insert', "insert into test_table1 (name) values (%s)"),
+             ('select', "select * from test_table1")])
+        ok_(isinstance(tracer.calls[1][2], M.QueryDisabledException))
+        store.rollback()
+
+    def test_failing_error_hook_should_not_replace_the_error(self):
+        class Failing(M.Hook):
+            def error(self, ctx, exc):
+                raise ValueError('hook failed')
+
+        store = self.prepare_store()
+        store.add_hook(Failing())
+        with patch.object(M, 'buffered_slog') as slog:
+            self.assertRaises(M.MySQLdb.ProgrammingError, store.execute,
+                              "select * from no_such_table")
+        ok_(slog.call_args[0][0].startswith('ERROR_HOOK_FAIL Failing '))
+
+    def disable_and_execute(self, store, sql):
+        store.disabled_queries[md5(sql).hexdigest()] = time.time() + 60
+        try:
+            store.execute(sql)
+        finally:
+            store.disabled_queries.clear()
+
+    def test_after_fork(self):
+        store = self.prepare_store()
+        store.execute("insert into test_table1 (name) values (%s)", 'a')
+        cursor = store.get_cursor(table='test_table1')
+        pid = M.os.getpid()
+        M.buffered_slog('PARENT_MESSAGE')
+        with patch.object(M.os, 'getpid', return_value=pid + 1):
+            # the transaction of the parent is not visible in the child
+            ok_(not store.is_dirty())
+            eq_(len(M.log_buffer.pending), 0)
+            new_cursor = store.get_cursor(table='test_table1')
+            ok_(new_cursor is not cursor)
+            ok_(cursor in M._inherited_connections)
+            eq_(sorted(store.after_fork(warmup=True)), ['farm1', 'farm2'])
+        M.reset_after_fork()
+        store.rollback_all(force=True)
+
+        store = self.prepare_store()
+        store.execute("insert into test_table1 (name) values (%s)", 'a')
+        cursor = store.get_cursor(table='test_table1')
+        with patch.object(M.os, 'getpid', return_value=pid + 2):
+            store.rollback()
+            store.commit()
+            store.close()
+        M.reset_after_fork()
+        # the inherited connection is neither rolled back nor closed
+        ok_(cursor.connection.open)
+        eq_(cursor.connection.database.execute(
+            'select count(*) from test_table1').fetchone(), (1,))
+
+    def test_conv(self):
+        fakedb.execute_script('test_sqlstore1', 'create table test_table3 '
+                              '(id integer, score real, name varchar(10));'
+                              "insert into test_table3 values (1, 0.5, 'a');",
+                              host='fake1')
+        store = self.prepare_store()
+        sql = 'select id, score, name from test_table3'
+        eq_(store.execute(sql), ((1, 0.5, 'a'),))
+        cursor = store.get_cursor(table='test_table3', raw=True)
+        cursor.execute(sql)
+        eq_(cursor.fetchall(), (('1', '0.5', 'a'),))
+        eq_(cursor.connection.converter, fakedb.conversions)
+        cursor = store.get_cursor(table='test_table3', conv={8: int})
+        cursor.execute(sql)
+        eq_(cursor.fetchall(), ((1, '0.5', 'a'),))
+
+        database = dict(self.database)
+        database['farms'] = dict(database['farms'])
+        database['farms']['farm1'] = dict(database['farms']['farm1'],
+                                          conv='light')
+        store = M.store_from_config(database, use_cache=False)
+        eq_(store.execute(sql), ((1, 0.5, 'a'),))
+        cursor = store.get_cursor(table='test_table3', raw=True)
+        cursor.execute(sql)
+        eq_(cursor.fetchall(), (('1', '0.5', 'a'),))
+        ok_(isinstance(store.execute(sql)[0][0], int))
+
+        store = self.prepare_store(conv='raw')
+        eq_(store.execute(sql), (('1', '0.5', 'a'),))
+        self.assertRaises(ValueError, self.prepare_store, conv='no_such')
+
+    def test_conv_should_apply_after_retry(self):
+        store = self.prepare_store(retry_attempts=1, retry_backoff=0.001)
+        broken = []
+
+        def server_gone(conn, match):
+            if conn in broken:
+                raise M.MySQLdb.OperationalError(2006, 'gone away')
+            return [(conn.convert(1), conn.convert('a'))]
+
+        cursor = store.get_cursor(table='test_table1', raw=True)
+        broken.append(cursor.connection)
+        scripts = [(re.compile(r'select id, name from test_table1'),
+                    server_gone)]
+        with patch.object(fakedb, 'SCRIPTS', scripts + fakedb.SCRIPTS):
+            cursor.execute('select id, name from test_table1')
+            eq_(store.retries, 1)
+            eq_(cursor.fetchall(), (('1', 'a'),))
+            cursor.execute('select id, name from test_table1')
+            eq_(cursor.fetchall(), (('1', 'a'),))
+        eq_(cursor.connection.converter, fakedb.conversions)
+
+    def test_connect_options(self):
+        eq_(M.parse_config_string('host:3306:db:user:pw?compress=1&'
+                                  'read_timeout=30'),
+            dict(host='host', port=3306, db='db', user='user', passwd='pw',
+                 compress=1, read_timeout=30))
+        # "?" in passwords
+        eq_(M.parse_config_string('h:3306:db:u:pa?ss')['passwd'], 'pa?ss')
+        eq_(M.parse_config_string('h:3306:db:u:p?w=1')['passwd'], 'p?w=1')
+        eq_(M.parse_config_string('h:3306:db:u:p?compress=x')['passwd'],
+            'p?compress=x')
+        eq_(M.parse_config_string('h:3306:db:u:p?w?compress=1'),
+            dict(host='h', port=3306, db='db', user='u', passwd='p?w',
+                 compress=1))
+        self.assertRaises(ValueError, M.parse_connect_options,
+                          {'no_such_option': 1})
+        dbcnf = M.parse_config_string('h:3306:db:u:p?read_timeout=30')
+        with patch.object(M.MySQLdb, 'version_info', (1, 2, 4), create=True):
+            self.assertRaises(ValueError, M.check_connect_options, dbcnf)
+            M.check_connect_options(dict(dbcnf, driver='fake'))
+        with patch.object(M.MySQLdb, 'version_info', (1, 3, 8), create=True):
+            M.check_connect_options(dbcnf)
+
+        database = dict(self.database)
+        database['options'] = dict(database['options'], connect_options={
+            'net_write_timeout': 600, 'compress': 0})
+        database['farms'] = dict(database['farms'])
+        database['farms']['farm2'] = dict(database['farms']['farm2'],
+                                          connect_options={'compress': True})
+        store = M.store_from_config(database, use_cache=False)
+        eq_(store.get_farm('farm1').dbcnf['net_write_timeout'], 600)
+        cursor = store.get_cursor(table='test_table1')
+        eq_(cursor.connection.compress, 0)
+        eq_(store.get_cursor(table='test_table2').connection.compress, 1)
+
+        compressed = store.get_cursor(table='test_table1', compress=True)
+        eq_(compressed.connection.compress, 1)
+        ok_(compressed.farm is not cursor.farm)
+        eq_(compressed.farm.name, 'farm1')
+        ok_(store.get_cursor(table='test_table1', compress=False) is cursor)
+        self.assertRaises(Exception, store.execute,
+                          "insert into test_table1 (name) values (%s)", 'a',
+                          compress=True)
+        self.assertRaises(Exception, compressed.execute,
+                          "insert into test_table1 (name) values (%s)", 'a')
+        eq_(store.execute('select name from test_table1', compress=True), ())
+        store.execute("insert into test_table1 (name) values (%s)", 'a')
+        self.assertRaises(Exception, store.execute,
+                          'select name from test_table1', compress=True)
+        self.assertRaises(Exception, store.get_cursor, table='test_table1',
+                          compress=True)
+        store.commit()
+        eq_(store.execute('select name from test_table1', compress=True),
+            (('a',),))
+        store.close()
+        ok_(compressed.farm.cursor is None)
+
+    def test_store_cache_should_close_evicted_stores(self):
+        database = dict(self.database)
+        with patch.object(M, '_stores',
+                          M.StoreCache(1, M.close_evicted_store)):
+            store1 = M.store_from_config(database)
+            ok_(M.store_from_config(dict(database)) is store1)
+            farm = store1.get_farm('farm1')
+            store1.execute("select * from test_table1")
+            ok_(farm.cursor is not None)
+
+            store2 = M.store_from_config(dict(database, options={
+                'driver': 'fake', 'logging': True}))
+            ok_(store2 is not store1)
+            ok_(farm.cursor is None)
+            # reconnects if still used
+            eq_(store1.execute("select count(*) from test_table1"), ((0,),))
+
+            # not closed in a transaction
+            store2.execute("insert into test_table1 (name) values ('a')")
+            farm = store2.get_farm('farm1')
+            ok_(M.store_from_config(database) is not store1)
+            ok_(farm.cursor is not None)
+            store2.rollback()
+            store1.close()
+            store2.close()
+
+    def test_receive_conf_should_reuse_farms(self):
+        store = M.store_from_config(self.database, use_cache=False,
+                                    delete_without_where=True)
+        farm1 = store.get_farm('farm1')
+        farm2 = store.get_farm('farm2')
+        cursor = store.get_cursor(table='test_table2')
+        database = dict(self.database)
+        database['farms'] = dict(database['farms'])
+        database['farms']['farm2'] = dict(
+            database['farms']['farm2'],
+            master='fake2:3306:test_sqlstore3:sqlstore:sqlstore')
+        store.receive_conf(repr(database))
+        ok_(store.get_farm('farm1') is farm1)
+        ok_(store.get_farm('farm2') is not farm2)
+        ok_(store.get_farm('farm2').delete_without_where)
+        # the replaced farm is closed
+        ok_(farm2.cursor is None)
+        ok_(not cursor.connection.open)
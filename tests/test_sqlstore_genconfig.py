@@ -0,0 +1,91 @@
+# encoding=utf8
+
+import json
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from mock import patch
+from nose.tools import eq_, ok_
+
+from douban.sqlstore import genconfig
+from douban.sqlstore.genconfig import FarmManager
+
+
+class Settings(object):
+
+    default_params = {
+        'roles': ['m', 's', 'b'],
+        'rw_user': {'user': 'rw_user', 'passwd': 'rw'},
+        'ro_user': {'user': 'ro_user', 'passwd': 'ro'},
+        'tables': [],
+    }
+
+    def __init__(self, **farms):
+        self.farms = farms
+        self.configs = {}
+
+
+def farm(**params):
+    return dict({'port': 3306, 'dbs': ['db']}, **params)
+
+
+class FarmManagerCacheTest(TestCase):
+
+    def setUp(self):
+        fd, self.cache_file = tempfile.mkstemp()
+        os.close(fd)
+        now = time.time()
+        with open(self.cache_file, 'w') as f:
+            json.dump({
+                'versioned': {'version': 1, 'time': now - 3600,
+                              'tables': ['t1']},
+                'fresh': {'version': None, 'time': now - 10,
+                          'tables': ['t2']},
+                'stale': {'version': None, 'time': now - 3600,
+                          'tables': ['t3']},
+            }, f)
+
+    def tearDown(self):
+        os.remove(self.cache_file)
+
+    def test_cache_should_be_valid_by_schema_version(self):
+        settings = Settings(versioned=farm(schema_version=1))
+        fm = FarmManager(settings, cache_file=self.cache_file)
+        eq_(fm.get_cached_tables('versioned'), ['t1'])
+
+        settings.farms['versioned']['schema_version'] = 2
+        eq_(fm.get_cached_tables('versioned'), None)
+
+    def test_cache_should_be_valid_by_ttl(self):
+        settings = Settings(fresh=farm(), stale=farm())
+        fm = FarmManager(settings, cache_file=self.cache_file, cache_ttl=60)
+        eq_(fm.get_cached_tables('fresh'), ['t2'])
+        eq_(fm.get_cached_tables('stale'), None)
+        fm.cache_ttl = 0
+        eq_(fm.get_cached_tables('fresh'), None)
+
+    def test_discover_tables(self):
+        settings = Settings(versioned=farm(schema_version=1), fresh=farm(),
+                            stale=farm())
+        fm = FarmManager(settings, cache_file=self.cache_file, cache_ttl=60,
+                         jobs=2)
+        with patch.object(genconfig, 'SqlFarm') as sqlfarm, \
+                patch.object(genconfig, 'parallel_map',
+                             wraps=genconfig.parallel_map) as parallel_map:
+            cursor = sqlfarm.return_value.get_cursor.return_value
+            cursor.fetchall.return_value = [('t4',)]
+            fm.discover_tables(['versioned', 'fresh', 'stale'])
+        eq_(parallel_map.call_args[1], {'pool_size': 2})
+        # only the farm with a stale cache is queried
+        eq_(sqlfarm.call_count, 1)
+        ok_(sqlfarm.call_args[0][0].startswith('stale_m:3306:db:'))
+        eq_([fm.get_tables(f) for f in ('versioned', 'fresh', 'stale')],
+            [['t1'], ['t2'], ['t4']])
+
+        fm.save_cache()
+        with open(self.cache_file) as f:
+            cache = json.load(f)
+        eq_(cache['stale']['tables'], ['t4'])
+        ok_(time.time() - cache['stale']['time'] < 60)
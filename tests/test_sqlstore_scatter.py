@@ -0,0 +1,151 @@
+# encoding=utf8
+
+from unittest import TestCase
+
+from nose.tools import eq_, ok_
+
+import douban.sqlstore as M
+from douban.sqlstore import fakedb
+from douban.sqlstore.scatter import ScatterQuery
+
+
+DESCRIPTION = (('id',), ('name',))
+
+
+class ScatterQueryTest(TestCase):
+
+    def test_parse(self):
+        query = ScatterQuery('select id, name from t where x in (select y '
+                             'from u order by y limit 3) order by t.name '
+                             'desc, id limit 5, 10')
+        eq_(query.offset, 5)
+        eq_(query.limit, 10)
+        eq_(query.order_by, [('t.name', True), ('id', False)])
+        eq_(query.columns, ['id', 'name'])
+        ok_(query.farm_sql.endswith('order by t.name desc, id limit 15'))
+        query = ScatterQuery('select id from t limit 10 offset 2')
+        eq_((query.offset, query.limit), (2, 10))
+
+    def test_limit_placeholders(self):
+        query = ScatterQuery('select id from t where x=%s order by id desc '
+                             'limit %s, %s', (1, 5, 10))
+        eq_((query.offset, query.limit), (5, 10))
+        eq_(query.order_by, [('id', True)])
+        eq_(query.args, (1,))
+        eq_(query.farm_sql, 'select id from t where x=%s order by id desc '
+            'limit 15')
+        query = ScatterQuery('select id from t limit %s offset %s', (3, 1))
+        eq_((query.offset, query.limit, query.args), (1, 3, ()))
+        query = ScatterQuery('select id from t limit %(n)s', {'n': 4})
+        eq_(query.limit, 4)
+
+    def test_merge_order_by(self):
+        query = ScatterQuery('select id, name from t order by name desc, id '
+                             'limit 1, 3')
+        results = [(DESCRIPTION, ((1, 'c'), (4, 'b'), (5, 'a'))),
+                   (DESCRIPTION, ((2, 'c'), (3, 'b'))),
+                   (None, ())]
+        eq_(query.merge(results), ((2, 'c'), (3, 'b'), (4, 'b')))
+
+    def test_merge_aggregates(self):
+        query = ScatterQuery('select count(*), sum(x), min(x), max(x) as m '
+                             'from t')
+        eq_(query.aggregates, ['count', 'sum', 'min', 'max'])
+        results = [(None, ((2, 5, 1, 4),)), (None, ((0, None, None, None),)),
+                   (None, ((1, 7, 7, 7),))]
+        eq_(query.merge(results), ((3, 12, 1, 7),))
+
+        query = ScatterQuery('select kind, count(*) as n from t group by kind '
+                             'order by n desc limit 2')
+        description = (('kind',), ('n',))
+        results = [(description, (('a', 1), ('b', 2))),
+                   (description, (('c', 2), ('a', 5)))]
+        eq_(query.merge(results), (('a', 6), ('b', 2)))
+
+    def test_merge_distinct(self):
+        for sql in ('select kind from t group by kind order by kind limit 2',
+                    'select distinct kind from t order by kind limit 2'):
+            query = ScatterQuery(sql)
+            ok_('limit' not in query.farm_sql)
+            results = [((('kind',),), (('a',), ('b',))),
+                       ((('kind',),), (('a',), ('c',)))]
+            eq_(query.merge(results), (('a',), ('b',)))
+        query = ScatterQuery('select distinct * from t')
+        eq_(query.merge([(None, ((1, 'a'), (1, 'b'))), (None, ((1, 'a'),))]),
+            ((1, 'a'), (1, 'b')))
+
+    def test_not_combinable(self):
+        self.assertRaises(ValueError, ScatterQuery, 'select avg(x) from t')
+        self.assertRaises(ValueError, ScatterQuery,
+                          'select count(distinct x) from t')
+        self.assertRaises(ValueError, ScatterQuery, 'select sum(x) + 1 from t')
+
+
+class ScatterSelectTest(TestCase):
+    database = {
+        'farms': {
+            "farm0": {
+                "master": "fake0:3306:test_sqlstore0:sqlstore:sqlstore",
+                "tables": ["test_table1", "*"],
+            },
+            "farm1": {
+                "master": "fake1:3306:test_sqlstore1:sqlstore:sqlstore",
+                "tables": ["test_table1"],
+            },
+            "farm1_alias": {
+                "master": "fake1:3306:test_sqlstore1:sqlstore:sqlstore",
+                "tables": [],
+            },
+            "farm2": {
+                "master": "fake2:3306:test_sqlstore2:sqlstore:sqlstore",
+                "tables": ["test_table2"],
+            },
+        },
+        'options': {
+            'driver': 'fake',
+        },
+    }
+
+    def setUp(self):
+        schema = ('create table test_table1 (id integer primary key, '
+                  'kind varchar(10));')
+        fakedb.execute_script('test_sqlstore0', schema +
+                              "insert into test_table1 values (1, 'a');"
+                              "insert into test_table1 values (4, 'b');",
+                              host='fake0')
+        fakedb.execute_script('test_sqlstore1', schema +
+                              "insert into test_table1 values (2, 'a');"
+                              "insert into test_table1 values (3, 'a');",
+                              host='fake1')
+        fakedb.execute_script('test_sqlstore2', 'create table test_table2 '
+                              '(id integer primary key);'
+                              'insert into test_table2 values (5);',
+                              host='fake2')
+        self.store = M.store_from_config(self.database, use_cache=False)
+
+    def tearDown(self):
+        self.store.close()
+        fakedb.reset()
+
+    def test_scatter_select(self):
+        store = self.store
+        eq_(store.scatter_select('select id from test_table1 order by id '
+                                 'desc limit 3'), ((4,), (3,), (2,)))
+        eq_(store.scatter_select('select count(*) from test_table1 where '
+                                 'kind=%s', 'a'), ((3,),))
+        eq_(store.scatter_select('select id from test_table1 order by id',
+                                 farms=['farm1']), ((2,), (3,)))
+        eq_(store.scatter_select('select id from test_table1 where kind=%s '
+                                 'order by id limit %s, %s', ('a', 1, 2)),
+            ((2,), (3,)))
+        eq_(store.scatter_select('select distinct kind from test_table1 '
+                                 'order by kind'), (('a',), ('b',)))
+        eq_(store.scatter_select('select kind, max(id) from test_table1 '
+                                 'group by kind order by kind'),
+            (('a', 3), ('b', 4)))
+
+    def test_default_farms_should_hold_the_tables(self):
+        store = self.store
+        eq_(store.scatter_select('select id from test_table2'), ((5,),))
+        self.assertRaises(ValueError, store.scatter_select,
+                          'select id from test_table3')
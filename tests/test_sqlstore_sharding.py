@@ -0,0 +1,193 @@
+# encoding=utf8
+
+import os
+import tempfile
+from StringIO import StringIO
+from unittest import TestCase
+
+from nose.tools import eq_
+
+import douban.sqlstore as M
+from douban.sqlstore import fakedb
+from douban.sqlstore.capture import read_capture
+from douban.sqlstore.replay import Replayer
+from douban.sqlstore.sharding import ShardedTable, ShardingError
+
+
+class ShardedTableTest(TestCase):
+
+    def setUp(self):
+        self.shard = ShardedTable('user_event', 'user_id', 'hash',
+                                  farms=['farm0', 'farm1'])
+
+    def test_hash(self):
+        eq_(self.shard.get_farm_name(3), 'farm1')
+        eq_(self.shard.get_farm_name('4'), 'farm0')
+        eq_(self.shard.get_farm_name('abc'),
+            self.shard.get_farm_name(u'abc'))
+        self.assertRaises(ShardingError, self.shard.get_farm_name, None)
+
+    def test_range(self):
+        shard = ShardedTable('user_log', 'user_id', 'range',
+                             ranges=[[100, 'farm1'], [0, 'farm0']])
+        eq_(shard.get_farm_name(0), 'farm0')
+        eq_(shard.get_farm_name(99), 'farm0')
+        eq_(shard.get_farm_name(100), 'farm1')
+        self.assertRaises(ShardingError, shard.get_farm_name, -1)
+
+    def test_extract_keys(self):
+        extract = self.shard.extract_keys
+        eq_(extract('select', 'select * from user_event where user_id=%s',
+                    1), [1])
+        eq_(extract('select', 'select * from user_event where '
+                    'e.`user_id` = %s and kind=%s', (1, 2)), [1])
+        eq_(extract('select', 'select * from user_event where user_id in '
+                    '(%s, %s, 5)', (1, 2)), [1, 2, 5])
+        eq_(extract('select', 'select * from user_event where user_id in %s',
+                    ((1, 2),)), [1, 2])
+        eq_(extract('update', 'update user_event set kind=%(kind)s '
+                    'where user_id=%(uid)s', {'kind': 1, 'uid': 7}), [7])
+        eq_(extract('delete', "delete from user_event where user_id='8'"),
+            ['8'])
+        eq_(extract('select', 'select * from user_event where kind=%s', 1),
+            None)
+        eq_(extract('select', 'select * from user_event where user_id=%s '
+                    'or kind=%s', (1, 2)), None)
+        eq_(extract('select', 'select * from user_event where user_id not '
+                    'in (%s)', 1), None)
+        eq_(extract('update', 'update user_event set user_id=%s where id=%s',
+                    (1, 2)), None)
+        eq_(extract('update', 'update user_event set user_id=%s where '
+                    'user_id=%s', (1, 2)), [2])
+        eq_(extract('select', 'select * from user_event where not '
+                    'user_id = 1'), None)
+        eq_(extract('select', 'select * from user_event where !(user_id = 1)'),
+            None)
+        eq_(extract('select', 'select * from user_event where user_id = 1 '
+                    '|| id=2'), None)
+        eq_(extract('select', 'select * from user_event where user_id = 1 '
+                    'and kind != 2'), [1])
+
+    def test_extract_inserted_keys(self):
+        extract = self.shard.extract_keys
+        eq_(extract('insert', 'insert into user_event (kind, user_id) '
+                    'values (%s, %s)', (1, 2)), [2])
+        eq_(extract('insert', 'insert into user_event (kind, user_id, time) '
+                    'values (%s, %s, now()), (%s, 4, now()) on duplicate key '
+                    'update kind=values(kind)', (1, 2, 3)), [2, 4])
+        eq_(extract('insert', 'insert into user_event set kind=%s, '
+                    'user_id=%s', (1, 2)), [2])
+
+
+class ShardingTest(TestCase):
+    database = {
+        'farms': {
+            "farm0": {
+                "master": "fake0:3306:test_sqlstore0:sqlstore:sqlstore",
+                "tables": ["*"],
+            },
+            "farm1": {
+                "master": "fake1:3306:test_sqlstore1:sqlstore:sqlstore",
+                "tables": [],
+            },
+        },
+        'shards': {
+            'user_event': {
+                'key': 'user_id',
+                'function': 'hash',
+                'farms': ['farm0', 'farm1'],
+            },
+        },
+        'options': {
+            'driver': 'fake',
+        },
+    }
+
+    def setUp(self):
+        schema = ('create table user_event (id integer primary key '
+                  'autoincrement, user_id integer not null, kind integer)')
+        fakedb.execute_script('test_sqlstore0', schema, host='fake0')
+        fakedb.execute_script('test_sqlstore1', schema, host='fake1')
+        self.store = M.store_from_config(self.database, use_cache=False)
+
+    def tearDown(self):
+        self.store.close()
+        fakedb.reset()
+
+    def test_route_by_shard_key(self):
+        store = self.store
+        for user_id in (1, 2, 3):
+            store.execute('insert into user_event (user_id, kind) '
+                          'values (%s, %s)', (user_id, 0))
+        store.commit()
+        eq_(store.execute('select user_id from user_event where user_id=%s',
+                          3), ((3,),))
+        cursor = store.get_cursor(table='user_event', shard_key=1)
+        eq_(cursor.farm.name, 'farm1')
+        cursor.execute('select user_id from user_event order by user_id')
+        eq_(cursor.fetchall(), ((1,), (3,)))
+        self.assertRaises(ShardingError, store.get_cursor, table='user_event')
+
+    def test_multiple_shards(self):
+        store = self.store
+        self.assertRaises(ShardingError, store.execute,
+                          'insert into user_event (user_id) values (%s), (%s)',
+                          (1, 2))
+        store.execute('insert into user_event (user_id) values (%s)', 1)
+        store.execute('insert into user_event (user_id) values (%s)', 2)
+        store.commit()
+        sql = 'select user_id from user_event where user_id in (%s, %s)'
+        self.assertRaises(ShardingError, store.execute, sql, (1, 2))
+        eq_(sorted(store.execute(sql, (1, 2), scatter=True)), [(1,), (2,)])
+        eq_(store.execute('update user_event set kind=1 where kind is null',
+                          scatter=True), 2)
+        store.commit()
+
+    def test_load_file(self):
+        database = dict(self.database, options={
+            'driver': 'fake', 'driver_options': {'local_infile': 1}})
+        store = M.store_from_config(database, use_cache=False)
+        fd, path = tempfile.mkstemp()
+        os.write(fd, '1\t0\n3\t0\n')
+        os.close(fd)
+        try:
+            columns = ['user_id', 'kind']
+            self.assertRaises(ShardingError, store.load_file, 'user_event',
+                              path, columns)
+            eq_(store.load_file('user_event', path, columns, farm='farm1'),
+                2)
+            store.commit()
+            cursor = store.get_cursor(table='user_event', shard_key=1)
+            cursor.execute('select user_id from user_event')
+            eq_(cursor.fetchall(), ((1,), (3,)))
+            cursor = store.get_cursor(table='user_event', shard_key=2)
+            cursor.execute('select user_id from user_event')
+            eq_(cursor.fetchall(), ())
+        finally:
+            os.remove(path)
+            store.close()
+
+    def test_replay(self):
+        store = self.store
+        f = StringIO()
+        store.start_capture(f)
+        store.execute('insert into user_event (user_id) values (%s)', 1)
+        store.execute('insert into user_event (user_id) values (%s)', 2)
+        store.commit()
+        store.execute('select kind from user_event where user_id=%s', 1)
+        cursor = store.get_cursor(table='user_event', shard_key=2)
+        cursor.execute('select kind from user_event')
+        store.stop_capture()
+
+        f.seek(0)
+        _, records = read_capture(f)
+        replayer = Replayer(self.database, speed=0)
+        report = replayer.run(list(records))
+        eq_(report['statements'], 4)
+        eq_(sum(r['errors'] for r in report['fingerprints']), 0)
+
+    def test_invalid_config(self):
+        database = dict(self.database, shards={
+            'user_event': {'key': 'user_id', 'farms': ['farm0', 'farm2']}})
+        self.assertRaises(ShardingError, M.store_from_config, database,
+                          use_cache=False)